@@ -62,7 +62,7 @@ export function updateCase(data) {
 
 /**
  * 根据姓名搜索病人
- * @param {object} params - 查询参数，例如 { name: '张三' }
+ * @param {object} params - 查询参数，例如 { name: '张三', page: 1, per_page: 20 }，结果按相关度排序
  */
 export function searchPatients(params) {
   return request({
@@ -72,6 +72,20 @@ export function searchPatients(params) {
   })
 }
 
+/**
+ * 按姓名或拼音首字母前缀联想病人
+ * @param {object} params - 查询参数，例如 { q: 'zs', limit: 10, seq: 3 }，seq 会原样返回
+ * @param {AbortSignal} signal - 用于取消被新输入取代的请求
+ */
+export function typeaheadPatients(params, signal) {
+  return request({
+    url: '/api/hospital/patient/typeahead',
+    method: 'get',
+    params,
+    signal
+  })
+}
+
 export function getCaseById(case_id) {
     return request({
         url: '/api/hospital/case/single',
@@ -19,6 +19,23 @@ export function addImage(formData) {
     })
 }
 
+// 上传DICOM序列 (多个单帧DICOM文件或zip压缩包)，组装为3D影像
+export function addImageSeries(formData) {
+    return request({
+        url: '/api/image/series',
+        method: 'post',
+        data: formData
+    })
+}
+
+// 查询3D影像后台处理任务进度
+export function getIngestJob(job_id) {
+    return request({
+        url: `/api/image/job/${job_id}`,
+        method: 'get'
+    })
+}
+
 // 删除影像
 export function deleteImage(image_id) {
     return request({
@@ -45,6 +62,22 @@ export function getImagePreview(image_id, params) {
   })
 }
 
+// 确保按需生成的切片已生成，返回切片信息
+export function ensureSlice(image_id, direction, index) {
+  return request({
+    url: `/api/image/${image_id}/slice/${direction}/${index}`,
+    method: 'post'
+  })
+}
+
+// 获取大尺寸2D影像的瓦片金字塔清单
+export function getImageTiles(image_id) {
+  return request({
+    url: `/api/image/${image_id}/tiles`,
+    method: 'get'
+  })
+}
+
 export function addAnnotation(data) {
   return request({
     url: '/api/image/annotate',
@@ -92,4 +125,10 @@ export function getImageSegList(params) {
     method: 'get',
     params
   });
-} 
\ No newline at end of file
+} 
+export function getSegJob(job_id) {
+  return request({
+    url: `/api/image/seg/job/${job_id}`,
+    method: 'get'
+  });
+}
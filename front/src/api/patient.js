@@ -58,4 +58,15 @@ export function getPatientDetail(patientId) {
     method: 'get',
     params: { patient_id: patientId }
   });
-} 
\ No newline at end of file
+} 
+/**
+ * 检索病人或病历，结果按相关度排序并分页
+ * @param {object} params - 查询参数，例如 { q: '头痛', type: 'case', page: 1, per_page: 20 }，type 为 patient 或 case
+ */
+export function searchRecords(params) {
+  return request({
+    url: '/api/patient/search',
+    method: 'get',
+    params
+  });
+}
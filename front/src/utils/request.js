@@ -51,7 +51,7 @@ service.interceptors.response.use(
   response => {
     const res = response.data
     // 根据后端接口约定，判断请求是否成功
-    if (res.code && res.code !== 200 && res.code !== 201) {
+    if (res.code && res.code !== 200 && res.code !== 201 && res.code !== 202) {
       // 如果是未登录状态
       if (res.code === 401) {
         // 清除本地存储的用户信息
@@ -65,6 +65,10 @@ service.interceptors.response.use(
     }
   },
   error => {
+    // 被主动取消的请求 (例如输入联想中被新输入取代的请求) 不提示错误
+    if (axios.isCancel(error)) {
+      return Promise.reject(error)
+    }
     // 处理401未授权错误
     if (error.response && error.response.status === 401) {
       localStorage.removeItem('userInfo')
@@ -6,11 +6,20 @@ from utils.jwtauth import jwt_required
 import bcrypt
 from user import user_bp
 from hospital import hospital_bp
-from utils.oss import upload_to_oss
+from utils.oss import uploader
 from werkzeug.utils import secure_filename
 from image import image_bp
 from patient import patient_bp
 from home import home_bp
+from ingest import ingest_queue
+from segment import seg_queue
+from utils.slice_cache import slice_cache
+from offices import office_trees
+from utils.response_cache import response_cache
+from typeahead import patient_typeahead
+from migrate import upgrade, compact_slices, backfill_previews, backfill_thumbnails
+from stats import rebuild_counters
+from search import rebuild_search_index
 import os
 
 app = flask.Flask(__name__)
@@ -19,6 +28,12 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'hidoc_secret_key'  # 添加JWT密钥
 
 db.init_app(app)
+ingest_queue.init_app(app)
+seg_queue.init_app(app)
+slice_cache.init_app(app)
+office_trees.init_app(app)
+response_cache.init_app(app)
+patient_typeahead.init_app(app)
 
 # 注册认证蓝图
 app.register_blueprint(auth_bp)
@@ -33,6 +48,42 @@ def create_tables():
     with app.app_context():
         db.create_all()
 
+# 升级已有数据库的表结构: flask --app app upgrade-db
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    applied = upgrade()
+    print(f"已执行升级步骤: {', '.join(applied)}" if applied else "数据库已是最新结构")
+
+# 将逐张切片记录的3D影像改为切片清单: flask --app app compact-slices
+@app.cli.command('compact-slices')
+def compact_slices_command():
+    compacted, skipped = compact_slices()
+    print(f"已改为切片清单: {compacted} 个影像，切片不完整而跳过: {skipped} 个影像")
+
+# 为已有影像回填列表预览指针: flask --app app backfill-previews
+@app.cli.command('backfill-previews')
+def backfill_previews_command():
+    filled, missing = backfill_previews()
+    print(f"已回填预览: {filled} 个影像，暂无预览: {missing} 个影像")
+
+# 为已有影像生成列表缩略图 (需先回填预览指针): flask --app app backfill-thumbnails
+@app.cli.command('backfill-thumbnails')
+def backfill_thumbnails_command():
+    filled, failed = backfill_thumbnails()
+    print(f"已生成缩略图: {filled} 个影像，失败: {failed} 个影像")
+
+# 从业务表重算首页统计计数器: flask --app app rebuild-stats
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    count = rebuild_counters()
+    print(f"已重算首页统计计数器: {count} 行")
+
+# 从病人和病历表重建检索索引: flask --app app rebuild-search
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    count = rebuild_search_index()
+    print(f"已重建检索索引: {count} 行")
+
 # 添加一个受保护的API接口示例
 @app.route('/api/protected', methods=['GET'])
 @jwt_required
@@ -50,38 +101,46 @@ def protected():
 @app.route('/api/upload', methods=['POST'])
 @jwt_required
 def upload_file():
-    """接收文件并上传到阿里云OSS的接口"""
+    """
+    接收文件并上传到阿里云OSS的接口。
+    支持在同一个请求中携带多个 file 字段，多个文件会并发上传，任一失败则整体返回失败。
+    """
     if 'file' not in request.files:
         return jsonify({'code': 400, 'message': '请求中不包含文件'}), 400
     
-    file = request.files['file']
+    files = request.files.getlist('file')
 
-    if file.filename == '':
+    if any(file.filename == '' for file in files):
         return jsonify({'code': 400, 'message': '未选择文件'}), 400
 
-    if file:
-        # 使用 secure_filename 确保文件名安全
-        filename = secure_filename(file.filename)
-        # 为了防止文件名冲突，可以加上用户ID或时间戳等作为前缀
-        # 这里我们简单地存放在 'uploads/' 目录下
-        object_name = f"hidoc2/uploads/{request.user_id}/{filename}"
-
-        # 直接上传文件流到OSS
-        file_url = upload_to_oss(file.stream, object_name)
-
-        if file_url:
-            return jsonify({
-                'code': 200,
-                'message': '文件上传成功',
-                'data': {
-                    'url': file_url
-                }
-            })
-        else:
-            return jsonify({'code': 500, 'message': '文件上传失败'}), 500
-
-    return jsonify({'code': 500, 'message': '发生未知错误'}), 500
+    # 使用 secure_filename 确保文件名安全
+    # 为了防止文件名冲突，可以加上用户ID或时间戳等作为前缀
+    # 这里我们简单地存放在 'uploads/' 目录下
+    items = [
+        (f"hidoc2/uploads/{request.user_id}/{secure_filename(file.filename)}", file.stream)
+        for file in files
+    ]
+
+    # 直接并发上传文件流到OSS
+    results = uploader.upload_batch(items)
+    failed = [r.key for r in results if r.error]
+
+    if failed:
+        return jsonify({'code': 500, 'message': '文件上传失败', 'data': {'failed': failed}}), 500
+
+    data = {'url': results[0].url}
+    if len(results) > 1:
+        data['urls'] = [r.url for r in results]
+    return jsonify({
+        'code': 200,
+        'message': '文件上传成功',
+        'data': data
+    })
 
 if __name__ == '__main__':
     create_tables()  # 在启动应用前创建数据库表
+    with app.app_context():
+        patient_typeahead.build()  # 启动时加载病人联想的前缀树，否则在首次查询时加载
+        ingest_queue.recover()  # 重新投递上次退出时仍在排队的影像处理任务
+        seg_queue.recover()  # 重新投递上次退出时仍在排队的AI分割任务
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,41 @@
+"""
+切片渲染性能测试：比较不同进程数下渲染一个3D体数据全部切片的耗时。
+
+用法 (在 server 目录下):
+    python benchmarks/bench_render.py --shape 300 512 512 --workers 1 2 4 8
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+from utils.render import render_volume_slices
+
+
+def main():
+    parser = argparse.ArgumentParser(description='切片渲染性能测试')
+    parser.add_argument('--shape', type=int, nargs=3, default=[120, 512, 512], help='DICOM多帧形状 (帧 行 列)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1])
+    args = parser.parse_args()
+
+    frames, rows, cols = args.shape
+    volume = (np.random.rand(frames, rows, cols) * 4000).astype(np.int16)
+    axes = {'x': cols, 'y': rows, 'z': frames}
+    total = sum(axes.values())
+
+    baseline = None
+    for workers in args.workers:
+        start = time.perf_counter()
+        for _ in render_volume_slices(volume, True, None, axes, workers):
+            pass
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f"workers={workers:<3} slices={total} time={elapsed:.2f}s "
+              f"rate={total / elapsed:.1f}/s speedup={baseline / elapsed:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
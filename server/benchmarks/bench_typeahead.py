@@ -0,0 +1,70 @@
+"""
+病人联想前缀树性能测试：构建耗时，以及不同长度前缀的单次查询延迟 (含删除后首次查询的重新计算)。
+
+只测试内存中的前缀树，不需要数据库。
+
+用法 (在 server 目录下):
+    python benchmarks/bench_typeahead.py --patients 100000 500000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from typeahead import PrefixTrie, name_keys
+
+SURNAMES = '王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗'
+GIVEN = '伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英华玉兰文'
+
+
+def make_names(count, rng):
+    return [rng.choice(SURNAMES) + ''.join(rng.choice(GIVEN) for _ in range(rng.choice((1, 2))))
+            for _ in range(count)]
+
+
+def timed(func, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(timings), max(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='病人联想前缀树性能测试')
+    parser.add_argument('--patients', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for count in args.patients:
+        names = make_names(count, rng)
+        start = time.perf_counter()
+        trie = PrefixTrie(args.limit)
+        for record_id, name in enumerate(names, 1):
+            for key in name_keys(name):
+                trie.insert(key, record_id)
+        print(f"patients={count:<7} build={time.perf_counter() - start:.2f}s")
+
+        for prefix in ('张', '张伟', names[-1]):
+            trie.search(prefix, args.limit)
+            median, worst = timed(lambda: trie.search(prefix, args.limit), args.rounds)
+            print(f"  prefix={prefix:<4} median={median:7.1f}us max={worst:7.1f}us")
+
+        # 删除一个排在最前的病人后，下一次查询需要重新计算该前缀的结果
+        record_id = trie.search('张', 1)[0]
+        for key in name_keys(names[record_id - 1]):
+            trie.remove(key, record_id)
+        start = time.perf_counter()
+        trie.search('张', args.limit)
+        print(f"  after delete, prefix=张 first query={(time.perf_counter() - start) * 1e3:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+上传性能测试：比较不同并发数下批量上传切片的吞吐量，无需连接阿里云。
+
+用法 (在 server 目录下):
+    python benchmarks/bench_upload.py --count 500 --size 200 --latency 0.03 --workers 1 4 16
+    python benchmarks/bench_upload.py --backend local --dir /tmp/hidoc_storage
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.oss import Uploader, LocalBackend, MemoryBackend
+
+
+class LatencyBackend:
+    """在真实后端之外为每次上传增加固定延迟，模拟网络往返"""
+
+    def __init__(self, backend, latency):
+        self.backend = backend
+        self.latency = latency
+
+    def put(self, key, data):
+        time.sleep(self.latency)
+        self.backend.put(key, data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量上传性能测试')
+    parser.add_argument('--backend', choices=['memory', 'local'], default='memory')
+    parser.add_argument('--dir', default='/tmp/hidoc_storage', help='local 后端的存储目录')
+    parser.add_argument('--count', type=int, default=300, help='上传对象数')
+    parser.add_argument('--size', type=int, default=150, help='每个对象的大小(KB)')
+    parser.add_argument('--latency', type=float, default=0.02, help='模拟的单次上传网络延迟(秒)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size * 1024)
+    for workers in args.workers:
+        backend = LocalBackend(args.dir) if args.backend == 'local' else MemoryBackend()
+        uploader = Uploader(LatencyBackend(backend, args.latency), max_workers=workers)
+        items = [(f"bench/{workers}/{i}.png", payload) for i in range(args.count)]
+
+        start = time.perf_counter()
+        results = uploader.upload_batch(items)
+        elapsed = time.perf_counter() - start
+        failed = sum(1 for r in results if r.error)
+        print(f"workers={workers:<3} objects={args.count} failed={failed} time={elapsed:.2f}s "
+              f"rate={args.count / elapsed:.1f}/s throughput={args.count * args.size / 1024 / elapsed:.1f}MB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,27 @@
 import utils.jwtauth
+from utils.pagination import paginate, InvalidCursor
 from flask import request, jsonify, Blueprint, make_response
 from sqlalchemy import distinct
 from sqlalchemy.orm import joinedload
 from models import db, Doctor, Office, DoctorOffice, DoctorHospital, Patient, Case, Image
+from previews import preview_urls, thumbnail_urls
+from offices import office_trees, subtree_filter
+from search import search_patients, patient_name_filter, page_args
+from typeahead import patient_typeahead
+from utils.response_cache import response_cache
 from datetime import datetime
 
 hospital_bp = Blueprint('hospital', __name__)
 
+# 科室列表随科室树和医生的科室、医院归属变化
+response_cache.invalidate_on(Office, 'offices')
+response_cache.invalidate_on(DoctorOffice, 'offices', 'doc_id')
+response_cache.invalidate_on(DoctorHospital, 'offices', 'doc_id')
+
 @hospital_bp.route('/api/hospital/office', methods=['GET'])
 @utils.jwtauth.jwt_required
+# 300 秒只在 redis 后端生效，内存后端的失效不跨进程，过期时间不超过 RESPONSE_CACHE_MEMORY_MAX_TTL
+@response_cache.cached('offices', ttl=300)
 def get_doctor_offices():
     """
     获取当前登录医生在指定医院负责的所有科室列表。
@@ -74,49 +87,25 @@ def get_doctor_offices():
         }), 403
     
     # 1. 获取医生在该医院直接负责的所有科室
-    doctor_offices = db.session.query(Office).join(
-        DoctorOffice, Office.id == DoctorOffice.off_id
+    doctor_office_ids = [off_id for off_id, in db.session.query(DoctorOffice.off_id).join(
+        Office, Office.id == DoctorOffice.off_id
     ).filter(
         DoctorOffice.doc_id == user_id,
         Office.hospital_id == hospital_id
-    ).all()
-
-    # 2. 收集所有相关科室（直接负责的 + 子科室），并去重
-    final_offices_map = {} # 使用字典去重, key: office.id, value: office object
+    )]
 
-    def get_all_descendants(office):
-        # 递归函数，获取一个科室及其所有子孙科室
-        if office.id not in final_offices_map:
-            final_offices_map[office.id] = office
-            # office.children 来自于 models.py 中的 backref
-            for child in office.children:
-                get_all_descendants(child)
+    # 2. 收集所有相关科室（直接负责的 + 子科室）并去重，
+    #    子孙科室和父科室路径都从缓存的科室树中取，不再逐层查库
+    tree = office_trees.get(hospital_id)
+    final_office_ids = {}
+    for office_id in doctor_office_ids:
+        final_office_ids.update(dict.fromkeys(tree.descendants(office_id)))
 
-    for office in doctor_offices:
-        get_all_descendants(office)
-
-    # 3. 为每个科室构建完整的父科室路径
+    # 3. 为每个科室附上从顶层父科室开始的完整父科室路径
     result = []
-    # 预先获取医院所有科室，以高效构建父路径，避免循环查库
-    all_hospital_offices = {o.id: o for o in Office.query.filter_by(hospital_id=hospital_id).all()}
-
-    for office in final_offices_map.values():
-        office_data = office.to_dict()
-        parent_path = []
-        
-        current_parent_id = office.parent_id
-        while current_parent_id:
-            # 使用预先获取的字典来查找父科室
-            parent_office = all_hospital_offices.get(current_parent_id)
-            if parent_office:
-                parent_path.append(parent_office.to_dict())
-                current_parent_id = parent_office.parent_id
-            else:
-                break
-        
-        # 反转路径，使其从顶层父科室开始
-        parent_path.reverse()
-        office_data['parent_path'] = parent_path
+    for office_id in final_office_ids:
+        office_data = dict(tree.offices[office_id])
+        office_data['parent_path'] = tree.path(office_id)
         result.append(office_data)
     
     return make_response(jsonify({
@@ -125,26 +114,6 @@ def get_doctor_offices():
         'data': result
     }))
 
-def get_all_child_offices(parent_office_id):
-    """
-    递归获取一个科室下的所有子科室ID
-    """
-    # 使用集合以避免重复
-    all_office_ids = {int(parent_office_id)}
-    # 待检查的科室ID队列
-    offices_to_check = [int(parent_office_id)]
-    
-    while offices_to_check:
-        current_id = offices_to_check.pop(0)
-        # 查询以当前科室为父科室的所有子科室
-        children = Office.query.filter_by(parent_id=current_id).all()
-        for child in children:
-            if child.id not in all_office_ids:
-                all_office_ids.add(child.id)
-                offices_to_check.append(child.id)
-                
-    return list(all_office_ids)
-
 @hospital_bp.route('/api/hospital/case', methods=['GET'])
 @utils.jwtauth.jwt_required
 def get_cases_by_office():
@@ -155,8 +124,6 @@ def get_cases_by_office():
     office_id = request.args.get('office_id')
     patient_name = request.args.get('patient_name')
     my_case = request.args.get('my_case') # 'true' or 'false'
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 10, type=int)
 
     if not office_id:
         return jsonify({'code': 400, 'message': '缺少office_id参数'}), 400
@@ -171,26 +138,23 @@ def get_cases_by_office():
     if not office:
         return jsonify({'code': 404, 'message': '科室不存在'}), 404
 
-    # 获取该科室及其所有子科室的ID
-    all_office_ids = get_all_child_offices(office_id)
-
-    # 在这些科室中查询病历
-    cases_query = Case.query.filter(Case.office_id.in_(all_office_ids))
+    # 按物化路径连接科室表，查询该科室及其所有子科室的病历，
+    # 由数据库在 office.path 索引上做前缀范围扫描，不再展开成很长的 IN 列表
+    cases_query = Case.query.join(Office, Case.office_id == Office.id).filter(subtree_filter(office))
     
     # 如果提供了病人姓名，则加入查询条件
     if patient_name:
-        cases_query = cases_query.join(Patient).filter(Patient.name.contains(patient_name))
+        cases_query = cases_query.join(Patient).filter(patient_name_filter(patient_name))
     
     # 如果勾选了"只显示我创建的"
     if my_case == 'true':
         cases_query = cases_query.filter(Case.doctor_id == user_id)
 
     # 按病历日期降序排序
-    cases_pagination = cases_query.order_by(Case.case_date.desc(), Case.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
-    
-    cases = cases_pagination.items
+    try:
+        cases, pagination = paginate(cases_query, (Case.case_date, Case.created_at, Case.id))
+    except InvalidCursor as e:
+        return jsonify({'code': 400, 'message': str(e)}), 400
     
     # 优化：一次性获取所有相关影像及其预览图
     images_by_case_id = {}
@@ -203,35 +167,19 @@ def get_cases_by_office():
             Image.parent_image_id.is_(None)
         ).all()
 
-        main_image_ids = [img.id for img in main_images]
-        previews_by_parent_id = {}
-
-        if main_image_ids:
-            # 2. 为兼容旧版MySQL，采用两步查询法获取预览图
-            # 首先，获取所有主影像关联的子影像
-            all_child_images = db.session.query(Image).filter(
-                Image.parent_image_id.in_(main_image_ids)
-            ).order_by(Image.parent_image_id, Image.id.asc()).all()
-
-            # 然后，在Python中处理，为每个父ID找到第一个子影像
-            for child in all_child_images:
-                if child.parent_image_id not in previews_by_parent_id:
-                    previews_by_parent_id[child.parent_image_id] = child
+        # 2. 一次性解析所有主影像的预览图
+        previews = preview_urls(main_images)
+        thumbnails = thumbnail_urls(main_images, previews)
 
         # 3. 构建影像信息并按case_id分组
-        base_url = "https://cdn.ember.ac.cn"
         for img in main_images:
-            preview_url = f"{base_url}/{img.oss_key}" # 默认是源文件
-
-            if img.format in ['dicom', 'nii']:
-                preview_image = previews_by_parent_id.get(img.id)
-                if preview_image:
-                    preview_url = f"{base_url}/{preview_image.oss_key}"
+            preview_url = previews[img.id]
 
             image_info = {
                 'image_id': img.id,
                 'name': img.name,
                 'preview_url': preview_url, 
+                'thumbnail_url': thumbnails[img.id],
                 'dim': img.dim
             }
             if img.case_id not in images_by_case_id:
@@ -252,12 +200,7 @@ def get_cases_by_office():
         'code': 200,
         'message': '查询成功',
         'data': data,
-        'pagination': {
-            'page': cases_pagination.page,
-            'per_page': cases_pagination.per_page,
-            'total_pages': cases_pagination.pages,
-            'total_items': cases_pagination.total
-        }
+        'pagination': pagination
     })
 
 @hospital_bp.route('/api/hospital/add_patient', methods=['POST'])
@@ -430,32 +373,18 @@ def get_single_case():
         Image.parent_image_id.is_(None)
     ).all()
 
-    main_image_ids = [img.id for img in main_images]
-    previews_by_parent_id = {}
-
-    if main_image_ids:
-        all_child_images = db.session.query(Image).filter(
-            Image.parent_image_id.in_(main_image_ids)
-        ).order_by(Image.parent_image_id, Image.id.asc()).all()
-
-        for child in all_child_images:
-            if child.parent_image_id not in previews_by_parent_id:
-                previews_by_parent_id[child.parent_image_id] = child
+    previews = preview_urls(main_images)
+    thumbnails = thumbnail_urls(main_images, previews)
 
     image_list = []
-    base_url = "https://cdn.ember.ac.cn"
     for img in main_images:
-        preview_url = f"{base_url}/{img.oss_key}"
-
-        if img.format in ['dicom', 'nii']:
-            preview_image = previews_by_parent_id.get(img.id)
-            if preview_image:
-                preview_url = f"{base_url}/{preview_image.oss_key}"
+        preview_url = previews[img.id]
 
         image_info = {
             'image_id': img.id,
             'name': img.name,
             'preview_url': preview_url,
+            'thumbnail_url': thumbnails[img.id],
             'dim': img.dim,
             'format': img.format,
             'type': img.type,
@@ -482,15 +411,40 @@ def get_single_case():
 @utils.jwtauth.jwt_required
 def search_patient():
     """
-    根据姓名搜索病人
+    根据姓名搜索病人，通过 search.py 的 n-gram 索引检索，姓名完全相同的在前，其余按相关度排序。
+    支持 page / per_page 分页 (默认每页20条)。
     """
     name = request.args.get('name')
     if not name:
         return jsonify({'code': 400, 'message': '缺少必要参数: name'}), 400
-    
-    patients = Patient.query.filter(Patient.name.contains(name)).all()
+
+    page, per_page = page_args()
+    results, pagination = search_patients(name, page, per_page)
     return jsonify({
         'code': 200,
         'message': '搜索成功',
-        'data': [patient.to_dict() for patient in patients]
+        'data': [patient.to_dict() for patient, _ in results],
+        'pagination': pagination
+    })
+
+
+# 选择病人时的输入联想
+@hospital_bp.route('/api/hospital/patient/typeahead', methods=['GET'])
+@utils.jwtauth.jwt_required
+def typeahead_patient():
+    """
+    按姓名或拼音首字母前缀联想病人，最新建档的在前，查询只读内存中的前缀树。
+
+    请求参数:
+    - q: 输入的前缀，例如 张三 或 zs
+    - limit: 返回条数，默认且最多为 TYPEAHEAD_LIMIT
+    - seq: 可选的请求序号，原样返回。前端每次输入递增序号，只采用最新序号的响应，丢弃乱序到达的旧响应
+    """
+    q = request.args.get('q', '')
+    limit = request.args.get('limit', type=int)
+    return jsonify({
+        'code': 200,
+        'message': '查询成功',
+        'data': patient_typeahead.search(q, limit),
+        'seq': request.args.get('seq')
     })
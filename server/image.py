@@ -1,52 +1,33 @@
 import utils.jwtauth
-from flask import request, jsonify, Blueprint
-from models import db, Image, Patient, Office, Case, ImageBbox, ImageSeg
+from flask import request, jsonify, Blueprint, current_app, url_for, redirect, send_file
+from itsdangerous import URLSafeSerializer, BadSignature
+from models import db, Image, Patient, Office, Case, ImageBbox, ImageSeg, IngestJob, ImagePyramid, SliceManifest, SegJob
 from utils.oss import upload_to_oss, custom_endpoint
-import uuid
+from utils.content import derived_key
+from utils.series import scan_headers, group_series, assemble_series, extract_zip, ArchiveTooLarge
+from utils.imaging import convert_to_png, load_volume, upload_suffix
+from utils.slice_cache import slice_cache
+from utils.tiles import manifest
+from utils.pagination import paginate, InvalidCursor
+from utils.response_cache import response_cache
+from ingest import (ingest_queue, render_lazy_slice, materialize_slice, wants_tiles, build_tile_pyramid,
+                    sync_slice_annotated, find_content, remember_content,
+                    store_original, reuse_rendered_slices, store_thumbnail, expire_stale_job)
+from previews import preview_urls, thumbnail_urls
+from segment import seg_queue, pending_count, queue_position, expire_stale_jobs
+from PIL import Image as PilImage, UnidentifiedImageError
 import io
 import os
+import uuid
+import shutil
+import zipfile
 import pydicom
-from pydicom.pixel_data_handlers.util import apply_voi_lut
 import nibabel as nib
-import numpy as np
-from PIL import Image as PilImage
-import tempfile
-import requests
-import re
 
 image_bp = Blueprint('image', __name__)
 
-def convert_to_png(pixel_array, is_dicom, ds=None):
-    """
-    将DICOM或NII文件的像素数组转换为PNG图像字节流。
-    如果可用，会为DICOM应用VOI LUT。
-    """
-    # 归一化或应用LUT
-    if is_dicom and ds and 'VOILUTSequence' in ds:
-        # 应用VOI LUT
-        arr = apply_voi_lut(pixel_array, ds)
-    else:
-        # 其他情况进行简单的归一化
-        arr = pixel_array.astype(np.float32)
-        if np.max(arr) != np.min(arr):
-            arr = (arr - np.min(arr)) / (np.max(arr) - np.min(arr)) * 255.0
-        else:
-            arr = np.zeros_like(arr)
-    
-    arr = arr.astype(np.uint8)
-
-    # 转换为灰度PIL图像
-    if arr.ndim == 2:
-        pil_img = PilImage.fromarray(arr, 'L')
-    else: # 对于可能存在的多通道数据，只取第一通道
-        pil_img = PilImage.fromarray(arr[:,:,0], 'L')
-    
-    # 保存到内存缓冲区
-    img_buffer = io.BytesIO()
-    pil_img.save(img_buffer, format='PNG')
-    img_buffer.seek(0)
-    
-    return img_buffer
+# 影像列表随医生自己的影像变化 (包括后台处理完成后回写的状态和预览)
+response_cache.invalidate_on(Image, 'images', 'creator_id')
 
 @image_bp.route('/api/image/add', methods=['POST'])
 @utils.jwtauth.jwt_required
@@ -74,44 +55,38 @@ def add_image():
     office_id = request.form.get('office_id') if request.form.get('office_id') else None
     case_id = request.form.get('case_id') if request.form.get('case_id') else None
     note = request.form.get('note')
+    lazy = request.form.get('lazy', str(current_app.config['INGEST_LAZY_SLICES'])).lower() == 'true'
+    tiles = request.form.get('tiles', str(current_app.config['INGEST_TILE_PYRAMID'])).lower() == 'true'
 
     # 验证可选的外键是否存在
-    if patient_id and not Patient.query.get(patient_id):
-        return jsonify({'code': 404, 'message': '病人不存在'}), 404
-    if office_id and not Office.query.get(office_id):
-        return jsonify({'code': 404, 'message': '科室不存在'}), 404
-    if case_id and not Case.query.get(case_id):
-        return jsonify({'code': 404, 'message': '病历不存在'}), 404
+    error = _check_image_refs(patient_id, office_id, case_id)
+    if error:
+        return error
 
     # 2. --- 文件分析 ---
-    file_bytes = file.read()
-    file_size_kb = len(file_bytes) / 1024.0
+    # 上传内容在解析请求时直接写入工作目录，只落盘一次，格式识别、解析和上传OSS都直接使用这个文件；
+    # 落盘时同时计算内容哈希，相同内容已存储过时跳过上传和渲染
+    original_ext = upload_suffix(file.filename)
+    upload_path, content_hash = ingest_queue.spool(file.stream, original_ext)
+    file_size_kb = os.path.getsize(upload_path) / 1024.0
     file.close()
+    # 3D影像的后台任务会接管该文件，处理完成后由任务删除
+    handed_off = False
 
-    file_stream = io.BytesIO(file_bytes)
-    
     ds = None
     nib_img = None
     img_format = 'picture' 
-    tmp_path = None
 
     try:
-        file_stream.seek(0)
-        ds = pydicom.dcmread(file_stream, stop_before_pixels=False)
+        ds = pydicom.dcmread(upload_path, stop_before_pixels=True)
         img_format = 'dicom'
     except pydicom.errors.InvalidDicomError:
         pass
 
     if not ds:
         try:
-            # 使用临时文件来稳健地处理NII加载
-            # 后缀有助于nibabel猜测文件类型
-            suffix = os.path.splitext(file.filename)[1] if file.filename and file.filename.endswith(('.nii', '.nii.gz')) else '.tmp'
-            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-                tmp.write(file_bytes)
-                tmp_path = tmp.name
-            
-            nib_img = nib.load(tmp_path)
+            # nibabel 根据后缀猜测文件类型，并以内存映射方式打开
+            nib_img = nib.load(upload_path)
             img_format = 'nii'
         except (nib.filebasedimages.ImageFileError, ValueError):
             # 不是一个有效的NII文件。它将被作为 'picture' 处理。
@@ -121,88 +96,87 @@ def add_image():
     try:
         # 情况 A: 普通图片
         if img_format == 'picture':
-            oss_key = f"hidoc2/images/{uuid.uuid4()}{os.path.splitext(file.filename)[1]}"
-            file_stream.seek(0)
-            if not upload_to_oss(file_stream, oss_key):
-                raise Exception("OSS upload failed")
+            oss_key = store_original(upload_path, content_hash, original_ext)
 
             new_image = Image(
                 name=name, format='picture', type=img_type, dim='2D',
                 patient_id=patient_id, creator_id=creator_id,
                 office_id=office_id, case_id=case_id, note=note,
-                oss_key=oss_key, size=file_size_kb
+                oss_key=oss_key, size=file_size_kb, content_hash=content_hash,
+                preview_key=oss_key
             )
             db.session.add(new_image)
+            try:
+                pil_img = PilImage.open(upload_path)
+            except UnidentifiedImageError:
+                pil_img = None # 无法识别的图片不生成缩略图和瓦片
+            if pil_img is not None:
+                store_thumbnail(new_image, lambda: PilImage.open(upload_path))
+                if tiles and wants_tiles(*pil_img.size):
+                    build_tile_pyramid(new_image, pil_img)
             db.session.commit()
+            # 原图留在本地缓存中，随后的AI分割不必再从OSS下载；缓存失败不影响上传结果
+            try:
+                slice_cache.adopt_original(oss_key, upload_path)
+            except OSError as e:
+                print(f"Failed to cache original {oss_key}: {e}")
             return jsonify({'code': 201, 'message': '影像上传成功', 'data': new_image.to_dict()}), 201
 
         # 情况 B: DICOM 或 NII
         is_dicom = (img_format == 'dicom')
         
-        original_ext = ".dcm" if is_dicom else os.path.splitext(file.filename)[1]
-        original_oss_key = f"hidoc2/images/{uuid.uuid4()}{original_ext}"
-        file_stream.seek(0)
-        if not upload_to_oss(file_stream, original_oss_key):
-            raise Exception("Original file OSS upload failed")
-
-        pixel_array = ds.pixel_array if is_dicom else nib_img.get_fdata()
-        shape = pixel_array.shape
-        is_3d = (hasattr(ds, 'NumberOfFrames') and ds.NumberOfFrames > 1) if is_dicom else (pixel_array.ndim >= 3)
+        if is_dicom:
+            original_ext = ".dcm"
+        original_oss_key = store_original(upload_path, content_hash, original_ext)
+        image_fields = dict(
+            name=name, format=img_format, type=img_type,
+            patient_id=patient_id, creator_id=creator_id,
+            office_id=office_id, case_id=case_id, note=note,
+            oss_key=original_oss_key, size=file_size_kb, content_hash=content_hash
+        )
+
+        # 仅根据文件头判断维度，3D影像的像素数据留给后台任务解码
+        is_3d = (hasattr(ds, 'NumberOfFrames') and ds.NumberOfFrames > 1) if is_dicom else (len(nib_img.shape) >= 3)
         
-        # B.1 --- 处理3D影像 ---
+        # B.1 --- 处理3D影像：按需生成、复用已有切片或登记后台切片任务 ---
         if is_3d:
-            slice_x, slice_y, slice_z = (shape[2], shape[1], shape[0]) if is_dicom else (shape[0], shape[1], shape[2])
-            
-            volume_image = Image(
-                name=name, format=img_format, type=img_type, dim='3D',
-                patient_id=patient_id, creator_id=creator_id,
-                office_id=office_id, case_id=case_id, note=note,
-                oss_key=original_oss_key, size=file_size_kb,
-                slice_x=slice_x, slice_y=slice_y, slice_z=slice_z
-            )
-            db.session.add(volume_image)
-            db.session.flush()
-            parent_id = volume_image.id
-
-            axes = {'x': (slice_x, ' sagittal'), 'y': (slice_y, ' coronal'), 'z': (slice_z, ' axial')}
-            for axis_name, (slice_count, axis_label) in axes.items():
-                for i in range(slice_count):
-                    if axis_name == 'z':
-                        slice_arr = pixel_array[i, :, :] if is_dicom else pixel_array[:, :, i].T
-                    elif axis_name == 'y':
-                        slice_arr = pixel_array[:, i, :] if is_dicom else pixel_array[:, i, :].T
-                    else: # x
-                        slice_arr = pixel_array[:, :, i] if is_dicom else pixel_array[i, :, :].T
-                    
-                    png_buffer = convert_to_png(slice_arr, is_dicom, ds)
-                    png_oss_key = f"hidoc2/images/{uuid.uuid4()}.png"
-                    png_size_kb = len(png_buffer.getvalue()) / 1024.0
-                    upload_to_oss(png_buffer, png_oss_key)
-                    slice_img = Image(
-                        name=f"{name}_{axis_label.strip()}_{i}", format='picture', type=img_type, dim='2D',
-                        creator_id=creator_id, oss_key=png_oss_key, size=png_size_kb,
-                        parent_image_id=parent_id, slice_direction=axis_name, slice=i
-                    )
-                    db.session.add(slice_img)
+            dims = (ds.Columns, ds.Rows, int(ds.NumberOfFrames)) if is_dicom else nib_img.shape[:3]
+            volume_image, job = _create_volume(upload_path, dims, image_fields, lazy, tiles)
+            if job is None:
+                message = '影像上传成功' if lazy else '影像已存在，已复用生成过的切片'
+                return jsonify({'code': 201, 'message': message, 'data': volume_image.to_dict()}), 201
+
+            handed_off = True
+            return jsonify({
+                'code': 202,
+                'message': '影像已接收，正在后台生成切片',
+                'data': {'image': volume_image.to_dict(), 'job': job.to_dict()}
+            }), 202
+
         # B.2 --- 处理2D影像 ---
         else:
-            slice_y, slice_x = shape[:2]
+            slice_y, slice_x = (ds.Rows, ds.Columns) if is_dicom else nib_img.shape[:2]
             
-            main_image = Image(
-                name=name, format=img_format, type=img_type, dim='2D',
-                patient_id=patient_id, creator_id=creator_id,
-                office_id=office_id, case_id=case_id, note=note,
-                oss_key=original_oss_key, size=file_size_kb,
-                slice_x=slice_x, slice_y=slice_y
-            )
+            main_image = Image(dim='2D', slice_x=slice_x, slice_y=slice_y, **image_fields)
             db.session.add(main_image)
             db.session.flush()
             parent_id = main_image.id
 
-            png_buffer = convert_to_png(pixel_array, is_dicom, ds)
-            png_oss_key = f"hidoc2/images/{uuid.uuid4()}.png"
-            png_size_kb = len(png_buffer.getvalue()) / 1024.0
-            upload_to_oss(png_buffer, png_oss_key)
+            build_tiles = tiles and wants_tiles(slice_x, slice_y)
+            known_preview = find_content(content_hash, 'preview')
+            png_buffer = None
+            if known_preview:
+                # 相同内容的预览图已存在，不再解码和上传
+                png_oss_key, png_size_kb = known_preview.oss_key, float(known_preview.size)
+            if not known_preview or build_tiles:
+                pixel_array, ds = load_volume(upload_path, img_format)
+                png_buffer = convert_to_png(pixel_array, is_dicom, ds)
+            if not known_preview:
+                png_oss_key = derived_key(content_hash, 'preview.png')
+                png_size_kb = len(png_buffer.getvalue()) / 1024.0
+                if not upload_to_oss(png_buffer, png_oss_key):
+                    raise Exception("Preview OSS upload failed")
+                remember_content(content_hash, 'preview', png_oss_key, png_size_kb)
             
             vis_image = Image(
                 name=f"{name}_preview", format='picture', type=img_type, dim='2D',
@@ -210,6 +184,13 @@ def add_image():
                 parent_image_id=parent_id
             )
             db.session.add(vis_image)
+            db.session.flush()
+            main_image.preview_image_id, main_image.preview_key = vis_image.id, png_oss_key
+            # 复用已有预览图时缩略图通常也已存在，没有预览图像素时只尝试复用
+            store_thumbnail(main_image, lambda: PilImage.open(io.BytesIO(png_buffer.getvalue())) if png_buffer else None)
+            if build_tiles:
+                # 瓦片由预览图生成，登记在主影像上
+                build_tile_pyramid(main_image, PilImage.open(io.BytesIO(png_buffer.getvalue())))
 
         db.session.commit()
         return jsonify({'code': 201, 'message': '影像处理成功'}), 201
@@ -220,10 +201,216 @@ def add_image():
         traceback.print_exc()
         return jsonify({'code': 500, 'message': f'处理影像时发生内部错误: {str(e)}'}), 500
     finally:
-        file_stream.close()
-        # 确保在使用完毕后删除临时文件
-        if tmp_path and os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        # 确保在使用完毕后删除暂存文件
+        if not handed_off and os.path.exists(upload_path):
+            os.remove(upload_path)
+
+
+def _check_image_refs(patient_id, office_id, case_id):
+    """验证影像关联的病人、科室、病历是否存在，不存在时返回错误响应"""
+    if patient_id and not Patient.query.get(patient_id):
+        return jsonify({'code': 404, 'message': '病人不存在'}), 404
+    if office_id and not Office.query.get(office_id):
+        return jsonify({'code': 404, 'message': '科室不存在'}), 404
+    if case_id and not Case.query.get(case_id):
+        return jsonify({'code': 404, 'message': '病历不存在'}), 404
+    return None
+
+
+def _create_volume(upload_path, dims, image_fields, lazy, tiles):
+    """
+    登记一个原始文件已上传OSS的3D影像，并安排切片的生成:
+    - 按需生成模式: 原始文件移入切片缓存，首次访问切片时渲染
+    - 相同研究已渲染过: 直接复用已有切片，只花一次哈希的代价
+    - 其他情况: 登记后台任务，由工作池异步生成切片，任务接管 upload_path
+    :param dims: (x, y, z) 三个方向的切片数
+    :return: (影像记录, 处理任务)，无需后台任务时处理任务为 None
+    """
+    slice_x, slice_y, slice_z = dims
+    if lazy:
+        volume_image = Image(dim='3D', slice_x=slice_x, slice_y=slice_y, slice_z=slice_z,
+                             lazy_slices=True, **image_fields)
+        db.session.add(volume_image)
+        db.session.commit()
+        # 原始文件已存入OSS，移入缓存失败时首次访问切片再从OSS下载
+        try:
+            slice_cache.adopt_original(volume_image.oss_key, upload_path)
+        except OSError as e:
+            print(f"Failed to cache original {volume_image.oss_key}: {e}")
+        return volume_image, None
+
+    volume_image = Image(dim='3D', slice_x=slice_x, slice_y=slice_y, slice_z=slice_z,
+                         status='processing', **image_fields)
+    db.session.add(volume_image)
+    db.session.flush()
+
+    if current_app.config['INGEST_SLICE_MANIFEST'] and \
+            reuse_rendered_slices(volume_image, current_app.config['INGEST_WINDOWING'], tiles):
+        volume_image.status = 'ready'
+        db.session.commit()
+        return volume_image, None
+
+    job = IngestJob(
+        image_id=volume_image.id, creator_id=volume_image.creator_id,
+        total=slice_x + slice_y + slice_z,
+        work_path=upload_path, build_tiles=tiles
+    )
+    db.session.add(job)
+    db.session.commit()
+    ingest_queue.submit(job.id)
+    return volume_image, job
+
+
+@image_bp.route('/api/image/series', methods=['POST'])
+@utils.jwtauth.jwt_required
+def add_image_series():
+    """
+    上传DICOM序列 (多个单帧DICOM文件，或包含这些文件的zip压缩包)。
+    并行读取文件头后按 SeriesInstanceUID 分组、按层面位置排序，每个序列组装为一个3D影像，
+    之后与 add_image 中的3D影像走相同的切片流程。
+    """
+    creator_id = request.user_id
+
+    files = [f for f in request.files.getlist('file') if f.filename]
+    if not files:
+        return jsonify({'code': 400, 'message': '缺少必要参数: file'}), 400
+
+    name = request.form.get('name')
+    img_type = request.form.get('type')
+    if not all([name, img_type]):
+        return jsonify({'code': 400, 'message': '缺少必要参数: name, type'}), 400
+
+    patient_id = request.form.get('patient_id') if request.form.get('patient_id') else None
+    office_id = request.form.get('office_id') if request.form.get('office_id') else None
+    case_id = request.form.get('case_id') if request.form.get('case_id') else None
+    note = request.form.get('note')
+    lazy = request.form.get('lazy', str(current_app.config['INGEST_LAZY_SLICES'])).lower() == 'true'
+    tiles = request.form.get('tiles', str(current_app.config['INGEST_TILE_PYRAMID'])).lower() == 'true'
+
+    error = _check_image_refs(patient_id, office_id, case_id)
+    if error:
+        return error
+
+    series_dir = os.path.join(ingest_queue.work_dir, f"series_{uuid.uuid4()}")
+    os.makedirs(series_dir)
+    paths = []
+    max_files, max_bytes = current_app.config['INGEST_SERIES_MAX_FILES'], current_app.config['INGEST_SERIES_MAX_BYTES']
+    try:
+        # 1. --- 所有文件落盘，zip 压缩包解压到同一目录，解压的文件数和大小计入整个请求的限额 ---
+        extracted_bytes = 0
+        for file in files:
+            path, _ = ingest_queue.spool(file.stream, upload_suffix(file.filename))
+            file.close()
+            if zipfile.is_zipfile(path):
+                try:
+                    extracted = extract_zip(path, series_dir, max_files - len(paths), max_bytes - extracted_bytes)
+                finally:
+                    os.remove(path)
+                paths.extend(extracted)
+                extracted_bytes += sum(os.path.getsize(p) for p in extracted)
+            else:
+                paths.append(path)
+
+        # 2. --- 并行读取文件头 (不读像素)，分组并排序 ---
+        headers = scan_headers(paths, current_app.config['INGEST_SERIES_WORKERS'])
+        series, rejected = group_series(headers)
+        skipped = [{'series_uid': h['series_uid'], 'reason': '尺寸与序列不一致或为多帧文件'} for h in rejected]
+        ignored_files = sum(1 for h in headers if h is None)
+
+        # 3. --- 每个序列组装为一个多帧DICOM，作为3D影像登记 ---
+        # 每个序列单独提交，某个序列失败时不影响已登记的序列，失败的序列在响应的 failed 中列出
+        created, failed = [], []
+        for index, (series_uid, members) in enumerate(series.items(), start=1):
+            if len(members) < 2:
+                skipped.append({'series_uid': series_uid, 'reason': '序列只有一张切片'})
+                continue
+
+            volume_path = os.path.join(ingest_queue.work_dir, f"{uuid.uuid4()}.dcm")
+            job = None
+            try:
+                frames, content_hash = assemble_series(members, volume_path)
+                rows, columns = members[0]['shape']
+                series_name = name if len(series) == 1 else f"{name}_{members[0]['series_description'] or index}"
+                image_fields = dict(
+                    name=series_name, format='dicom', type=img_type,
+                    patient_id=patient_id, creator_id=creator_id,
+                    office_id=office_id, case_id=case_id, note=note,
+                    oss_key=store_original(volume_path, content_hash, '.dcm'),
+                    size=os.path.getsize(volume_path) / 1024.0, content_hash=content_hash
+                )
+                volume_image, job = _create_volume(volume_path, (columns, rows, frames), image_fields, lazy, tiles)
+            except Exception as e:
+                db.session.rollback()
+                import traceback
+                traceback.print_exc()
+                failed.append({'series_uid': series_uid, 'files': len(members), 'reason': str(e)})
+                continue
+            finally:
+                # 后台任务接管组装好的文件，其余情况下在这里删除
+                if job is None and os.path.exists(volume_path):
+                    os.remove(volume_path)
+            created.append({
+                'series_uid': series_uid,
+                'files': len(members),
+                'image': volume_image.to_dict(),
+                'job': job.to_dict() if job else None
+            })
+    except zipfile.BadZipFile:
+        db.session.rollback()
+        return jsonify({'code': 400, 'message': '无效的zip压缩包'}), 400
+    except ArchiveTooLarge as e:
+        return jsonify({'code': 400, 'message': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        import traceback
+        traceback.print_exc()
+        return jsonify({'code': 500, 'message': f'处理DICOM序列时发生内部错误: {str(e)}'}), 500
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(series_dir, ignore_errors=True)
+
+    if not created and failed:
+        return jsonify({
+            'code': 500,
+            'message': '处理DICOM序列时发生内部错误',
+            'data': {'failed': failed, 'skipped': skipped, 'ignored_files': ignored_files}
+        }), 500
+
+    if not created:
+        return jsonify({
+            'code': 400,
+            'message': '未找到可以组装为3D影像的DICOM序列',
+            'data': {'skipped': skipped, 'ignored_files': ignored_files}
+        }), 400
+
+    code = 202 if any(item['job'] for item in created) else 201
+    message = f'已组装 {len(created)} 个DICOM序列'
+    if failed:
+        message += f'，{len(failed)} 个序列处理失败'
+    return jsonify({
+        'code': code,
+        'message': message,
+        'data': {'series': created, 'failed': failed, 'skipped': skipped, 'ignored_files': ignored_files}
+    }), code
+
+
+@image_bp.route('/api/image/job/<int:job_id>', methods=['GET'])
+@utils.jwtauth.jwt_required
+def get_ingest_job(job_id):
+    """
+    查询3D影像后台处理任务的状态和进度。
+    """
+    job = IngestJob.query.get(job_id)
+    if not job:
+        return jsonify({'code': 404, 'message': '处理任务不存在'}), 404
+
+    if job.creator_id != request.user_id:
+        return jsonify({'code': 403, 'message': '您无权查看此任务'}), 403
+
+    expire_stale_job(job)
+    return jsonify({'code': 200, 'message': '查询成功', 'data': job.to_dict()})
 
 
 @image_bp.route('/api/image/<int:image_id>', methods=['GET'])
@@ -248,29 +435,19 @@ def get_image_preview(image_id):
             return jsonify({'code': 400, 'message': '无效的direction参数，应为 "x"、"y" 或 "z"'}), 400
 
         source_url = f"{base_url}/{image.oss_key}"
-        
-        slices = Image.query.filter_by(
-            parent_image_id=image.id,
-            slice_direction=direction
-        ).order_by(Image.slice.asc()).all()
-        
-        slice_previews = [
-            {'slice': s.slice, 'url': f"{base_url}/{s.oss_key}", 'id': s.id} for s in slices
-        ]
-        
-        # 查询哪些切片包含标注信息 (Bbox)
-        annotated_slices = []
-        if slices:
-            slice_ids = [s.id for s in slices]
-            # 查询所有相关的bbox记录，然后获取有bbox的image_id
-            annotated_slice_ids_query = db.session.query(ImageBbox.image_id).filter(
-                ImageBbox.image_id.in_(slice_ids)
-            ).distinct()
-            
-            annotated_slice_ids = {row.image_id for row in annotated_slice_ids_query}
 
-            # 过滤出包含标注的切片索引
-            annotated_slices = [s.slice for s in slices if s.id in annotated_slice_ids]
+        manifest = SliceManifest.query.filter_by(image_id=image.id, direction=direction).first()
+        if manifest:
+            # 切片清单: 一次读出整个方向的切片键和标注位图，只有标注过的切片才有切片记录
+            slice_ids = dict(db.session.query(Image.slice, Image.id).filter_by(
+                parent_image_id=image.id, slice_direction=direction))
+            slice_previews = [
+                {'slice': i, 'url': f"{base_url}/{key}", 'id': slice_ids.get(i)}
+                for i, key in enumerate(manifest.keys())
+            ]
+            annotated_slices = manifest.annotated_indices()
+        else:
+            slice_previews, annotated_slices = _slice_rows_preview(image, direction, base_url)
 
         response_data.update({
             'dim': '3D',
@@ -287,14 +464,13 @@ def get_image_preview(image_id):
 
         # 如果是专业的2D影像格式，则查找其单独生成的预览图
         if image.format in ['dicom', 'nii']:
-            preview_image = Image.query.filter_by(parent_image_id=image.id).first()
-            if preview_image:
-                preview_url = f"{base_url}/{preview_image.oss_key}"
+            preview_url = preview_urls([image])[image.id]
         
         response_data.update({
             'dim': '2D',
             'source_url': source_url,
             'preview_url': preview_url,
+            'tiled': ImagePyramid.query.filter_by(image_id=image.id).count() > 0,
         })
     
     else:
@@ -303,6 +479,152 @@ def get_image_preview(image_id):
     return jsonify({'code': 200, 'message': '获取成功', 'data': response_data})
 
 
+def _slice_rows_preview(image, direction, base_url):
+    """按切片记录返回某方向的切片预览和有标注的切片索引 (按需生成或旧版逐张记录的3D影像)"""
+    slices = Image.query.filter_by(
+        parent_image_id=image.id,
+        slice_direction=direction
+    ).order_by(Image.slice.asc()).all()
+    
+    if image.lazy_slices:
+        # 按需生成模式：已生成的切片直接指向CDN，其余指向渲染接口，首次访问时生成
+        rendered = {s.slice: s for s in slices}
+        token = _slice_token(image.id)
+        slice_count = {'x': image.slice_x, 'y': image.slice_y, 'z': image.slice_z}[direction]
+        slice_previews = []
+        for i in range(slice_count):
+            s = rendered.get(i)
+            if s:
+                slice_previews.append({'slice': i, 'url': f"{base_url}/{s.oss_key}", 'id': s.id})
+            else:
+                url = url_for('image.render_slice', image_id=image.id, direction=direction, index=i,
+                              token=token, _external=True)
+                slice_previews.append({'slice': i, 'url': url, 'id': None})
+    else:
+        slice_previews = [
+            {'slice': s.slice, 'url': f"{base_url}/{s.oss_key}", 'id': s.id} for s in slices
+        ]
+    
+    # 查询哪些切片包含标注信息 (Bbox)
+    annotated_slices = []
+    if slices:
+        slice_ids = [s.id for s in slices]
+        # 查询所有相关的bbox记录，然后获取有bbox的image_id
+        annotated_slice_ids_query = db.session.query(ImageBbox.image_id).filter(
+            ImageBbox.image_id.in_(slice_ids)
+        ).distinct()
+        
+        annotated_slice_ids = {row.image_id for row in annotated_slice_ids_query}
+
+        # 过滤出包含标注的切片索引
+        annotated_slices = [s.slice for s in slices if s.id in annotated_slice_ids]
+
+    return slice_previews, annotated_slices
+
+
+@image_bp.route('/api/image/<int:image_id>/tiles', methods=['GET'])
+@utils.jwtauth.jwt_required
+def get_image_tiles(image_id):
+    """
+    获取2D影像或切片的瓦片金字塔清单。
+    客户端根据各层尺寸和瓦片行列数，只请求当前缩放级别下可见区域的瓦片。
+    """
+    image = Image.query.get(image_id)
+    if not image:
+        return jsonify({'code': 404, 'message': '影像不存在'}), 404
+
+    pyramid = ImagePyramid.query.filter_by(image_id=image_id).first()
+    if not pyramid:
+        return jsonify({'code': 404, 'message': '该影像没有瓦片金字塔'}), 404
+
+    data = manifest(pyramid.width, pyramid.height, pyramid.tile_size, pyramid.overlap, pyramid.format)
+    data.update({
+        'image_id': image_id,
+        'tile_count': pyramid.tile_count,
+        'dzi_url': f"{custom_endpoint}/{pyramid.oss_prefix}.dzi",
+        'tile_url_template': f"{custom_endpoint}/{pyramid.oss_prefix}_files/{{level}}/{{col}}_{{row}}.{pyramid.format}"
+    })
+    return jsonify({'code': 200, 'message': '获取成功', 'data': data})
+
+
+def _slice_token(image_id):
+    """切片渲染地址中携带的签名，使浏览器 <img> 无需认证头也能加载，同时无法遍历其他影像"""
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='image-slice').dumps(image_id)
+
+
+def _get_lazy_volume(image_id, direction, index, allow_manifest=False):
+    """
+    校验按需生成切片的请求参数，返回 (影像, 错误响应)。
+    allow_manifest 为 True 时也接受以切片清单记录切片的3D影像。
+    """
+    image = Image.query.get(image_id)
+    if not image:
+        return None, (jsonify({'code': 404, 'message': '影像不存在'}), 404)
+    has_manifest = allow_manifest and image.dim == '3D' and image.slice_manifests.count() > 0
+    if image.dim != '3D' or not (image.lazy_slices or has_manifest):
+        return None, (jsonify({'code': 400, 'message': '该影像的切片不是按需生成的'}), 400)
+    if direction not in ['x', 'y', 'z']:
+        return None, (jsonify({'code': 400, 'message': '无效的direction参数，应为 "x"、"y" 或 "z"'}), 400)
+    slice_count = {'x': image.slice_x, 'y': image.slice_y, 'z': image.slice_z}[direction]
+    if not 0 <= index < slice_count:
+        return None, (jsonify({'code': 404, 'message': '切片不存在'}), 404)
+    return image, None
+
+
+@image_bp.route('/api/image/<int:image_id>/slice/<direction>/<int:index>', methods=['GET'])
+def render_slice(image_id, direction, index):
+    """
+    按需生成3D影像的单张切片。
+    已生成过的切片重定向到CDN；否则从缓存或原始文件渲染后直接返回PNG，并上传OSS供以后访问。
+    通过URL中的签名鉴权，而不是JWT。
+    """
+    try:
+        token_image_id = URLSafeSerializer(current_app.config['SECRET_KEY'], salt='image-slice').loads(
+            request.args.get('token', ''))
+    except BadSignature:
+        token_image_id = None
+    if token_image_id != image_id:
+        return jsonify({'code': 403, 'message': '切片地址无效'}), 403
+
+    image, error = _get_lazy_volume(image_id, direction, index)
+    if error:
+        return error
+
+    existing = Image.query.filter_by(parent_image_id=image.id, slice_direction=direction, slice=index).first()
+    if existing:
+        return redirect(f"{custom_endpoint}/{existing.oss_key}")
+
+    try:
+        png = render_lazy_slice(image, direction, index)
+        materialize_slice(image, direction, index, png)
+    except Exception as e:
+        db.session.rollback()
+        import traceback
+        traceback.print_exc()
+        return jsonify({'code': 500, 'message': f'生成切片时发生内部错误: {str(e)}'}), 500
+
+    return send_file(io.BytesIO(png), mimetype='image/png', max_age=86400)
+
+
+@image_bp.route('/api/image/<int:image_id>/slice/<direction>/<int:index>', methods=['POST'])
+@utils.jwtauth.jwt_required
+def ensure_slice(image_id, direction, index):
+    """
+    确保按需生成或切片清单中的切片有切片记录，返回切片信息 (用于在没有切片记录的切片上标注)。
+    """
+    image, error = _get_lazy_volume(image_id, direction, index, allow_manifest=True)
+    if error:
+        return error
+
+    try:
+        slice_img = materialize_slice(image, direction, index)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'code': 500, 'message': f'生成切片时发生内部错误: {str(e)}'}), 500
+
+    return jsonify({'code': 200, 'message': '切片已生成', 'data': slice_img.to_dict()})
+
+
 @image_bp.route('/api/image/<int:image_id>', methods=['PUT'])
 @utils.jwtauth.jwt_required
 def update_image(image_id):
@@ -368,60 +690,41 @@ def delete_image(image_id):
 
 @image_bp.route('/api/image/list', methods=['GET'])
 @utils.jwtauth.jwt_required
+@response_cache.cached('images', ttl=30)
 def list_images():
     """
     获取当前医生创建的所有影像列表 (仅父影像)，支持分页。
     """
     creator_id = request.user_id
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 10, type=int)
     
     try:
         # 只查询 parent_image_id 为 NULL 的顶层影像，并进行分页
-        pagination = Image.query.filter_by(creator_id=creator_id, parent_image_id=None) \
-            .order_by(Image.created_at.desc()) \
-            .paginate(page=page, per_page=per_page, error_out=False)
-        
-        images = pagination.items
+        images, pagination = paginate(
+            Image.query.filter_by(creator_id=creator_id, parent_image_id=None), (Image.created_at, Image.id))
         results = []
         base_url = custom_endpoint
+        # 整页影像的预览图一次性解析，不再逐个查询子影像
+        previews = preview_urls(images)
+        thumbnails = thumbnail_urls(images, previews)
 
         for image in images:
             image_data = image.to_dict()
             source_url = f"{base_url}/{image.oss_key}"
-            preview_url = source_url  # 默认预览URL为源URL
-
-            # 1. 对于2D picture类型，使用源URL作为预览 (默认行为)
-            
-            # 2. 对于2D dicom/nii, 查找其子预览影像
-            if image.dim == '2D' and image.format in ['dicom', 'nii']:
-                preview_image = Image.query.filter_by(parent_image_id=image.id).first()
-                if preview_image:
-                    preview_url = f"{base_url}/{preview_image.oss_key}"
-            
-            # 3. 对于3D dicom/nii, 查找第一个切片作为预览
-            elif image.dim == '3D':
-                first_slice = Image.query.filter_by(parent_image_id=image.id).order_by(Image.id.asc()).first()
-                if first_slice:
-                    preview_url = f"{base_url}/{first_slice.oss_key}"
+            preview_url = previews[image.id]
 
             image_data['source_url'] = source_url
             image_data['preview_url'] = preview_url
+            image_data['thumbnail_url'] = thumbnails[image.id]
             results.append(image_data)
             
         return jsonify({
             'code': 200,
             'message': '查询成功',
             'data': results,
-            'pagination': {
-                'page': pagination.page,
-                'per_page': pagination.per_page,
-                'total_pages': pagination.pages,
-                'total_items': pagination.total,
-                'has_next': pagination.has_next,
-                'has_prev': pagination.has_prev
-            }
+            'pagination': pagination
         })
+    except InvalidCursor as e:
+        return jsonify({'code': 400, 'message': str(e)}), 400
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -469,6 +772,7 @@ def add_annotation():
                 note=data.get('note')
             )
             db.session.add(new_bbox)
+            sync_slice_annotated(image)
             db.session.commit()
             return jsonify({'code': 201, 'message': '标注创建成功', 'data': new_bbox.to_dict()}), 201
         except (ValueError, TypeError):
@@ -533,7 +837,9 @@ def delete_annotation():
             return jsonify({'code': 403, 'message': '您无权删除此标注'}), 403
             
         try:
+            slice_img = bbox.image
             db.session.delete(bbox)
+            sync_slice_annotated(slice_img)
             db.session.commit()
             return jsonify({'code': 200, 'message': '标注删除成功'})
         except Exception as e:
@@ -589,7 +895,8 @@ def update_annotation():
 @utils.jwtauth.jwt_required
 def seg_image():
     """
-    接收影像ID和查询词，调用AI服务进行分割，并存储结果。
+    接收影像ID和查询词，登记AI分割任务后立即返回，由 segment.py 的队列调用AI服务并在完成后存储结果。
+    返回 202 和任务信息，之后通过 /api/image/seg/job/<job_id> 轮询任务状态，成功时带回分割结果。
     """
     creator_id = request.user_id
     data = request.get_json()
@@ -609,54 +916,47 @@ def seg_image():
     if image.format != 'picture' or image.dim != '2D':
         return jsonify({'code': 400, 'message': 'AI分割仅支持2D picture格式的影像'}), 400
 
-    try:
-        # 1. 从OSS获取影像文件
-        image_url = f"{custom_endpoint}/{image.oss_key}"
-        image_response = requests.get(image_url, timeout=10)
-        image_response.raise_for_status()
-        image_bytes = image_response.content
-        
-        # 从oss_key中提取文件名
-        filename = image.oss_key.split('/')[-1]
+    if pending_count(creator_id) >= current_app.config['SEG_MAX_PENDING']:
+        return jsonify({'code': 429, 'message': '您提交的分割任务过多，请等待已提交的任务完成'}), 429
 
-        # 2. 调用外部AI预测服务
-        predict_url = 'http://localhost:6006/predict'
-        files = {'image': (filename, image_bytes, 'application/octet-stream')}
-        payload = {'query': query}
-        
-        try:
-            predict_response = requests.post(predict_url, files=files, data=payload, timeout=60)
-            predict_response.raise_for_status()
-            predict_data = predict_response.json()
-        except requests.exceptions.RequestException as e:
-            return jsonify({'code': 503, 'message': f'调用AI服务失败: {e}'}), 503
-
-        # 3. 将结果存入数据库
-        raw_reasoning = predict_data.get('result', '')
-        normalized_reasoning = raw_reasoning
-        if raw_reasoning:
-            # 规范化AI模型输出的文本，去除序号和括号间的空格，以匹配前端解析规则
-            normalized_reasoning = re.sub(r'(\d+)\.\s+【', r'\1.【', raw_reasoning)
-            
-        new_seg = ImageSeg(
-            image_id=image_id,
-            creator_id=creator_id,
-            query=query,
-            reasoning=normalized_reasoning,
-            oss_key=predict_data.get('oss_key')
-        )
-        db.session.add(new_seg)
+    try:
+        job = SegJob(image_id=image.id, creator_id=creator_id, query=query)
+        db.session.add(job)
         db.session.commit()
-
-        return jsonify({'code': 201, 'message': '影像分割成功', 'data': new_seg.to_dict()}), 201
-
-    except requests.exceptions.HTTPError as e:
-        return jsonify({'code': 500, 'message': f'从OSS获取影像失败: {e}'}), 500
     except Exception as e:
         db.session.rollback()
-        import traceback
-        traceback.print_exc()
-        return jsonify({'code': 500, 'message': f'处理请求时发生内部错误: {str(e)}'}), 500
+        return jsonify({'code': 500, 'message': f'数据库错误: {str(e)}'}), 500
+
+    seg_queue.submit(job.id)
+    return jsonify({'code': 202, 'message': '分割任务已提交', 'data': _seg_job_data(job)}), 202
+
+
+def _seg_job_data(job):
+    data = job.to_dict()
+    data['position'] = queue_position(job)
+    data['seg'] = job.seg.to_dict() if job.seg else None
+    return data
+
+
+@image_bp.route('/api/image/seg/job/<int:job_id>', methods=['GET'])
+@utils.jwtauth.jwt_required
+def get_seg_job(job_id):
+    """
+    查询AI分割任务的状态: queued 排队中 (position 为前面排队的任务数)、running 执行中、
+    succeeded 已完成 (seg 为分割结果)、failed 失败 (error 为原因)。
+    """
+    job = db.session.get(SegJob, job_id)
+    if not job:
+        return jsonify({'code': 404, 'message': '分割任务不存在'}), 404
+
+    if job.creator_id != request.user_id:
+        return jsonify({'code': 403, 'message': '您无权查看此任务'}), 403
+
+    if job.status in ('queued', 'running'):
+        # 执行任务的进程已退出时任务不会再完成，标记为失败以免前端一直轮询
+        expire_stale_jobs(job.id)
+
+    return jsonify({'code': 200, 'message': '查询成功', 'data': _seg_job_data(job)})
 
 
 @image_bp.route('/api/image/seg/list', methods=['GET'])
@@ -669,9 +969,6 @@ def list_image_segs():
     if not image_id:
         return jsonify({'code': 400, 'message': '缺少必要参数: image_id'}), 400
 
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 10, type=int)
-
     image = Image.query.get(image_id)
     if not image:
         return jsonify({'code': 404, 'message': '影像不存在'}), 404
@@ -680,27 +977,19 @@ def list_image_segs():
         return jsonify({'code': 400, 'message': '此接口仅支持查询2D picture格式影像的分割记录'}), 400
     
     try:
-        pagination = db.session.query(ImageSeg).filter_by(image_id=image_id) \
-            .order_by(ImageSeg.created_at.desc()) \
-            .paginate(page=page, per_page=per_page, error_out=False)
-        
-        segs = pagination.items
+        segs, pagination = paginate(
+            db.session.query(ImageSeg).filter_by(image_id=image_id), (ImageSeg.created_at, ImageSeg.id))
         data = [seg.to_dict() for seg in segs]
 
         return jsonify({
             'code': 200,
             'message': '查询成功',
             'data': data,
-            'pagination': {
-                'page': pagination.page,
-                'per_page': pagination.per_page,
-                'total_pages': pagination.pages,
-                'total_items': pagination.total,
-                'has_next': pagination.has_next,
-                'has_prev': pagination.has_prev
-            }
+            'pagination': pagination
         })
 
+    except InvalidCursor as e:
+        return jsonify({'code': 400, 'message': str(e)}), 400
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -0,0 +1,628 @@
+import io
+import os
+import uuid
+import hashlib
+import tempfile
+import traceback
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from flask import Request, request
+from PIL import Image as PilImage
+from models import db, Image, IngestJob, ImagePyramid, SliceManifest, ImageBbox, ContentObject
+from utils.oss import uploader, download_from_oss, upload_file_to_oss
+from utils.content import content_key, derived_key, derived_slice_template
+from utils.imaging import (AXIS_LABELS, upload_suffix, load_volume, window_volume, extract_slice, apply_window,
+                           encode_png, convert_to_png)
+from utils.render import render_volume_slices
+from utils.tiles import TILE_OVERLAP, iter_tiles, tile_key, dzi_xml
+from utils.thumbnails import thumbnail_name, encode_thumbnail
+from utils.slice_cache import slice_cache
+from previews import update_preview
+
+# 每批并发上传的切片数，每上传完一批向数据库提交一次进度
+UPLOAD_BATCH = 64
+# 批量写入切片记录时每条 executemany 语句的行数
+INSERT_BATCH = 1000
+# 上传文件落盘时每次读写的字节数
+SPOOL_CHUNK = 1024 * 1024
+
+
+class SpooledUpload:
+    """
+    multipart 上传时 Werkzeug 写入文件内容的目标: 直接写入工作目录中的文件，写入的同时计算内容哈希。
+    其余文件操作 (读取、定位等) 转给底层文件。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.taken = False
+        self._digest = hashlib.sha256()
+        self._file = open(path, 'w+b')
+
+    def write(self, data):
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def take(self, suffix):
+        """由调用方接管文件 (请求结束时不再删除)，返回 (本地路径, SHA-256十六进制字符串)"""
+        self._file.close()
+        if not self.path.endswith(suffix):
+            # 同一目录内改名，不复制内容
+            path = f"{os.path.splitext(self.path)[0]}{suffix}"
+            os.replace(self.path, path)
+            self.path = path
+        self.taken = True
+        return self.path, self._digest.hexdigest()
+
+
+class UploadRequest(Request):
+    """multipart 上传的文件不经 Werkzeug 的临时文件，直接写入 INGEST_WORK_DIR，上传内容只落盘一次"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = SpooledUpload(os.path.join(ingest_queue.work_dir, f"{uuid.uuid4()}{upload_suffix(filename)}"))
+        self.__dict__.setdefault('spooled_uploads', []).append(upload)
+        return upload
+
+
+def _remove_unclaimed_uploads(exc):
+    for upload in request.__dict__.get('spooled_uploads', ()):
+        if upload.taken:
+            continue
+        upload.close()
+        if os.path.exists(upload.path):
+            os.remove(upload.path)
+
+
+class IngestQueue:
+    """
+    3D影像后台处理队列。
+    上传接口只保存原始文件并登记任务，切片的生成、上传和入库由这里的工作池完成。
+
+    通过 app.config['INGEST_BACKEND'] 选择执行方式：
+    - 'local': 进程内线程池 (默认)，并发数由 INGEST_WORKERS 控制
+    - 'inline': 在当前请求中同步执行，用于测试和调试
+    - 'rq': 投递到 Redis Queue 持久化队列，由独立的 rq worker 进程执行
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('INGEST_BACKEND', 'local')
+        app.config.setdefault('INGEST_WORKERS', 2)
+        # 渲染切片和上传DICOM序列时读取文件头使用的共享进程池大小，由所有任务共用；
+        # None 表示CPU核数 (也是上限)，1 表示在当前线程串行执行
+        app.config.setdefault('INGEST_RENDER_WORKERS', None)
+        app.config.setdefault('INGEST_SERIES_WORKERS', None)
+        # 一次上传DICOM序列时 zip 压缩包解压出的文件数和总字节数上限
+        app.config.setdefault('INGEST_SERIES_MAX_FILES', 5000)
+        app.config.setdefault('INGEST_SERIES_MAX_BYTES', 2 * 1024 * 1024 * 1024)
+        # 切片窗宽窗位模式，见 utils.imaging.WINDOW_MODES；'slice' 为逐切片归一化
+        app.config.setdefault('INGEST_WINDOWING', 'volume')
+        # 3D影像默认是否按需生成切片，上传时可用表单字段 lazy 覆盖
+        app.config.setdefault('INGEST_LAZY_SLICES', False)
+        # 3D影像的切片以每个方向一条切片清单记录，只有被标注的切片才创建影像记录；
+        # 为 False 时沿用每张切片一条影像记录
+        app.config.setdefault('INGEST_SLICE_MANIFEST', True)
+        # 是否为大尺寸2D影像和切片生成瓦片金字塔，上传时可用表单字段 tiles 覆盖；
+        # 仅长边不小于 INGEST_TILE_MIN_SIZE 的图像才会生成
+        app.config.setdefault('INGEST_TILE_PYRAMID', False)
+        app.config.setdefault('INGEST_TILE_MIN_SIZE', 2048)
+        app.config.setdefault('INGEST_TILE_SIZE', 256)
+        app.config.setdefault('INGEST_TILE_FORMAT', 'png')
+        # 列表使用的缩略图: 长边像素数与格式 ('webp' 或 'jpeg')
+        app.config.setdefault('INGEST_THUMBNAIL_SIZE', 256)
+        app.config.setdefault('INGEST_THUMBNAIL_FORMAT', 'webp')
+        app.config.setdefault('INGEST_WORK_DIR', os.path.join(tempfile.gettempdir(), 'hidoc_ingest'))
+        app.config.setdefault('INGEST_REDIS_URL', 'redis://localhost:6379/0')
+        # 执行中的任务超过该秒数没有进度更新即视为已中断 (例如进程重启)
+        app.config.setdefault('INGEST_STALE_AFTER', 600)
+        app.extensions['ingest_queue'] = self
+        self.app = app
+        # 上传的文件直接写入工作目录，请求结束时删除没有被接管的文件
+        app.request_class = UploadRequest
+        app.teardown_request(_remove_unclaimed_uploads)
+
+    @property
+    def work_dir(self):
+        path = self.app.config['INGEST_WORK_DIR']
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def spool(self, stream, suffix):
+        """
+        取得上传文件在工作目录中的路径和内容哈希。
+        multipart 上传的文件在解析请求时已经直接写入工作目录 (见 UploadRequest)，这里只接管该文件，不再复制；
+        其他文件流分块写入工作目录，写入的同时计算内容哈希，不需要再读一遍文件。
+        :return: (本地路径, SHA-256十六进制字符串)
+        """
+        if isinstance(stream, SpooledUpload):
+            return stream.take(suffix)
+        path = os.path.join(self.work_dir, f"{uuid.uuid4()}{suffix}")
+        digest = hashlib.sha256()
+        with open(path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(SPOOL_CHUNK), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        return path, digest.hexdigest()
+
+    def submit(self, job_id):
+        """投递一个已入库的处理任务"""
+        backend = self.app.config['INGEST_BACKEND']
+        if backend == 'inline':
+            run_job(job_id)
+        elif backend == 'rq':
+            # 仅在启用持久化队列时才需要安装 redis 和 rq
+            from redis import Redis
+            from rq import Queue
+            queue = Queue('hidoc_ingest', connection=Redis.from_url(self.app.config['INGEST_REDIS_URL']))
+            queue.enqueue('ingest.run_queued_job', job_id, job_timeout=3600)
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.app.config['INGEST_WORKERS'],
+                    thread_name_prefix='hidoc-ingest'
+                )
+            self._executor.submit(self._run_in_context, job_id)
+
+    def _run_in_context(self, job_id):
+        with self.app.app_context():
+            run_job(job_id)
+
+    def recover(self):
+        """
+        进程启动时恢复 'local' 模式下随上一个进程丢失的任务: 已中断的任务标记为失败并清除生成了一半的切片，
+        仍在排队的重新投递。任务开始执行时会原子地认领，多个进程重复投递同一任务也只执行一次。
+        需要在应用上下文中调用；不经 app.py 启动时 (例如 gunicorn) 在工作进程的初始化钩子中调用。
+        返回 (重新投递数, 标记失败数)
+        """
+        if self.app.config['INGEST_BACKEND'] != 'local':
+            return 0, 0
+        stale = IngestJob.query.filter(IngestJob.status == 'running', IngestJob.updated_at < self.stale_before()).all()
+        for job in stale:
+            fail_job(job, '处理中断，请重新上传')
+        job_ids = [job_id for job_id, in db.session.query(IngestJob.id).filter(
+            IngestJob.status == 'queued').order_by(IngestJob.id)]
+        for job_id in job_ids:
+            self.submit(job_id)
+        return len(job_ids), len(stale)
+
+    def stale_before(self):
+        return datetime.now() - timedelta(seconds=self.app.config['INGEST_STALE_AFTER'])
+
+
+ingest_queue = IngestQueue()
+
+
+def run_queued_job(job_id):
+    """rq worker 的入口，worker 进程中需要自行创建应用上下文"""
+    from app import app
+    with app.app_context():
+        run_job(job_id)
+
+
+def _fetch_original(job, image):
+    """返回原始文件的本地路径；暂存文件不存在时(例如在其他机器上执行)从OSS下载"""
+    if job.work_path and os.path.exists(job.work_path):
+        return job.work_path
+    suffix = '.nii.gz' if image.oss_key.endswith('.nii.gz') else os.path.splitext(image.oss_key)[1]
+    path = os.path.join(ingest_queue.work_dir, f"{uuid.uuid4()}{suffix}")
+    download_from_oss(image.oss_key, path)
+    return path
+
+
+def slice_row(image, axis_name, index, oss_key, size_kb):
+    """3D影像一张切片的切片记录，返回 image 表的列值字典"""
+    return {
+        'name': f"{image.name}_{AXIS_LABELS[axis_name]}_{index}", 'format': 'picture', 'type': image.type,
+        'dim': '2D', 'creator_id': image.creator_id, 'oss_key': oss_key, 'size': size_kb,
+        'parent_image_id': image.id, 'slice_direction': axis_name, 'slice': index
+    }
+
+
+def insert_slice_rows(rows):
+    """
+    批量写入切片记录 (不提交)。
+    按 INSERT_BATCH 分批以 executemany 执行 INSERT，不为每张切片创建ORM对象再逐条 flush。
+    :param rows: slice_row 返回的字典列表
+    """
+    for start in range(0, len(rows), INSERT_BATCH):
+        db.session.execute(insert(Image), rows[start:start + INSERT_BATCH])
+
+
+def _store_slices(job, image, batch, sizes, templates=None):
+    """
+    并发上传一批切片，全部成功后写入切片记录并提交进度；任一失败则抛出异常。
+    使用切片清单时 templates 为各方向的OSS键模板，切片不写切片记录，只按方向累计大小到 sizes。
+    """
+    use_manifest = templates is not None
+    keyed = [
+        (templates[axis_name].format(index=i) if use_manifest else f"hidoc2/images/{uuid.uuid4()}.png",
+         axis_name, i, png_buffer)
+        for axis_name, i, png_buffer in batch
+    ]
+    results = uploader.upload_batch((key, png_buffer) for key, _, _, png_buffer in keyed)
+    failed = [r for r in results if r.error]
+    if failed:
+        raise Exception(f"{len(failed)} 张切片上传失败: {failed[0].error}")
+
+    if use_manifest:
+        for _, axis_name, _, png_buffer in keyed:
+            sizes[axis_name] += len(png_buffer.getvalue()) / 1024.0
+    else:
+        insert_slice_rows([
+            slice_row(image, axis_name, i, png_oss_key, len(png_buffer.getvalue()) / 1024.0)
+            for png_oss_key, axis_name, i, png_buffer in keyed
+        ])
+    if job.build_tiles:
+        for png_oss_key, axis_name, i, png_buffer in keyed:
+            # 只读取PNG文件头判断尺寸，大尺寸切片才解码并生成瓦片
+            pil_img = PilImage.open(io.BytesIO(png_buffer.getvalue()))
+            if wants_tiles(*pil_img.size):
+                # 瓦片金字塔需要关联切片记录，使用切片清单时为该切片单独创建。
+                # 切片按内容寻址，不同影像的相同切片共用 oss_key，只能按 uq_image_slice 的列查找本影像的记录
+                slice_img = Image.query.filter_by(
+                    parent_image_id=image.id, slice_direction=axis_name, slice=i).first() or Image(
+                    **slice_row(image, axis_name, i, png_oss_key, len(png_buffer.getvalue()) / 1024.0))
+                db.session.add(slice_img)
+                build_tile_pyramid(slice_img, pil_img)
+    job.done += len(keyed)
+    db.session.commit()
+
+
+def find_content(digest, kind):
+    """按内容哈希查找已存储的对象，没有则返回 None"""
+    return ContentObject.query.filter_by(sha256=digest, kind=kind).first()
+
+
+def remember_content(digest, kind, oss_key, size_kb):
+    """
+    登记一个按内容寻址存储的对象 (不提交)。
+    并发上传相同内容时由唯一约束去重，保留先登记的记录。
+    """
+    try:
+        with db.session.begin_nested():
+            db.session.add(ContentObject(sha256=digest, kind=kind, oss_key=oss_key, size=size_kb))
+    except IntegrityError:
+        pass
+
+
+def store_original(path, digest, suffix):
+    """
+    按内容寻址上传原始文件，相同内容已存储过时跳过上传。
+    :return: 原始文件的OSS键
+    """
+    known = find_content(digest, 'original')
+    if known:
+        return known.oss_key
+    oss_key = content_key(digest, suffix)
+    if not upload_file_to_oss(path, oss_key):
+        raise Exception("Original file OSS upload failed")
+    remember_content(digest, 'original', oss_key, os.path.getsize(path) / 1024.0)
+    return oss_key
+
+
+def reuse_rendered_slices(image, windowing, tiles=False):
+    """
+    相同原始文件已用同一窗口模式渲染过切片时，直接为影像登记指向这些切片的切片清单 (不提交)，
+    跳过渲染和上传。需要瓦片时同时复用已生成的瓦片金字塔，不完整时不复用，由后台任务重新生成。
+    返回是否复用成功。
+    """
+    if not image.content_hash:
+        return False
+    known = find_content(image.content_hash, f"slices:{windowing}")
+    if not known:
+        return False
+    sources = {}
+    for manifest in SliceManifest.query.filter(SliceManifest.key_template.startswith(f"{known.oss_key}/")):
+        sources.setdefault(manifest.direction, manifest)
+    if set(sources) != {'x', 'y', 'z'}:
+        return False
+    pyramids = _reusable_pyramids(image, sources) if tiles else {}
+    if pyramids is None:
+        return False
+    for direction, source in sources.items():
+        db.session.add(SliceManifest(
+            image_id=image.id, direction=direction, count=source.count,
+            key_template=source.key_template, size=source.size
+        ))
+    for (direction, index), pyramid in pyramids.items():
+        source = sources[direction]
+        slice_img = Image(**slice_row(image, direction, index, source.key(index), float(source.size) / source.count))
+        db.session.add(slice_img)
+        # 瓦片按随机前缀存储且不会再修改，可以直接共用
+        db.session.add(ImagePyramid(
+            image=slice_img, oss_prefix=pyramid.oss_prefix, width=pyramid.width, height=pyramid.height,
+            tile_size=pyramid.tile_size, overlap=pyramid.overlap, format=pyramid.format,
+            tile_count=pyramid.tile_count
+        ))
+    image.preview_key = sources['x'].key(0) if sources['x'].count else None
+    store_thumbnail(image, windowing=windowing)
+    return True
+
+
+def _reusable_pyramids(image, sources):
+    """
+    共用这些切片的影像上已生成的瓦片金字塔，按 (方向, 索引) 返回需要瓦片的每张切片的金字塔；
+    瓦片规格与当前配置不同或有切片缺少金字塔时返回 None
+    """
+    config = ingest_queue.app.config
+    counts = {'x': image.slice_x, 'y': image.slice_y, 'z': image.slice_z}
+    # 各方向切片的两边长度
+    planes = {'x': (image.slice_y, image.slice_z), 'y': (image.slice_x, image.slice_z),
+              'z': (image.slice_x, image.slice_y)}
+    wanted = {(direction, index) for direction, count in counts.items()
+              if wants_tiles(*planes[direction]) for index in range(count)}
+    if not wanted:
+        return {}
+    volume_ids = db.session.query(SliceManifest.image_id).filter(
+        SliceManifest.key_template.in_([source.key_template for source in sources.values()]))
+    found = {}
+    for direction, index, pyramid in db.session.query(Image.slice_direction, Image.slice, ImagePyramid).join(
+            ImagePyramid, ImagePyramid.image_id == Image.id).filter(
+            Image.parent_image_id.in_(volume_ids),
+            ImagePyramid.tile_size == config['INGEST_TILE_SIZE'], ImagePyramid.format == config['INGEST_TILE_FORMAT']):
+        found.setdefault((direction, index), pyramid)
+    if not wanted <= set(found):
+        return None
+    return {key: found[key] for key in wanted}
+
+
+def store_thumbnail(image, load=None, windowing=None):
+    """
+    为主影像生成列表缩略图并上传，写入 image.thumbnail_key (不提交)。
+    相同原始文件已生成过同样规格的缩略图时直接复用；否则调用 load() 取得预览图 (PIL图像) 后缩小编码，
+    load 为 None 时只尝试复用。缩略图只用于列表展示，生成失败时列表退回预览图，不影响入库。
+    3D影像的预览切片随窗口模式变化，windowing 与切片一样写进派生键，窗口模式变化后不会复用旧的缩略图；
+    不知道3D影像的窗口模式时缩略图只属于该影像。
+    返回是否写入了缩略图。
+    """
+    config = ingest_queue.app.config
+    size, fmt = config['INGEST_THUMBNAIL_SIZE'], config['INGEST_THUMBNAIL_FORMAT']
+    name = thumbnail_name(size, fmt)
+    if windowing:
+        name = f"{windowing}/{name}"
+    kind = f"thumbnail:{name}"
+    # 不知道窗口模式的3D影像不按内容共用缩略图
+    shared = bool(image.content_hash) and (bool(windowing) or image.dim != '3D')
+    try:
+        known = find_content(image.content_hash, kind) if shared else None
+        if known:
+            image.thumbnail_key = known.oss_key
+            return True
+        if load is None:
+            return False
+        pil_img = load()
+        if pil_img is None:
+            return False
+        data = encode_thumbnail(pil_img, size, fmt)
+        if shared:
+            oss_key = derived_key(image.content_hash, name)
+        else:
+            db.session.flush()
+            oss_key = f"hidoc2/thumbs/{image.id}/{name}"
+        uploader.put(oss_key, data)
+        if shared:
+            remember_content(image.content_hash, kind, oss_key, len(data) / 1024.0)
+        image.thumbnail_key = oss_key
+        return True
+    except Exception:
+        traceback.print_exc()
+        return False
+
+
+def wants_tiles(width, height):
+    """图像是否大到需要瓦片金字塔"""
+    return max(width, height) >= ingest_queue.app.config['INGEST_TILE_MIN_SIZE']
+
+
+def _upload_tiles(items):
+    results = uploader.upload_batch(items)
+    failed = [r for r in results if r.error]
+    if failed:
+        raise Exception(f"{len(failed)} 张瓦片上传失败: {failed[0].error}")
+
+
+def build_tile_pyramid(image, pil_img):
+    """
+    为2D影像生成 DZI 瓦片金字塔，分批并发上传瓦片和描述文件，并登记瓦片金字塔记录 (由调用方提交)。
+    任一瓦片上传失败则抛出异常。
+    """
+    config = ingest_queue.app.config
+    tile_size, fmt = config['INGEST_TILE_SIZE'], config['INGEST_TILE_FORMAT']
+    prefix = f"hidoc2/tiles/{uuid.uuid4()}"
+
+    tile_count = 0
+    batch = []
+    for level, col, row, data in iter_tiles(pil_img, tile_size, TILE_OVERLAP, fmt):
+        batch.append((tile_key(prefix, level, col, row, fmt), data))
+        if len(batch) >= UPLOAD_BATCH:
+            _upload_tiles(batch)
+            tile_count += len(batch)
+            batch = []
+    if batch:
+        _upload_tiles(batch)
+        tile_count += len(batch)
+
+    width, height = pil_img.size
+    uploader.put(f"{prefix}.dzi", dzi_xml(width, height, tile_size, TILE_OVERLAP, fmt))
+    pyramid = ImagePyramid(
+        image=image, oss_prefix=prefix, width=width, height=height,
+        tile_size=tile_size, overlap=TILE_OVERLAP, format=fmt, tile_count=tile_count
+    )
+    db.session.add(pyramid)
+    return pyramid
+
+
+def run_job(job_id):
+    """
+    执行一个3D影像处理任务：按 x/y/z 三个方向生成所有切片PNG，上传OSS并写入切片记录。
+    任一切片失败则整个任务失败，已生成的切片记录会被清除。
+    需要在应用上下文中调用。
+    """
+    # 原子地认领排队中的任务，重复投递 (例如启动恢复与原进程同时投递) 时只有一次执行
+    claimed = IngestJob.query.filter_by(id=job_id, status='queued').update(
+        {'status': 'running', 'done': 0, 'updated_at': datetime.now()}, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return
+    job = IngestJob.query.get(job_id)
+    image = job.image
+    local_path = None
+
+    try:
+        local_path = _fetch_original(job, image)
+        is_dicom = (image.format == 'dicom')
+        windowing = ingest_queue.app.config['INGEST_WINDOWING']
+        prewindowed = (windowing != 'slice')
+        pixel_array, ds = load_volume(local_path, image.format, native=prewindowed)
+        if prewindowed:
+            # 整个体数据统一窗口后转为 uint8，释放原始像素数组 (ds 内部也缓存了一份)
+            pixel_array, ds = window_volume(pixel_array, ds, windowing), None
+
+        axes = {'x': image.slice_x, 'y': image.slice_y, 'z': image.slice_z}
+        render_workers = ingest_queue.app.config['INGEST_RENDER_WORKERS']
+        templates = None
+        if ingest_queue.app.config['INGEST_SLICE_MANIFEST']:
+            # 已知原始文件哈希时切片按内容寻址，之后上传相同研究可直接复用
+            templates = {
+                axis_name: derived_slice_template(image.content_hash, windowing, axis_name) if image.content_hash
+                else slice_key(image.id, axis_name, '{index}')
+                for axis_name in axes
+            }
+        sizes = dict.fromkeys(axes, 0.0)
+        batch = []
+        thumbnail_png = None
+        for rendered in render_volume_slices(pixel_array, is_dicom, ds, axes, render_workers, prewindowed):
+            if rendered[0] == 'x' and rendered[1] == 0:
+                # 列表预览是 x 方向第一张切片，缩略图也由它生成
+                thumbnail_png = rendered[2].getvalue()
+            batch.append(rendered)
+            if len(batch) >= UPLOAD_BATCH:
+                _store_slices(job, image, batch, sizes, templates)
+                batch = []
+        if batch:
+            _store_slices(job, image, batch, sizes, templates)
+
+        if templates is not None:
+            for axis_name, slice_count in axes.items():
+                db.session.add(SliceManifest(
+                    image_id=image.id, direction=axis_name, count=slice_count,
+                    key_template=templates[axis_name], size=sizes[axis_name]
+                ))
+            if image.content_hash:
+                remember_content(image.content_hash, f"slices:{windowing}",
+                                 derived_key(image.content_hash, windowing), sum(sizes.values()))
+        update_preview(image)
+        store_thumbnail(image, lambda: PilImage.open(io.BytesIO(thumbnail_png)) if thumbnail_png else None, windowing)
+        image.status = 'ready'
+        job.status = 'succeeded'
+        db.session.commit()
+    except Exception as e:
+        traceback.print_exc()
+        db.session.rollback()
+        fail_job(job, str(e))
+    finally:
+        if local_path and os.path.exists(local_path):
+            os.remove(local_path)
+
+
+def fail_job(job, error):
+    """任务失败: 清除已生成的切片记录，影像和任务标记为失败"""
+    Image.query.filter_by(parent_image_id=job.image_id).delete()
+    SliceManifest.query.filter_by(image_id=job.image_id).delete()
+    job.image.status = 'failed'
+    job.status = 'failed'
+    job.error = error
+    db.session.commit()
+
+
+def expire_stale_job(job):
+    """执行任务的进程已退出时任务不会再有进度，标记为失败；返回是否标记"""
+    if job.status != 'running' or not job.updated_at or job.updated_at >= ingest_queue.stale_before():
+        return False
+    fail_job(job, '处理中断，请重新上传')
+    return True
+
+
+def slice_key(image_id, direction, index):
+    """切片使用确定的OSS键，重复生成时不会产生多份对象，同一方向的键可以用一个模板表示"""
+    return f"hidoc2/slices/{image_id}/{direction}/{index}.png"
+
+
+def render_lazy_slice(image, direction, index):
+    """
+    返回按需生成的切片PNG字节，依次查找内存/磁盘缓存，未命中时从内存映射的原始文件中渲染。
+    """
+    windowing = ingest_queue.app.config['INGEST_WINDOWING']
+    # 以原始文件的OSS键区分影像，窗口模式变化后不会命中旧的渲染结果
+    cache_key = f"{image.oss_key}/{direction}/{index}:{windowing}"
+    png = slice_cache.get_png(cache_key)
+    if png is not None:
+        return png
+
+    pixel_array, ds, window = slice_cache.get_volume(image, windowing)
+    is_dicom = (image.format == 'dicom')
+    slice_arr = extract_slice(pixel_array, direction, index, is_dicom)
+    if window is None:
+        png = convert_to_png(slice_arr, is_dicom, ds).getvalue()
+    else:
+        png = encode_png(apply_window(slice_arr, window)).getvalue()
+    slice_cache.put_png(cache_key, png)
+    return png
+
+
+def materialize_slice(image, direction, index, png=None):
+    """
+    确保切片有对应的切片记录 (标注需要切片ID)，返回切片记录。
+    切片清单中的切片已在OSS上，直接登记；按需生成的切片先渲染并上传。
+    并发请求同一切片时，由切片记录上 uq_image_slice (parent_image_id, slice_direction, slice) 的唯一约束保证只保留一条记录。
+    """
+    existing = Image.query.filter_by(parent_image_id=image.id, slice_direction=direction, slice=index).first()
+    if existing:
+        return existing
+
+    manifest = SliceManifest.query.filter_by(image_id=image.id, direction=direction).first()
+    if manifest:
+        oss_key = manifest.key(index)
+        size_kb = float(manifest.size) / manifest.count
+    else:
+        if png is None:
+            png = render_lazy_slice(image, direction, index)
+        oss_key = slice_key(image.id, direction, index)
+        uploader.put(oss_key, png)
+        size_kb = len(png) / 1024.0
+
+    slice_img = Image(**slice_row(image, direction, index, oss_key, size_kb))
+    try:
+        db.session.add(slice_img)
+        if image.preview_key is None:
+            # 按需生成切片的3D影像以第一张生成的切片作为列表预览
+            db.session.flush()
+            image.preview_image_id, image.preview_key = slice_img.id, oss_key
+            store_thumbnail(image, lambda: PilImage.open(io.BytesIO(png)) if png else None,
+                            ingest_queue.app.config['INGEST_WINDOWING'])
+        db.session.commit()
+        return slice_img
+    except IntegrityError:
+        db.session.rollback()
+        return Image.query.filter_by(parent_image_id=image.id, slice_direction=direction, slice=index).first()
+
+
+def sync_slice_annotated(slice_img):
+    """切片的标注增删后，同步切片清单中的标注位图 (不提交)"""
+    if slice_img.parent_image_id is None or slice_img.slice_direction is None:
+        return
+    manifest = SliceManifest.query.filter_by(
+        image_id=slice_img.parent_image_id, direction=slice_img.slice_direction).first()
+    if manifest:
+        manifest.set_annotated(slice_img.slice, ImageBbox.query.filter_by(image_id=slice_img.id).count() > 0)
+
@@ -0,0 +1,355 @@
+import os
+import tempfile
+from sqlalchemy import inspect, text, bindparam
+from sqlalchemy.schema import CreateColumn
+from PIL import Image as PilImage
+from models import (db, Image, IngestJob, SliceManifest, ImageBbox, ImageMask, ImageSeg, ImagePyramid, Office,
+                    Case, AiAdvice, DashboardCounter, Patient, SearchGram)
+from previews import resolve_previews
+from ingest import store_thumbnail
+from offices import office_path
+from stats import rebuild_counters
+from search import rebuild_search_index
+from utils.oss import download_from_oss
+from utils.content import derived_key
+
+# 按顺序执行的数据库升级步骤。
+# 每个步骤都必须是幂等的：先检查结构，已升级过则直接跳过。
+MIGRATIONS = []
+
+
+def migration(func):
+    """注册一个升级步骤"""
+    MIGRATIONS.append(func)
+    return func
+
+
+def add_column(model, column_name, default=None):
+    """
+    按模型中的列定义为已存在的表补充新列。
+    default 为原样写入DDL的默认值，用于回填已有数据行。
+    返回是否实际执行了变更。
+    """
+    table = model.__table__
+    existing = {c['name'] for c in inspect(db.engine).get_columns(table.name)}
+    if column_name in existing:
+        return False
+
+    dialect = db.engine.dialect
+    column_ddl = str(CreateColumn(table.c[column_name]).compile(dialect=dialect))
+    if default is not None:
+        column_ddl += f" DEFAULT {default}"
+    table_name = dialect.identifier_preparer.quote(table.name)
+    db.session.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_ddl}"))
+    db.session.commit()
+    return True
+
+
+def add_index(model, index_name):
+    """
+    按模型中的索引定义为已存在的表补充索引，返回是否实际执行了变更。
+    """
+    table = model.__table__
+    existing = {i['name'] for i in inspect(db.engine).get_indexes(table.name)}
+    if index_name in existing:
+        return False
+    index = next(i for i in table.indexes if i.name == index_name)
+    index.create(db.engine)
+    return True
+
+
+@migration
+def add_image_status():
+    """image 表新增处理状态列，已有影像均视为已就绪"""
+    return add_column(Image, 'status', default="'ready'")
+
+
+@migration
+def add_image_lazy_slices():
+    """image 表新增按需生成切片标志，已有影像均为预生成"""
+    return add_column(Image, 'lazy_slices', default='0')
+
+
+@migration
+def add_ingest_job_build_tiles():
+    """ingest_job 表新增瓦片金字塔生成标志"""
+    return add_column(IngestJob, 'build_tiles', default='0')
+
+
+@migration
+def add_image_content_hash():
+    """image 表新增原始文件内容哈希列及其索引，已有影像的哈希为空"""
+    changed = add_column(Image, 'content_hash')
+    return add_index(Image, 'ix_image_content_hash') or changed
+
+
+@migration
+def drop_image_oss_key_unique():
+    """
+    内容相同的影像共用同一OSS对象，去掉 image.oss_key 的唯一约束，改为普通索引；
+    切片记录的去重改由 uq_image_slice 保证。
+    SQLite 不支持删除约束，开发库需重建。
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return False
+    inspector = inspect(db.engine)
+    unique_names = [i['name'] for i in inspector.get_indexes('image') if i['unique'] and i['column_names'] == ['oss_key']]
+    unique_names += [c['name'] for c in inspector.get_unique_constraints('image') if c['column_names'] == ['oss_key']]
+    changed = False
+    for name in dict.fromkeys(unique_names):
+        quoted = db.engine.dialect.identifier_preparer.quote(name)
+        if dialect == 'mysql':
+            db.session.execute(text(f"ALTER TABLE image DROP INDEX {quoted}"))
+        else:
+            db.session.execute(text(f"ALTER TABLE image DROP CONSTRAINT {quoted}"))
+        changed = True
+    db.session.commit()
+    return add_index(Image, 'ix_image_oss_key') or changed
+
+
+@migration
+def add_image_slice_unique():
+    """同一3D影像同一方向的切片索引唯一"""
+    return add_index(Image, 'uq_image_slice')
+
+
+@migration
+def add_image_preview():
+    """image 表新增列表预览指针，已有影像由 backfill-previews 命令回填"""
+    changed = add_column(Image, 'preview_image_id')
+    return add_column(Image, 'preview_key') or changed
+
+
+@migration
+def add_image_thumbnail_key():
+    """image 表新增列表缩略图键，已有影像由 backfill-thumbnails 命令生成"""
+    return add_column(Image, 'thumbnail_key')
+
+
+@migration
+def add_office_path():
+    """office 表新增物化路径列及其索引，并为路径为空的科室计算路径"""
+    changed = add_column(Office, 'path')
+    changed = add_index(Office, 'ix_office_path') or changed
+    return rebuild_office_paths() > 0 or changed
+
+
+def rebuild_office_paths():
+    """
+    按 parent_id 重新计算所有科室的物化路径，只写回与计算结果不同的科室，返回写回的科室数。
+    数据中存在环的科室无法得到路径，保持不变。
+    """
+    offices = db.session.query(Office.id, Office.parent_id, Office.path).all()
+    parents = {office_id: parent_id for office_id, parent_id, _ in offices}
+    paths = {}
+
+    def resolve(office_id, visiting=()):
+        if office_id not in paths:
+            parent_id = parents.get(office_id)
+            if parent_id in visiting:
+                return None
+            parent_path = resolve(parent_id, visiting + (office_id,)) if parent_id in parents else None
+            if parent_id in parents and parent_path is None:
+                return None
+            paths[office_id] = office_path(parent_path, office_id)
+        return paths[office_id]
+
+    changes = []
+    for office_id, _, path in offices:
+        new_path = resolve(office_id)
+        if new_path is not None and new_path != path:
+            changes.append({'office_id': office_id, 'new_path': new_path})
+    if changes:
+        db.session.execute(
+            Office.__table__.update().where(Office.__table__.c.id == bindparam('office_id')).values(path=bindparam('new_path')),
+            changes
+        )
+    db.session.commit()
+    return len(changes)
+
+
+# 按列表和统计查询的筛选、排序条件建立的组合索引
+QUERY_INDEXES = (
+    (Image, 'ix_image_creator_parent_created'),
+    (Case, 'ix_case_office_date'),
+    (Case, 'ix_case_doctor_created'),
+    (Case, 'ix_case_patient_created'),
+    (ImageSeg, 'ix_image_seg_image_created'),
+    (ImageSeg, 'ix_image_seg_creator_created'),
+    (AiAdvice, 'ix_ai_advice_patient_created'),
+    (AiAdvice, 'ix_ai_advice_creator_created'),
+)
+
+
+@migration
+def add_query_indexes():
+    """为影像、病历、AI分割、AI辅诊表补充组合索引，数据量大的表建索引可能需要较长时间"""
+    changed = False
+    for model, index_name in QUERY_INDEXES:
+        changed = add_index(model, index_name) or changed
+    return changed
+
+
+@migration
+def fill_dashboard_counters():
+    """首页统计计数器表为空而已有业务数据时，从业务表整体计算一次"""
+    if DashboardCounter.query.first() is not None:
+        return False
+    # ImageSeg 的 query 列遮住了 Model.query，这里统一用 session 查询
+    if not any(db.session.query(model.id).first() is not None for model in (Case, ImageSeg, AiAdvice)):
+        return False
+    return rebuild_counters() > 0
+
+
+@migration
+def fill_search_index():
+    """检索索引表为空而已有病人或病历时，从业务表整体建立一次"""
+    if db.session.query(SearchGram.id).first() is not None:
+        return False
+    if not any(db.session.query(model.id).first() is not None for model in (Patient, Case)):
+        return False
+    return rebuild_search_index() > 0
+
+
+def upgrade():
+    """
+    创建缺失的表，并依次执行所有升级步骤。
+    返回实际执行过的步骤名称列表。
+    """
+    db.create_all()
+    applied = []
+    for step in MIGRATIONS:
+        if step():
+            applied.append(step.__name__)
+    return applied
+
+
+def compact_volume(volume):
+    """
+    把一个逐张切片记录的3D影像改为切片清单: 切片的OSS键按顺序打包进清单，
+    删除没有被标注、分割或瓦片引用的切片记录。切片不完整时跳过，返回是否实际执行了变更。
+    """
+    rows = Image.query.filter_by(parent_image_id=volume.id).order_by(Image.slice.asc()).all()
+    axes = {'x': volume.slice_x, 'y': volume.slice_y, 'z': volume.slice_z}
+    by_direction = {direction: [r for r in rows if r.slice_direction == direction] for direction in axes}
+    if any([r.slice for r in by_direction[d]] != list(range(count or 0)) for d, count in axes.items()):
+        return False
+
+    row_ids = [r.id for r in rows]
+    referenced = set()
+    for model in (ImageBbox, ImageMask, ImageSeg, ImagePyramid):
+        referenced.update(image_id for image_id, in db.session.query(model.image_id).filter(
+            model.image_id.in_(row_ids)).distinct())
+    annotated = {image_id for image_id, in db.session.query(ImageBbox.image_id).filter(
+        ImageBbox.image_id.in_(row_ids)).distinct()}
+
+    for direction, dir_rows in by_direction.items():
+        manifest = SliceManifest(
+            image_id=volume.id, direction=direction, count=len(dir_rows),
+            packed_keys='\n'.join(r.oss_key for r in dir_rows),
+            size=sum(float(r.size) for r in dir_rows)
+        )
+        for r in dir_rows:
+            if r.id in annotated:
+                manifest.set_annotated(r.slice, True)
+        db.session.add(manifest)
+
+    unreferenced = [image_id for image_id in row_ids if image_id not in referenced]
+    if unreferenced:
+        Image.query.filter(Image.id.in_(unreferenced)).delete(synchronize_session=False)
+        # 预览图的OSS键不变，只是可能不再有对应的切片记录
+        if volume.preview_image_id in unreferenced:
+            volume.preview_image_id = None
+    db.session.commit()
+    return True
+
+
+def compact_slices():
+    """
+    将所有仍是逐张切片记录的3D影像改为切片清单，每个影像单独提交。
+    返回 (已处理影像数, 跳过影像数)。
+    """
+    volumes = Image.query.filter(
+        Image.dim == '3D', Image.parent_image_id.is_(None), Image.lazy_slices.is_(False),
+        Image.status == 'ready', ~Image.slice_manifests.any()
+    ).order_by(Image.id.asc()).all()
+    compacted = skipped = 0
+    for volume in volumes:
+        if compact_volume(volume):
+            compacted += 1
+        else:
+            skipped += 1
+    return compacted, skipped
+
+
+def backfill_previews(batch_size=500):
+    """
+    为 preview_key 为空的主影像回填预览指针，按ID分批提交。
+    按需生成切片且尚未生成任何切片的3D影像暂时没有预览，保持为空，首次生成切片时写入。
+    返回 (已回填影像数, 仍无预览影像数)。
+    """
+    filled = missing = 0
+    last_id = 0
+    while True:
+        images = Image.query.filter(
+            Image.parent_image_id.is_(None), Image.preview_key.is_(None), Image.id > last_id
+        ).order_by(Image.id.asc()).limit(batch_size).all()
+        if not images:
+            break
+        previews = resolve_previews(images)
+        for image in images:
+            if image.id in previews:
+                image.preview_image_id, image.preview_key = previews[image.id]
+                filled += 1
+            else:
+                missing += 1
+        last_id = images[-1].id
+        db.session.commit()
+    return filled, missing
+
+
+def _load_preview(preview_key):
+    """下载预览图并解码，返回加载完成的PIL图像"""
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(preview_key)[1])
+    os.close(fd)
+    try:
+        download_from_oss(preview_key, path)
+        with PilImage.open(path) as pil_img:
+            pil_img.load()
+            return pil_img.copy()
+    finally:
+        os.remove(path)
+
+
+def _preview_windowing(image):
+    """3D影像预览切片的窗口模式，从按内容寻址的切片键 {派生前缀}/{窗口模式}/{方向}/{索引}.png 中取出，无法确定时为 None"""
+    if image.dim != '3D' or not image.content_hash:
+        return None
+    prefix = derived_key(image.content_hash, '')
+    parts = image.preview_key[len(prefix):].split('/') if image.preview_key.startswith(prefix) else []
+    return parts[0] if len(parts) == 3 else None
+
+
+def backfill_thumbnails(batch_size=100):
+    """
+    为已有预览指针、但还没有缩略图的主影像生成缩略图，按ID分批提交。
+    需要先执行 backfill-previews。返回 (已生成影像数, 失败影像数)。
+    """
+    filled = failed = 0
+    last_id = 0
+    while True:
+        images = Image.query.filter(
+            Image.parent_image_id.is_(None), Image.preview_key.isnot(None),
+            Image.thumbnail_key.is_(None), Image.id > last_id
+        ).order_by(Image.id.asc()).limit(batch_size).all()
+        if not images:
+            break
+        for image in images:
+            if store_thumbnail(image, lambda: _load_preview(image.preview_key), _preview_windowing(image)):
+                filled += 1
+            else:
+                failed += 1
+        last_id = images[-1].id
+        db.session.commit()
+    return filled, failed
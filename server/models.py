@@ -48,6 +48,9 @@ class Office(db.Model):
     name = db.Column(db.String(100), nullable=False, comment='科室名称')
     parent_id = db.Column(db.Integer, db.ForeignKey('office.id', ondelete='CASCADE'), nullable=True, comment='上级科室ID')
     hospital_id = db.Column(db.Integer, db.ForeignKey('hospital.id'), nullable=False, comment='所属医院ID')
+    # 物化路径，形如 /1/5/12/，由 offices.py 中的事件在新增和移动科室时维护；
+    # 查询某科室及其所有子孙科室时用 path LIKE '/1/5/%' 走索引范围扫描
+    path = db.Column(db.String(255), nullable=True, index=True, comment='科室物化路径 (从顶层科室到自身的ID)')
     created_at = db.Column(db.TIMESTAMP, default=datetime.now, comment='创建时间')
     
     # 自引用关系，添加级联删除
@@ -126,6 +129,14 @@ class Patient(db.Model):
 
 class Case(db.Model):
     __tablename__ = 'case'
+    __table_args__ = (
+        # 科室病历列表: 按科室筛选，按就诊日期、创建时间倒序分页
+        db.Index('ix_case_office_date', 'office_id', 'case_date', 'created_at'),
+        # 首页统计和病人列表: 按医生筛选，按创建时间取区间
+        db.Index('ix_case_doctor_created', 'doctor_id', 'created_at'),
+        # 病人的病历列表: 按病人筛选，按创建时间倒序分页
+        db.Index('ix_case_patient_created', 'patient_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='病历ID')
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id', ondelete='CASCADE'), nullable=False, comment='病人ID')
@@ -173,6 +184,12 @@ class Case(db.Model):
 
 class Image(db.Model):
     __tablename__ = 'image'
+    __table_args__ = (
+        # 同一3D影像同一方向的每个切片索引只有一条切片记录，并发生成切片记录时依赖该约束去重
+        db.Index('uq_image_slice', 'parent_image_id', 'slice_direction', 'slice', unique=True),
+        # 影像列表: 按创建者筛选顶层影像，按创建时间倒序分页
+        db.Index('ix_image_creator_parent_created', 'creator_id', 'parent_image_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='影像ID')
     name = db.Column(db.String(255), nullable=True, comment='影像名称')
@@ -184,14 +201,22 @@ class Image(db.Model):
     office_id = db.Column(db.Integer, db.ForeignKey('office.id', ondelete='SET NULL'), nullable=True, comment='科室ID')
     case_id = db.Column(db.Integer, db.ForeignKey('case.id', ondelete='SET NULL'), nullable=True, comment='病历ID')
     note = db.Column(db.Text, nullable=True, comment='备注')
-    oss_key = db.Column(db.String(255), nullable=False, unique=True, comment='OSS对象存储键')
+    oss_key = db.Column(db.String(255), nullable=False, index=True, comment='OSS对象存储键，内容相同的影像共用同一对象')
     size = db.Column(db.Numeric(10, 2), nullable=False, comment='文件大小(KB)')
+    content_hash = db.Column(db.String(64), nullable=True, index=True, comment='原始文件内容的SHA-256')
     parent_image_id = db.Column(db.Integer, db.ForeignKey('image.id', ondelete='CASCADE'), nullable=True, comment='父影像ID (用于3D影像切片)')
     slice_direction = db.Column(db.Enum('x', 'y', 'z'), nullable=True, comment='3D影像切片方向')
     slice = db.Column(db.Integer, nullable=True, comment='3D影像切片索引')
     slice_x = db.Column(db.Integer, nullable=True, comment='3D影像x方向切片数')
     slice_y = db.Column(db.Integer, nullable=True, comment='3D影像y方向切片数')
     slice_z = db.Column(db.Integer, nullable=True, comment='3D影像z方向切片数')
+    status = db.Column(db.Enum('processing', 'ready', 'failed'), nullable=False, default='ready', comment='处理状态')
+    lazy_slices = db.Column(db.Boolean, nullable=False, default=False, comment='3D影像切片是否在首次访问时按需生成')
+    # 列表预览指针，由入库流程写入，列表接口直接读取而不再查找子影像。
+    # 不设外键，避免与 parent_image_id 在同一张表上形成环状级联。
+    preview_image_id = db.Column(db.Integer, nullable=True, comment='预览子影像ID (2D预览图或3D的 x 方向第一张切片记录)')
+    preview_key = db.Column(db.String(255), nullable=True, comment='列表预览图的OSS键')
+    thumbnail_key = db.Column(db.String(255), nullable=True, comment='列表缩略图的OSS键')
     created_at = db.Column(db.TIMESTAMP, default=datetime.now, comment='创建时间')
     
     # 关系
@@ -215,12 +240,153 @@ class Image(db.Model):
             'note': self.note,
             'oss_key': self.oss_key,
             'size': float(self.size) if self.size is not None else None,
+            'content_hash': self.content_hash,
             'parent_image_id': self.parent_image_id,
             'slice_direction': self.slice_direction,
             'slice': self.slice,
             'slice_x': self.slice_x,
             'slice_y': self.slice_y,
             'slice_z': self.slice_z,
+            'status': self.status,
+            'lazy_slices': bool(self.lazy_slices),
+            'preview_image_id': self.preview_image_id,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
+        }
+
+class ContentObject(db.Model):
+    __tablename__ = 'content_object'
+    __table_args__ = (db.UniqueConstraint('sha256', 'kind', name='uq_content_object_sha256_kind'),)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='内容对象ID')
+    sha256 = db.Column(db.String(64), nullable=False, comment='原始文件内容的SHA-256')
+    kind = db.Column(db.String(32), nullable=False, comment="对象类别: original 原始文件, preview 2D预览图, slices:<窗口模式> 3D切片")
+    oss_key = db.Column(db.String(255), nullable=False, comment='OSS对象存储键；3D切片为键模板所在的前缀')
+    size = db.Column(db.Numeric(12, 2), nullable=False, default=0, comment='对象大小(KB)')
+    created_at = db.Column(db.TIMESTAMP, default=datetime.now, comment='创建时间')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'sha256': self.sha256,
+            'kind': self.kind,
+            'oss_key': self.oss_key,
+            'size': float(self.size) if self.size is not None else None,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
+        }
+
+class IngestJob(db.Model):
+    __tablename__ = 'ingest_job'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='处理任务ID')
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id', ondelete='CASCADE'), nullable=False, comment='主影像ID')
+    creator_id = db.Column(db.Integer, db.ForeignKey('doctor.id', ondelete='CASCADE'), nullable=False, comment='创建者ID (医生)')
+    status = db.Column(db.Enum('queued', 'running', 'succeeded', 'failed'), nullable=False, default='queued', comment='任务状态')
+    total = db.Column(db.Integer, nullable=False, default=0, comment='待生成切片总数')
+    done = db.Column(db.Integer, nullable=False, default=0, comment='已生成切片数')
+    work_path = db.Column(db.String(512), nullable=True, comment='原始文件的本地暂存路径')
+    build_tiles = db.Column(db.Boolean, nullable=False, default=False, comment='是否为大尺寸切片生成瓦片金字塔')
+    error = db.Column(db.Text, nullable=True, comment='失败原因')
+    created_at = db.Column(db.TIMESTAMP, default=datetime.now, comment='创建时间')
+    updated_at = db.Column(db.TIMESTAMP, default=datetime.now, onupdate=datetime.now, comment='更新时间')
+
+    # 关系
+    image = db.relationship('Image', backref=db.backref('ingest_jobs', lazy='dynamic', cascade='all, delete-orphan'))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'image_id': self.image_id,
+            'creator_id': self.creator_id,
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'progress': round(self.done / self.total * 100, 1) if self.total else 0.0,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S') if self.updated_at else None
+        }
+
+class SliceManifest(db.Model):
+    __tablename__ = 'slice_manifest'
+    __table_args__ = (db.UniqueConstraint('image_id', 'direction', name='uq_slice_manifest_image_direction'),)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='切片清单ID')
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id', ondelete='CASCADE'), nullable=False, comment='3D主影像ID')
+    direction = db.Column(db.Enum('x', 'y', 'z'), nullable=False, comment='切片方向')
+    count = db.Column(db.Integer, nullable=False, comment='该方向的切片数')
+    key_template = db.Column(db.String(255), nullable=True, comment='切片OSS键模板，{index} 替换为切片索引')
+    packed_keys = db.Column(db.Text, nullable=True, comment='按索引顺序以换行分隔的切片OSS键，无法用模板表示时使用')
+    size = db.Column(db.Numeric(12, 2), nullable=False, default=0, comment='该方向全部切片的总大小(KB)')
+    annotated = db.Column(db.LargeBinary, nullable=True, comment='标注位图，第 i 位表示第 i 张切片是否有标注')
+    created_at = db.Column(db.TIMESTAMP, default=datetime.now, comment='创建时间')
+
+    # 关系
+    image = db.relationship('Image', backref=db.backref('slice_manifests', lazy='dynamic', cascade='all, delete-orphan'))
+
+    def keys(self):
+        """按索引顺序返回全部切片的OSS键"""
+        if self.key_template:
+            return [self.key_template.format(index=i) for i in range(self.count)]
+        return self.packed_keys.split('\n') if self.packed_keys else []
+
+    def key(self, index):
+        if self.key_template:
+            return self.key_template.format(index=index)
+        return self.keys()[index]
+
+    def annotated_indices(self):
+        bitmap = self.annotated or b''
+        return [i for i in range(min(self.count, len(bitmap) * 8)) if bitmap[i >> 3] & (1 << (i & 7))]
+
+    def set_annotated(self, index, flag):
+        bitmap = bytearray(self.annotated or bytes((self.count + 7) // 8))
+        if flag:
+            bitmap[index >> 3] |= 1 << (index & 7)
+        else:
+            bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+        # 重新赋值为新对象，ORM 才能检测到变更
+        self.annotated = bytes(bitmap)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'image_id': self.image_id,
+            'direction': self.direction,
+            'count': self.count,
+            'key_template': self.key_template,
+            'size': float(self.size) if self.size is not None else None,
+            'annotated_slices': self.annotated_indices(),
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
+        }
+
+class ImagePyramid(db.Model):
+    __tablename__ = 'image_pyramid'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='瓦片金字塔ID')
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id', ondelete='CASCADE'), nullable=False, unique=True, comment='影像ID')
+    oss_prefix = db.Column(db.String(255), nullable=False, comment='瓦片OSS键前缀，瓦片位于 {前缀}_files/{层}/{列}_{行}.{格式}')
+    width = db.Column(db.Integer, nullable=False, comment='原图宽度')
+    height = db.Column(db.Integer, nullable=False, comment='原图高度')
+    tile_size = db.Column(db.Integer, nullable=False, comment='瓦片边长')
+    overlap = db.Column(db.Integer, nullable=False, default=0, comment='瓦片重叠像素数')
+    format = db.Column(db.Enum('png', 'jpeg'), nullable=False, default='png', comment='瓦片格式')
+    tile_count = db.Column(db.Integer, nullable=False, comment='瓦片总数')
+    created_at = db.Column(db.TIMESTAMP, default=datetime.now, comment='创建时间')
+
+    # 关系
+    image = db.relationship('Image', backref=db.backref('pyramid', uselist=False, cascade='all, delete-orphan'))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'image_id': self.image_id,
+            'oss_prefix': self.oss_prefix,
+            'width': self.width,
+            'height': self.height,
+            'tile_size': self.tile_size,
+            'overlap': self.overlap,
+            'format': self.format,
+            'tile_count': self.tile_count,
             'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
         }
 
@@ -281,6 +447,12 @@ class ImageMask(db.Model):
 
 class ImageSeg(db.Model):
     __tablename__ = 'image_seg'
+    __table_args__ = (
+        # 影像的分割记录列表: 按影像筛选，按创建时间倒序分页
+        db.Index('ix_image_seg_image_created', 'image_id', 'created_at'),
+        # 首页统计 (直接聚合时): 按创建者筛选，按创建时间取区间
+        db.Index('ix_image_seg_creator_created', 'creator_id', 'created_at'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='AI分割结果ID')
     image_id = db.Column(db.Integer, db.ForeignKey('image.id', ondelete='CASCADE'), nullable=False, comment='影像ID')
@@ -306,8 +478,52 @@ class ImageSeg(db.Model):
         }
 
 
+class SegJob(db.Model):
+    """
+    AI分割任务。提交分割请求时登记任务，由 segment.py 的队列按并发上限调用AI服务，结果落地时再创建 ImageSeg。
+    """
+    __tablename__ = 'seg_job'
+    __table_args__ = (
+        # 统计医生未完成的任务数
+        db.Index('ix_seg_job_creator_status', 'creator_id', 'status'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='分割任务ID')
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id', ondelete='CASCADE'), nullable=False, comment='影像ID')
+    creator_id = db.Column(db.Integer, db.ForeignKey('doctor.id', ondelete='CASCADE'), nullable=False, comment='创建者ID (医生)')
+    query = db.Column(db.Text, nullable=False, comment='分割查询')
+    status = db.Column(db.Enum('queued', 'running', 'succeeded', 'failed'), nullable=False, default='queued', comment='任务状态')
+    seg_id = db.Column(db.Integer, db.ForeignKey('image_seg.id', ondelete='SET NULL'), nullable=True, comment='分割结果ID')
+    error = db.Column(db.Text, nullable=True, comment='失败原因')
+    created_at = db.Column(db.TIMESTAMP, default=datetime.now, comment='创建时间')
+    updated_at = db.Column(db.TIMESTAMP, default=datetime.now, onupdate=datetime.now, comment='更新时间')
+
+    # 关系
+    image = db.relationship('Image', backref=db.backref('seg_jobs', lazy='dynamic', cascade='all, delete-orphan'))
+    seg = db.relationship('ImageSeg')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'image_id': self.image_id,
+            'creator_id': self.creator_id,
+            'query': self.query,
+            'status': self.status,
+            'seg_id': self.seg_id,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S') if self.updated_at else None
+        }
+
+
 class AiAdvice(db.Model):
     __tablename__ = 'ai_advice'
+    __table_args__ = (
+        # 病人的AI辅诊记录列表: 按病人筛选，按创建时间倒序分页
+        db.Index('ix_ai_advice_patient_created', 'patient_id', 'created_at'),
+        # 首页统计 (直接聚合时): 按创建者筛选，按创建时间取区间
+        db.Index('ix_ai_advice_creator_created', 'creator_id', 'created_at'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='AI建议ID')
     creator_id = db.Column(db.Integer, db.ForeignKey('doctor.id', ondelete='CASCADE'), nullable=False, comment='创建者ID (医生)')
@@ -329,3 +545,62 @@ class AiAdvice(db.Model):
             'therapy': self.therapy,
             'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
         }
+
+
+class DashboardCounter(db.Model):
+    """
+    首页统计计数器，由 stats.py 在写入病历、AI分割和AI辅诊时增量维护，可用 rebuild-stats 命令整体重建。
+    每个指标有一行全部累计 (period='total')，另按天各一行 (period 为 YYYY-MM-DD)。
+    """
+    __tablename__ = 'dashboard_counter'
+    __table_args__ = (
+        db.UniqueConstraint('doctor_id', 'hospital_id', 'metric', 'period', name='uq_dashboard_counter'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='计数器ID')
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id', ondelete='CASCADE'), nullable=False, comment='医生ID')
+    hospital_id = db.Column(db.Integer, nullable=False, default=0, comment='医院ID，不区分医院的指标为0')
+    metric = db.Column(db.String(16), nullable=False, comment='指标: cases 病历, patients 病人(去重), ai_segs AI分割, ai_advices AI辅诊')
+    period = db.Column(db.String(10), nullable=False, comment="统计周期: total 全部累计，或 YYYY-MM-DD 当天")
+    value = db.Column(db.Integer, nullable=False, default=0, comment='计数')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'doctor_id': self.doctor_id,
+            'hospital_id': self.hospital_id,
+            'metric': self.metric,
+            'period': self.period,
+            'value': self.value
+        }
+
+
+class SearchGram(db.Model):
+    """
+    病人和病历检索用的 n-gram 倒排索引，由 search.py 在写入病人、病历时增量维护，可用 rebuild-search 命令整体重建。
+    每行记录一个词元 (二元组或单字，见 utils/ngrams.py) 在某条记录某个字段中的出现次数。
+    """
+    __tablename__ = 'search_gram'
+    __table_args__ = (
+        # 检索: 按词元和记录类型定位，覆盖打分所需的列，不必回表
+        db.Index('ix_search_gram_lookup', 'gram', 'doc_type', 'field', 'doc_id', 'tf'),
+        # 记录修改或删除时清除其旧词元
+        db.Index('ix_search_gram_doc', 'doc_type', 'doc_id', 'field'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='索引行ID')
+    gram = db.Column(db.String(8), nullable=False, comment='词元')
+    doc_type = db.Column(db.String(16), nullable=False, comment='记录类型: patient 病人, case 病历')
+    doc_id = db.Column(db.Integer, nullable=False, comment='记录ID')
+    field = db.Column(db.String(32), nullable=False, comment='字段名')
+    tf = db.Column(db.Integer, nullable=False, default=1, comment='词元在字段中的出现次数')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'gram': self.gram,
+            'doc_type': self.doc_type,
+            'doc_id': self.doc_id,
+            'field': self.field,
+            'tf': self.tf
+        }
@@ -0,0 +1,192 @@
+import time
+import threading
+from sqlalchemy import event, inspect, select, update, and_, func, literal, String
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from models import Office
+
+
+class OfficeTree:
+    """
+    一家医院的科室树快照。科室以 to_dict() 的字典保存，不持有ORM对象，可以跨请求和线程共享。
+    """
+
+    def __init__(self, offices):
+        self.offices = {office['id']: office for office in offices}
+        self.children = {}
+        for office in offices:
+            self.children.setdefault(office['parent_id'], []).append(office['id'])
+
+    def __contains__(self, office_id):
+        return office_id in self.offices
+
+    def descendants(self, office_id):
+        """科室自身及其所有子孙科室的ID，按广度优先顺序"""
+        if office_id not in self.offices:
+            return []
+        result, seen = [office_id], {office_id}
+        for current in result:
+            for child in self.children.get(current, ()):
+                # 防御数据中的环
+                if child not in seen:
+                    seen.add(child)
+                    result.append(child)
+        return result
+
+    def path(self, office_id):
+        """从顶层科室到该科室父科室的路径 (科室字典列表)，不含科室自身"""
+        path, seen = [], {office_id}
+        parent_id = self.offices[office_id]['parent_id'] if office_id in self.offices else None
+        while parent_id is not None and parent_id in self.offices and parent_id not in seen:
+            seen.add(parent_id)
+            parent = self.offices[parent_id]
+            path.append(parent)
+            parent_id = parent['parent_id']
+        path.reverse()
+        return path
+
+
+class OfficeTreeCache:
+    """
+    按医院缓存科室树，每家医院只用一次查询加载全部科室，之后的子孙科室、父路径查询都在内存中完成。
+
+    - 通过ORM增删改科室并提交后，所在医院的缓存立即失效
+    - 绕过ORM直接修改数据库时，依赖 OFFICE_TREE_TTL (秒) 过期，为 0 时不缓存
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self._trees = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('OFFICE_TREE_TTL', 300)
+        self.ttl = app.config['OFFICE_TREE_TTL']
+        app.extensions['office_trees'] = self
+        self.clear()
+
+    def get(self, hospital_id):
+        """返回医院的科室树，未缓存或已过期时重新加载"""
+        with self._lock:
+            cached = self._trees.get(hospital_id)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        loaded_at = time.monotonic()
+        tree = OfficeTree([office.to_dict() for office in Office.query.filter_by(hospital_id=hospital_id)])
+        if self.ttl > 0:
+            with self._lock:
+                self._trees[hospital_id] = (loaded_at, tree)
+        return tree
+
+    def invalidate(self, hospital_ids):
+        with self._lock:
+            for hospital_id in hospital_ids:
+                self._trees.pop(hospital_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+
+
+office_trees = OfficeTreeCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_office_changes(session, flush_context):
+    """记录本事务中增删改过科室的医院，提交后再使缓存失效，避免其他请求在提交前重新加载到旧数据"""
+    changed = session.info.setdefault('office_tree_hospitals', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Office):
+            changed.add(obj.hospital_id)
+            # 科室被移到其他医院时，原医院的科室树同样失效
+            changed.update(inspect(obj).attrs.hospital_id.history.deleted)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_office_trees(session):
+    changed = session.info.pop('office_tree_hospitals', None)
+    if changed:
+        office_trees.invalidate(changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_office_changes(session):
+    session.info.pop('office_tree_hospitals', None)
+
+
+def office_path(parent_path, office_id):
+    """科室的物化路径: 父科室路径后接自身ID，顶层科室为 /ID/"""
+    return f"{parent_path or '/'}{office_id}/"
+
+
+def subtree_filter(office):
+    """
+    筛选科室自身及其所有子孙科室的条件，用于与 Office 连接的查询。
+    路径只由数字和 / 组成，以该科室路径为前缀的路径都落在 [路径, 路径末尾的 / 换成 0) 区间内 ('0' 紧跟在 '/' 之后)。
+    写成区间而不是 LIKE 前缀匹配，与排序规则无关，各数据库都能在 path 索引上做范围扫描。
+    还没有执行 upgrade-db 填写路径的科室退回按科室树展开的ID列表。
+    """
+    if office.path is None:
+        return Office.id.in_(office_trees.get(office.hospital_id).descendants(office.id))
+    return _path_prefix(office.path)
+
+
+class OfficeMoveError(ValueError):
+    """把科室移动到它自己或它的子孙科室下"""
+
+
+def office_move_error(office, parent_id):
+    """
+    检查能否把科室移到 parent_id 下，不能时返回错误信息。修改科室上级的接口应在修改前调用，
+    提交时 _move_office_path 仍会拒绝形成环的移动，但那时只能抛出异常。
+    """
+    if parent_id is None:
+        return None
+    if parent_id == office.id or parent_id in office_trees.get(office.hospital_id).descendants(office.id):
+        return '不能把科室移动到它自己或它的子科室下'
+    return None
+
+
+def _path_prefix(path):
+    return and_(Office.path >= path, Office.path < path[:-1] + '0')
+
+
+def _parent_path(connection, parent_id):
+    if parent_id is None:
+        return None
+    return connection.scalar(select(Office.path).where(Office.id == parent_id))
+
+
+@event.listens_for(Office, 'after_insert')
+def _set_office_path(mapper, connection, target):
+    """新增科室后写入物化路径 (需要自增ID，只能在插入之后)"""
+    path = office_path(_parent_path(connection, target.parent_id), target.id)
+    connection.execute(update(Office).where(Office.id == target.id).values(path=path))
+    set_committed_value(target, 'path', path)
+
+
+@event.listens_for(Office, 'after_update')
+def _move_office_path(mapper, connection, target):
+    """
+    科室移到新的父科室下时，改写它和所有子孙科室路径的前缀。
+    删除科室时子孙科室随外键级联删除，路径无需维护。
+    """
+    if not inspect(target).attrs.parent_id.history.has_changes():
+        return
+    old_path = target.path
+    new_path = office_path(_parent_path(connection, target.parent_id), target.id)
+    if new_path == old_path:
+        return
+    if old_path is None:
+        connection.execute(update(Office).where(Office.id == target.id).values(path=new_path))
+    else:
+        if new_path.startswith(old_path):
+            raise OfficeMoveError('不能把科室移动到它自己的子科室下')
+        connection.execute(
+            update(Office).where(_path_prefix(old_path)).values(
+                path=literal(new_path, String) + func.substr(Office.path, len(old_path) + 1, type_=String)
+            )
+        )
+    set_committed_value(target, 'path', new_path)
@@ -3,7 +3,9 @@ from flask import request, jsonify, Blueprint
 from sqlalchemy.orm import joinedload
 from models import db, Patient, Case, Image, AiAdvice, Office
 import utils.jwtauth
+from utils.pagination import paginate, InvalidCursor
 from utils.silicon_flow import silicon_flow_client
+from search import search_patients, search_cases, page_args
 
 patient_bp = Blueprint('patient', __name__)
 
@@ -119,34 +121,27 @@ def list_patients():
     获取当前医生负责过的所有病人列表，去重并分页。
     """
     doctor_id = request.user_id
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 10, type=int)
 
     try:
         # 通过 Case 表找到所有该医生接触过的病人ID，并去重
-        # 然后基于这些病人ID进行分页查询
-        pagination = db.session.query(Patient) \
-            .join(Case, Patient.id == Case.patient_id) \
-            .filter(Case.doctor_id == doctor_id) \
-            .distinct() \
-            .paginate(page=page, per_page=per_page, error_out=False)
-
-        patients = pagination.items
+        # 然后基于这些病人ID进行分页查询，新建档的病人在前
+        patients, pagination = paginate(
+            db.session.query(Patient)
+            .join(Case, Patient.id == Case.patient_id)
+            .filter(Case.doctor_id == doctor_id)
+            .distinct(),
+            (Patient.created_at, Patient.id)
+        )
         data = [patient.to_dict() for patient in patients]
 
         return jsonify({
             'code': 200,
             'message': '查询成功',
             'data': data,
-            'pagination': {
-                'page': pagination.page,
-                'per_page': pagination.per_page,
-                'total_pages': pagination.pages,
-                'total_items': pagination.total,
-                'has_next': pagination.has_next,
-                'has_prev': pagination.has_prev
-            }
+            'pagination': pagination
         })
+    except InvalidCursor as e:
+        return jsonify({'code': 400, 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'code': 500, 'message': f'查询时发生内部错误: {str(e)}'}), 500
 
@@ -161,23 +156,18 @@ def list_patient_cases():
     if not patient_id:
         return jsonify({'code': 400, 'message': '缺少必要参数: patient_id'}), 400
 
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 10, type=int)
-
     if not Patient.query.get(patient_id):
         return jsonify({'code': 404, 'message': '病人不存在'}), 404
     
     try:
         # 使用 joinedload 预加载关联的 doctor 和 office.hospital 信息，避免 N+1 查询
-        pagination = Case.query.filter_by(patient_id=patient_id) \
-            .options(
+        cases, pagination = paginate(
+            Case.query.filter_by(patient_id=patient_id).options(
                 joinedload(Case.doctor),
                 joinedload(Case.office).joinedload(Office.hospital)
-            ) \
-            .order_by(Case.created_at.desc()) \
-            .paginate(page=page, per_page=per_page, error_out=False)
-        
-        cases = pagination.items
+            ),
+            (Case.created_at, Case.id)
+        )
         data = []
         for case in cases:
             case_data = case.to_dict()
@@ -190,15 +180,10 @@ def list_patient_cases():
             'code': 200,
             'message': '查询成功',
             'data': data,
-            'pagination': {
-                'page': pagination.page,
-                'per_page': pagination.per_page,
-                'total_pages': pagination.pages,
-                'total_items': pagination.total,
-                'has_next': pagination.has_next,
-                'has_prev': pagination.has_prev
-            }
+            'pagination': pagination
         })
+    except InvalidCursor as e:
+        return jsonify({'code': 400, 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'code': 500, 'message': f'查询时发生内部错误: {str(e)}'}), 500
 
@@ -213,18 +198,12 @@ def list_patient_analyses():
     if not patient_id:
         return jsonify({'code': 400, 'message': '缺少必要参数: patient_id'}), 400
 
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 10, type=int)
-
     if not Patient.query.get(patient_id):
         return jsonify({'code': 404, 'message': '病人不存在'}), 404
     
     try:
-        pagination = AiAdvice.query.filter_by(patient_id=patient_id) \
-            .order_by(AiAdvice.created_at.desc()) \
-            .paginate(page=page, per_page=per_page, error_out=False)
-        
-        advices = pagination.items
+        advices, pagination = paginate(
+            AiAdvice.query.filter_by(patient_id=patient_id), (AiAdvice.created_at, AiAdvice.id))
         data = []
         for advice in advices:
             advice_data = advice.to_dict()
@@ -235,15 +214,10 @@ def list_patient_analyses():
             'code': 200,
             'message': '查询成功',
             'data': data,
-            'pagination': {
-                'page': pagination.page,
-                'per_page': pagination.per_page,
-                'total_pages': pagination.pages,
-                'total_items': pagination.total,
-                'has_next': pagination.has_next,
-                'has_prev': pagination.has_prev
-            }
+            'pagination': pagination
         })
+    except InvalidCursor as e:
+        return jsonify({'code': 400, 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'code': 500, 'message': f'查询时发生内部错误: {str(e)}'}), 500
 
@@ -262,4 +236,36 @@ def get_patient_detail():
     if not patient:
         return jsonify({'code': 404, 'message': '病人不存在'}), 404
     
-    return jsonify({'code': 200, 'message': '查询成功', 'data': patient.to_dict()})
\ No newline at end of file
+    return jsonify({'code': 200, 'message': '查询成功', 'data': patient.to_dict()})
+
+
+@patient_bp.route('/api/patient/search', methods=['GET'])
+@utils.jwtauth.jwt_required
+def search_records():
+    """
+    检索病人或病历，结果按相关度排序并分页 (page / per_page，默认每页20条，最多100条)。
+
+    请求参数:
+    - q: 查询串，汉字按任意位置的子串匹配，不需要分词
+    - type: patient (默认) 按病人姓名检索；case 在医生所属医院的病历中按主诉、诊断检索，诊断命中的权重更高
+    返回的每条记录附带 score 相关度分数，病历另附 patient_name。
+    """
+    q = (request.args.get('q') or '').strip()
+    doc_type = request.args.get('type', 'patient')
+    if not q:
+        return jsonify({'code': 400, 'message': '缺少必要参数: q'}), 400
+    if doc_type not in ('patient', 'case'):
+        return jsonify({'code': 400, 'message': 'type 只能是 patient 或 case'}), 400
+
+    page, per_page = page_args()
+    try:
+        if doc_type == 'patient':
+            results, pagination = search_patients(q, page, per_page)
+            data = [dict(patient.to_dict(), score=score) for patient, score in results]
+        else:
+            results, pagination = search_cases(q, request.user_id, page, per_page)
+            data = [dict(case.to_dict(), patient_name=patient_name, score=score)
+                    for case, patient_name, score in results]
+        return jsonify({'code': 200, 'message': '查询成功', 'data': data, 'pagination': pagination})
+    except Exception as e:
+        return jsonify({'code': 500, 'message': f'查询时发生内部错误: {str(e)}'}), 500
@@ -0,0 +1,80 @@
+from sqlalchemy import func
+from models import db, Image, SliceManifest
+from utils.oss import custom_endpoint
+
+
+def manifest_preview_keys(image_ids):
+    """
+    返回使用切片清单的3D影像的预览图OSS键 {影像ID: 键}，与逐张切片记录时一样取 x 方向第一张。
+    """
+    if not image_ids:
+        return {}
+    manifests = SliceManifest.query.filter(
+        SliceManifest.image_id.in_(image_ids), SliceManifest.direction == 'x', SliceManifest.count > 0
+    ).all()
+    return {m.image_id: m.key(0) for m in manifests}
+
+
+def first_children(image_ids):
+    """
+    一次查询取出每个影像ID最早创建的子影像 {影像ID: (子影像ID, OSS键)}。
+    2D DICOM/NII 的子影像是预览图，逐张记录切片的3D影像的第一个子影像是 x 方向第一张切片。
+    """
+    if not image_ids:
+        return {}
+    first_child = db.session.query(
+        Image.parent_image_id.label('parent_id'), func.min(Image.id).label('child_id')
+    ).filter(Image.parent_image_id.in_(image_ids)).group_by(Image.parent_image_id).subquery()
+    rows = db.session.query(first_child.c.parent_id, Image.id, Image.oss_key).join(
+        Image, Image.id == first_child.c.child_id)
+    return {parent_id: (child_id, oss_key) for parent_id, child_id, oss_key in rows}
+
+
+def resolve_previews(images):
+    """
+    从子影像和切片清单中查找一批主影像的预览 {影像ID: (预览子影像ID, OSS键)}，查询次数与影像数量无关:
+    - picture: 自身
+    - 使用切片清单的3D影像: 清单中 x 方向第一张切片 (没有切片记录，子影像ID为空)
+    - 其他 DICOM/NII: 最早创建的子影像；没有子影像时不返回
+    入库时据此写入 preview_image_id / preview_key，列表接口只在这两列为空时 (旧数据) 才需要调用。
+    """
+    previews = {image.id: (None, image.oss_key) for image in images if image.format == 'picture'}
+    manifest_keys = manifest_preview_keys([image.id for image in images if image.dim == '3D'])
+    previews.update((image_id, (None, key)) for image_id, key in manifest_keys.items())
+    pending = [image.id for image in images if image.format in ('dicom', 'nii') and image.id not in manifest_keys]
+    previews.update(first_children(pending))
+    return previews
+
+
+def update_preview(image):
+    """按当前的子影像和切片清单重新写入主影像的预览指针 (不提交)，返回是否找到了预览"""
+    preview_image_id, preview_key = resolve_previews([image]).get(image.id, (None, None))
+    image.preview_image_id, image.preview_key = preview_image_id, preview_key
+    return preview_key is not None
+
+
+def preview_keys(images):
+    """
+    批量取得一页主影像的预览图OSS键 {影像ID: 键}。
+    优先使用入库时写入的 preview_key；尚未回填的旧影像再批量查找，仍找不到时退回原始文件。
+    """
+    keys = {image.id: image.preview_key or image.oss_key for image in images}
+    missing = [image for image in images if not image.preview_key]
+    if missing:
+        keys.update((image_id, key) for image_id, (_, key) in resolve_previews(missing).items())
+    return keys
+
+
+def preview_urls(images):
+    """批量取得一页主影像的预览图URL {影像ID: URL}"""
+    return {image_id: f"{custom_endpoint}/{key}" for image_id, key in preview_keys(images).items()}
+
+
+def thumbnail_urls(images, previews):
+    """
+    批量取得一页主影像的缩略图URL {影像ID: URL}，不产生额外查询。
+    还没有缩略图的影像 (旧数据或生成失败) 使用 previews 中的预览图URL。
+    """
+    urls = dict(previews)
+    urls.update((image.id, f"{custom_endpoint}/{image.thumbnail_key}") for image in images if image.thumbnail_key)
+    return urls
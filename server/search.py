@@ -0,0 +1,170 @@
+from flask import request
+from sqlalchemy import event, inspect, select, and_, or_, case, func
+from models import db, Patient, Case, Office, DoctorHospital, SearchGram
+from utils.ngrams import index_grams, query_terms
+
+# 参与检索的字段及其打分权重
+FIELDS = {
+    'patient': {'name': 3},
+    'case': {'diagnosis': 2, 'chief_complaint': 1},
+}
+MODELS = {'patient': Patient, 'case': Case}
+MAX_PER_PAGE = 100
+
+
+def _gram_rows(doc_type, doc_id, values):
+    return [
+        {'gram': gram, 'doc_type': doc_type, 'doc_id': doc_id, 'field': field, 'tf': tf}
+        for field, text in values.items()
+        for gram, tf in index_grams(text).items()
+    ]
+
+
+def _reindex(connection, doc_type, doc_id, values):
+    """在当前事务中重写一条记录若干字段的词元，values 为 {字段: 文本}，文本为 None 时只清除"""
+    table = SearchGram.__table__
+    connection.execute(table.delete().where(
+        table.c.doc_type == doc_type, table.c.doc_id == doc_id, table.c.field.in_(list(values))))
+    rows = _gram_rows(doc_type, doc_id, values)
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def _indexed(doc_type):
+    """按记录类型生成插入、修改、删除时维护索引的事件处理函数，修改时只重写变化了的字段"""
+    fields = FIELDS[doc_type]
+
+    def inserted(mapper, connection, target):
+        _reindex(connection, doc_type, target.id, {field: getattr(target, field) for field in fields})
+
+    def updated(mapper, connection, target):
+        state = inspect(target)
+        changed = {field: getattr(target, field) for field in fields if state.attrs[field].history.has_changes()}
+        if changed:
+            _reindex(connection, doc_type, target.id, changed)
+
+    def deleted(mapper, connection, target):
+        _reindex(connection, doc_type, target.id, dict.fromkeys(fields))
+    return inserted, updated, deleted
+
+
+for _doc_type, _model in MODELS.items():
+    for _event, _handler in zip(('after_insert', 'after_update', 'after_delete'), _indexed(_doc_type)):
+        event.listen(_model, _event, _handler)
+
+
+def _term_condition(term):
+    if len(term) == 1:
+        # 单字匹配以该字开头的词元，写成区间以便在词元索引上做范围扫描
+        return and_(SearchGram.gram >= term, SearchGram.gram < chr(ord(term) + 1))
+    return SearchGram.gram == term
+
+
+def matches(doc_type, q):
+    """
+    命中查询串的记录及其分数的子查询 (doc_id, score)，查询串中没有可检索的文字时返回 None。
+    记录的某个字段包含查询串的全部词元即为命中；分数为各命中字段的 权重 × 词元出现次数 之和。
+    二元组全部出现不保证原文连续出现，需要精确子串匹配时由调用方再加条件筛选。
+    """
+    terms = query_terms(q)
+    if not terms:
+        return None
+    weights = FIELDS[doc_type]
+    conditions = [_term_condition(term) for term in terms]
+    matched_term = case(*[(condition, i) for i, condition in enumerate(conditions)])
+    per_field = select(
+        SearchGram.doc_id, SearchGram.field, func.sum(SearchGram.tf).label('hits')
+    ).where(
+        SearchGram.doc_type == doc_type, or_(*conditions)
+    ).group_by(SearchGram.doc_id, SearchGram.field).having(
+        func.count(func.distinct(matched_term)) == len(terms)
+    ).subquery()
+    weight = case(*[(per_field.c.field == field, value) for field, value in weights.items()], else_=0)
+    return select(
+        per_field.c.doc_id, func.sum(weight * per_field.c.hits).label('score')
+    ).group_by(per_field.c.doc_id).subquery()
+
+
+def page_args(default_per_page=20):
+    """检索结果按相关度排序，只支持页码分页，每页条数有上限"""
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', default_per_page, type=int), 1), MAX_PER_PAGE)
+    return page, per_page
+
+
+def _page_info(page, per_page, has_next=False):
+    return {'page': page, 'per_page': per_page, 'has_next': has_next, 'has_prev': page > 1}
+
+
+def _page(query, page, per_page):
+    """多取一条判断是否还有下一页，不统计总数"""
+    rows = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    return rows[:per_page], _page_info(page, per_page, len(rows) > per_page)
+
+
+def search_patients(q, page=1, per_page=20):
+    """按姓名检索病人，姓名与查询串完全相同的排在最前，其余按分数排序。返回 ([(病人, 分数)], 分页信息)"""
+    hits = matches('patient', q)
+    if hits is None:
+        return [], _page_info(page, per_page)
+    query = db.session.query(Patient, hits.c.score).join(hits, Patient.id == hits.c.doc_id).order_by(
+        case((Patient.name == q, 1), else_=0).desc(), hits.c.score.desc(), Patient.id.desc())
+    return _page(query, page, per_page)
+
+
+def search_cases(q, doctor_id, page=1, per_page=20):
+    """
+    在医生所属医院的病历中按主诉和诊断检索，按分数排序。返回 ([(病历, 病人姓名, 分数)], 分页信息)
+    """
+    hits = matches('case', q)
+    if hits is None:
+        return [], _page_info(page, per_page)
+    hospital_ids = select(DoctorHospital.hosp_id).where(DoctorHospital.doc_id == doctor_id)
+    query = db.session.query(Case, Patient.name, hits.c.score).join(
+        hits, Case.id == hits.c.doc_id
+    ).join(Office, Case.office_id == Office.id).join(Patient, Case.patient_id == Patient.id).filter(
+        Office.hospital_id.in_(hospital_ids)
+    ).order_by(hits.c.score.desc(), Case.created_at.desc(), Case.id.desc())
+    return _page(query, page, per_page)
+
+
+def patient_name_filter(name):
+    """
+    病历按病人姓名模糊筛选的条件: 先用索引取出候选病人，再在候选中精确匹配子串，
+    不再对病人表做 LIKE '%姓名%' 全表扫描。查询串中没有可检索的文字时退回子串匹配。
+    需要与 Patient 连接的查询。
+    """
+    hits = matches('patient', name)
+    if hits is None:
+        return Patient.name.contains(name)
+    return and_(Case.patient_id.in_(select(hits.c.doc_id)), Patient.name.contains(name))
+
+
+def rebuild_search_index(batch_size=1000):
+    """
+    从病人和病历表整体重建检索索引 (在一个事务中先删后写)，用于首次启用或修正绕过ORM的修改造成的偏差。
+    返回写入的索引行数。
+    """
+    table = SearchGram.__table__
+    total = 0
+    try:
+        db.session.execute(table.delete())
+        for doc_type, model in MODELS.items():
+            fields = list(FIELDS[doc_type])
+            last_id = 0
+            while True:
+                batch = db.session.query(model.id, *[getattr(model, field) for field in fields]).filter(
+                    model.id > last_id).order_by(model.id).limit(batch_size).all()
+                if not batch:
+                    break
+                rows = [row for doc_id, *values in batch
+                        for row in _gram_rows(doc_type, doc_id, dict(zip(fields, values)))]
+                if rows:
+                    db.session.execute(table.insert(), rows)
+                total += len(rows)
+                last_id = batch[-1][0]
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return total
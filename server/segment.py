@@ -0,0 +1,257 @@
+import re
+import traceback
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from sqlalchemy import and_, or_, not_
+from requests.adapters import HTTPAdapter
+from models import db, SegJob, ImageSeg
+from utils.oss import custom_endpoint, read_from_oss, signed_url
+from utils.slice_cache import slice_cache
+
+
+class SegQueue:
+    """
+    AI分割任务队列。分割接口只登记任务，由这里按并发上限调用AI预测服务，避免长时间占用Web工作进程。
+
+    通过 app.config['SEG_BACKEND'] 选择执行方式：
+    - 'local': 进程内线程池 (默认)，同时调用AI服务的任务数不超过 SEG_CONCURRENCY
+    - 'inline': 在当前请求中同步执行，用于测试和调试
+    - 'rq': 投递到 Redis Queue 的 hidoc_seg 队列，由独立的 rq worker 进程执行，
+      此时并发数即该队列的 worker 数，多个Web进程共用同一个上限
+    SEG_CONCURRENCY 应与AI服务能同时处理的请求数一致；'local' 模式下该上限按进程计算。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.http = None
+        self._executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEG_BACKEND', 'local')
+        app.config.setdefault('SEG_CONCURRENCY', 2)
+        app.config.setdefault('SEG_PREDICT_URL', 'http://localhost:6006/predict')
+        app.config.setdefault('SEG_PREDICT_TIMEOUT', 60)
+        # 原图的来源，见 IMAGE_SOURCES
+        app.config.setdefault('SEG_IMAGE_SOURCE', 'cache')
+        # 'url' 来源交给AI服务的签名地址有效期 (秒)
+        app.config.setdefault('SEG_SIGNED_URL_EXPIRES', 600)
+        # 'cdn' 来源下载原图的地址前缀和超时
+        app.config.setdefault('SEG_IMAGE_BASE_URL', custom_endpoint)
+        app.config.setdefault('SEG_FETCH_TIMEOUT', 10)
+        # 每个医生同时排队和执行中的任务数上限，超过时拒绝新的提交
+        app.config.setdefault('SEG_MAX_PENDING', 5)
+        # 执行中超过该秒数没有更新、或排队超过 SEG_QUEUE_TIMEOUT 秒的任务视为已中断 (例如进程重启)，
+        # 不再计入排队数，查询状态时标记为失败
+        app.config.setdefault('SEG_STALE_AFTER', 300)
+        app.config.setdefault('SEG_QUEUE_TIMEOUT', 1800)
+        app.config.setdefault('SEG_REDIS_URL', 'redis://localhost:6379/0')
+        if app.config['SEG_IMAGE_SOURCE'] not in IMAGE_SOURCES:
+            raise ValueError(f"未知的分割原图来源: {app.config['SEG_IMAGE_SOURCE']}")
+        # 调用AI服务复用 keep-alive 连接，连接池大小与并发上限一致
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=app.config['SEG_CONCURRENCY'])
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        app.extensions['seg_queue'] = self
+        self.app = app
+
+    def submit(self, job_id):
+        """投递一个已入库的分割任务"""
+        backend = self.app.config['SEG_BACKEND']
+        if backend == 'inline':
+            run_seg_job(job_id)
+        elif backend == 'rq':
+            # 仅在启用持久化队列时才需要安装 redis 和 rq
+            from redis import Redis
+            from rq import Queue
+            queue = Queue('hidoc_seg', connection=Redis.from_url(self.app.config['SEG_REDIS_URL']))
+            queue.enqueue('segment.run_queued_seg_job', job_id,
+                          job_timeout=self.app.config['SEG_PREDICT_TIMEOUT'] + self.app.config['SEG_FETCH_TIMEOUT'] + 60)
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.app.config['SEG_CONCURRENCY'],
+                    thread_name_prefix='hidoc-seg'
+                )
+            self._executor.submit(self._run_in_context, job_id)
+
+    def _run_in_context(self, job_id):
+        with self.app.app_context():
+            run_seg_job(job_id)
+
+    def recover(self):
+        """
+        进程启动时恢复 'local' 模式下随上一个进程丢失的任务: 已中断的任务标记为失败，仍在排队的重新投递。
+        任务开始执行时会原子地认领，多个进程重复投递同一任务也只执行一次。需要在应用上下文中调用；
+        不经 app.py 启动时 (例如 gunicorn) 在工作进程的初始化钩子中调用。
+        返回 (重新投递数, 标记失败数)
+        """
+        if self.app.config['SEG_BACKEND'] != 'local':
+            return 0, 0
+        failed = expire_stale_jobs()
+        job_ids = [job_id for job_id, in db.session.query(SegJob.id).filter(
+            SegJob.status == 'queued').order_by(SegJob.id)]
+        for job_id in job_ids:
+            self.submit(job_id)
+        return len(job_ids), failed
+
+
+seg_queue = SegQueue()
+
+
+class SegError(Exception):
+    """下载原图或调用AI服务失败，错误信息会记录到任务上"""
+
+
+def run_queued_seg_job(job_id):
+    """rq worker 的入口，worker 进程中需要自行创建应用上下文"""
+    from app import app
+    with app.app_context():
+        run_seg_job(job_id)
+
+
+def _stale():
+    """已中断的任务: 执行中长时间没有更新，或排队时间过长"""
+    config, now = seg_queue.app.config, datetime.now()
+    return or_(
+        and_(SegJob.status == 'running', SegJob.updated_at < now - timedelta(seconds=config['SEG_STALE_AFTER'])),
+        and_(SegJob.status == 'queued', SegJob.created_at < now - timedelta(seconds=config['SEG_QUEUE_TIMEOUT']))
+    )
+
+
+# SegJob 与 ImageSeg 一样有名为 query 的字段，覆盖了 Model.query，这里统一通过 db.session 查询
+def pending_count(creator_id):
+    """医生排队和执行中的分割任务数，已中断的任务不计入"""
+    return db.session.query(SegJob).filter(
+        SegJob.creator_id == creator_id, SegJob.status.in_(('queued', 'running')), not_(_stale())
+    ).count()
+
+
+def expire_stale_jobs(job_id=None):
+    """把已中断的任务 (或其中指定的一个) 标记为失败，返回标记的任务数"""
+    query = db.session.query(SegJob).filter(_stale())
+    if job_id is not None:
+        query = query.filter(SegJob.id == job_id)
+    try:
+        count = query.update({'status': 'failed', 'error': '任务已中断，请重新提交'}, synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return count
+
+
+def queue_position(job):
+    """排队中的任务前面还有多少个排队任务"""
+    if job.status != 'queued':
+        return 0
+    return db.session.query(SegJob).filter(SegJob.status == 'queued', SegJob.id < job.id).count()
+
+
+def normalize_reasoning(raw_reasoning):
+    """规范化AI模型输出的文本，去除序号和括号间的空格，以匹配前端解析规则"""
+    if not raw_reasoning:
+        return raw_reasoning
+    return re.sub(r'(\d+)\.\s+【', r'\1.【', raw_reasoning)
+
+
+def _image_file(image, content):
+    # 文件名取 oss_key 的最后一段
+    return {'files': {'image': (image.oss_key.split('/')[-1], content, 'application/octet-stream')}}
+
+
+def _image_from_cache(image, config):
+    """最近上传或浏览过的影像直接读本地缓存的原始文件，否则经OSS SDK下载一次并留在缓存中"""
+    with open(slice_cache.fetch_original(image.oss_key), 'rb') as f:
+        return _image_file(image, f.read())
+
+
+def _image_from_storage(image, config):
+    """经OSS SDK从 bucket 所在地域的 endpoint 直接读取原图，不经过CDN"""
+    return _image_file(image, read_from_oss(image.oss_key))
+
+
+def _image_from_url(image, config):
+    """不传原图，只把对象键和签名地址交给AI服务，由AI服务自行下载"""
+    return {'data': {'oss_key': image.oss_key,
+                     'image_url': signed_url(image.oss_key, config['SEG_SIGNED_URL_EXPIRES'])}}
+
+
+def _image_from_cdn(image, config):
+    """从公开的CDN地址下载原图 (早期的方式)"""
+    response = requests.get(f"{config['SEG_IMAGE_BASE_URL']}/{image.oss_key}", timeout=config['SEG_FETCH_TIMEOUT'])
+    response.raise_for_status()
+    return _image_file(image, response.content)
+
+
+# 通过 app.config['SEG_IMAGE_SOURCE'] 选择原图交给AI服务的方式:
+# - 'cache': 本地原始文件缓存，未命中时经OSS SDK下载 (默认)
+# - 'storage': 每次经OSS SDK读取
+# - 'url': 只传对象键和OSS endpoint上的签名地址，需要AI服务支持 image_url 参数且能访问该 endpoint
+# - 'cdn': 从CDN下载后再上传给AI服务
+IMAGE_SOURCES = {
+    'cache': _image_from_cache,
+    'storage': _image_from_storage,
+    'url': _image_from_url,
+    'cdn': _image_from_cdn,
+}
+
+
+def predict(image, query):
+    """按配置的来源取得原图并调用AI预测服务，返回服务的JSON结果"""
+    config = seg_queue.app.config
+    try:
+        payload = IMAGE_SOURCES[config['SEG_IMAGE_SOURCE']](image, config)
+    except Exception as e:
+        raise SegError(f'获取影像失败: {e}') from e
+
+    try:
+        predict_response = seg_queue.http.post(
+            config['SEG_PREDICT_URL'], files=payload.get('files'),
+            data={'query': query, **payload.get('data', {})}, timeout=config['SEG_PREDICT_TIMEOUT'])
+        predict_response.raise_for_status()
+        return predict_response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        raise SegError(f'调用AI服务失败: {e}') from e
+
+
+def run_seg_job(job_id):
+    """
+    执行一个分割任务: 调用AI服务，结果落地后创建 ImageSeg 记录并关联到任务。
+    失败时任务标记为 failed 并记录原因。需要在应用上下文中调用。
+    """
+    # 原子地认领排队中的任务，重复投递 (例如启动恢复与原进程同时投递) 时只有一次执行
+    claimed = db.session.query(SegJob).filter(SegJob.id == job_id, SegJob.status == 'queued').update(
+        {'status': 'running', 'updated_at': datetime.now()}, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return
+    job = db.session.get(SegJob, job_id)
+    try:
+        predict_data = predict(job.image, job.query)
+        if not predict_data.get('oss_key'):
+            raise SegError('AI服务没有返回分割结果')
+        seg = ImageSeg(
+            image_id=job.image_id,
+            creator_id=job.creator_id,
+            query=job.query,
+            reasoning=normalize_reasoning(predict_data.get('result', '')),
+            oss_key=predict_data['oss_key']
+        )
+        db.session.add(seg)
+        db.session.flush()
+        job.seg_id = seg.id
+        job.status = 'succeeded'
+        db.session.commit()
+    except Exception as e:
+        if not isinstance(e, SegError):
+            traceback.print_exc()
+        db.session.rollback()
+        job = db.session.get(SegJob, job_id)
+        if job:
+            job.status = 'failed'
+            job.error = str(e)
+            db.session.commit()
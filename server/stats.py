@@ -0,0 +1,310 @@
+from datetime import date, datetime, timedelta
+from collections import Counter
+from sqlalchemy import event, inspect, select, and_, func, literal, case
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from models import db, Case, Office, Image, ImageSeg, AiAdvice, DashboardCounter
+
+# 不区分医院的指标 (AI分割、AI辅诊) 登记在该医院ID下
+ANY_HOSPITAL = 0
+TOTAL = 'total'
+# 首页折线图覆盖的天数 (含今天)
+RECENT_DAYS = 7
+
+
+def _period(created_at):
+    """记录创建时间所在的统计日"""
+    return (created_at or datetime.now()).date().isoformat()
+
+
+def _bump(connection, doctor_id, hospital_id, metric, periods, delta):
+    """
+    在当前事务中把计数器加上 delta，计数器行不存在时插入。
+    并发插入同一行时唯一约束冲突，回到 UPDATE 重试一次。
+    """
+    table = DashboardCounter.__table__
+    for period in periods:
+        key = and_(table.c.doctor_id == doctor_id, table.c.hospital_id == hospital_id,
+                   table.c.metric == metric, table.c.period == period)
+        increment = table.update().where(key).values(value=table.c.value + delta)
+        if connection.execute(increment).rowcount:
+            continue
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(
+                    doctor_id=doctor_id, hospital_id=hospital_id, metric=metric, period=period, value=delta))
+        except IntegrityError:
+            connection.execute(increment)
+
+
+def _office_hospital(connection, office_id):
+    return connection.scalar(select(Office.hospital_id).where(Office.id == office_id))
+
+
+def _case_count(connection, doctor_id, patient_id, hospital_id):
+    """医生在该医院该病人的病历数"""
+    return connection.scalar(
+        select(func.count(Case.id)).join(Office, Case.office_id == Office.id).where(
+            Case.doctor_id == doctor_id, Case.patient_id == patient_id, Office.hospital_id == hospital_id
+        )
+    )
+
+
+def _count_case(target, connection, doctor_id, patient_id, office_id, created_at, delta):
+    """
+    病历计入 (delta=1) 或移出 (delta=-1) 某家医院的统计。
+    病人数按 (医生, 医院) 去重，先在会话中累计每个 (医生, 病人, 医院) 的病历数变化，
+    等本次 flush 的语句全部执行后再由 _count_patients 统一判断病人是否新增或移出:
+    同一次 flush 中的多份病历在 after_insert/after_delete 时彼此可见，逐条判断会重复计数。
+    """
+    hospital_id = _office_hospital(connection, office_id)
+    if hospital_id is None:
+        return
+    _bump(connection, doctor_id, hospital_id, 'cases', (TOTAL, _period(created_at)), delta)
+    session = inspect(target).session
+    if session is not None:
+        session.info.setdefault('stats_patient_changes', Counter())[(doctor_id, patient_id, hospital_id)] += delta
+
+
+def _load_old_value(target, value, oldvalue, initiator):
+    return value
+
+
+# 修改已过期的属性时默认不加载原值，history 中就没有旧值；打开 active_history 让移出原统计时能取到旧值
+for _attribute in (Case.doctor_id, Case.patient_id, Case.office_id, Office.hospital_id):
+    event.listen(_attribute, 'set', _load_old_value, active_history=True, retval=True)
+
+
+@event.listens_for(Case, 'after_insert')
+def _case_inserted(mapper, connection, target):
+    _count_case(target, connection, target.doctor_id, target.patient_id, target.office_id, target.created_at, 1)
+
+
+@event.listens_for(Case, 'after_delete')
+def _case_deleted(mapper, connection, target):
+    _count_case(target, connection, target.doctor_id, target.patient_id, target.office_id, target.created_at, -1)
+
+
+@event.listens_for(Case, 'after_update')
+def _case_updated(mapper, connection, target):
+    """病历换了科室、医生或病人时，从原来的统计中移出，再计入新的统计"""
+    state = inspect(target)
+    keys = ('doctor_id', 'patient_id', 'office_id')
+    if not any(state.attrs[key].history.has_changes() for key in keys):
+        return
+    old = {}
+    for key in keys:
+        history = state.attrs[key].history
+        old[key] = history.deleted[0] if history.deleted else getattr(target, key)
+    _count_case(target, connection, old['doctor_id'], old['patient_id'], old['office_id'], target.created_at, -1)
+    _count_case(target, connection, target.doctor_id, target.patient_id, target.office_id, target.created_at, 1)
+
+
+@event.listens_for(Session, 'after_flush')
+def _count_patients(session, flush_context):
+    """
+    本次 flush 的语句全部执行后，按 (医生, 病人, 医院) 比较病历数变化前后是否为0，
+    病人在该医院从无到有时病人数加一，从有到无时减一
+    """
+    changes = session.info.pop('stats_patient_changes', None)
+    if not changes:
+        return
+    connection = session.connection()
+    for (doctor_id, patient_id, hospital_id), delta in changes.items():
+        if not delta:
+            continue
+        after = _case_count(connection, doctor_id, patient_id, hospital_id)
+        change = (after > 0) - (after - delta > 0)
+        if change:
+            _bump(connection, doctor_id, hospital_id, 'patients', (TOTAL,), change)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_patient_changes(session):
+    session.info.pop('stats_patient_changes', None)
+
+
+def _set_patients(connection, doctor_id, hospital_id):
+    """按业务表重算医生在某家医院的去重病人数"""
+    value = connection.scalar(
+        select(func.count(func.distinct(Case.patient_id))).join(Office, Case.office_id == Office.id).where(
+            Case.doctor_id == doctor_id, Office.hospital_id == hospital_id
+        )
+    )
+    table = DashboardCounter.__table__
+    current = connection.scalar(select(table.c.value).where(
+        table.c.doctor_id == doctor_id, table.c.hospital_id == hospital_id,
+        table.c.metric == 'patients', table.c.period == TOTAL))
+    if value != (current or 0):
+        _bump(connection, doctor_id, hospital_id, 'patients', (TOTAL,), value - (current or 0))
+
+
+@event.listens_for(Office, 'after_update')
+def _office_moved(mapper, connection, target):
+    """科室换了医院时，科室下的全部病历随之从原医院的统计移到新医院，涉及医生的病人数在两家医院重算"""
+    history = inspect(target).attrs.hospital_id.history
+    if not history.deleted or history.deleted[0] == target.hospital_id:
+        return
+    old_hospital_id, new_hospital_id = history.deleted[0], target.hospital_id
+    case_day = func.date(Case.created_at)
+    rows = connection.execute(
+        select(Case.doctor_id, case_day, func.count(Case.id)).where(
+            Case.office_id == target.id).group_by(Case.doctor_id, case_day)
+    ).all()
+    for doctor_id, day, value in rows:
+        # func.date 在 SQLite 中返回字符串，在 MySQL 中返回 date
+        day = day.isoformat() if isinstance(day, date) else str(day)[:10]
+        _bump(connection, doctor_id, old_hospital_id, 'cases', (TOTAL, day), -value)
+        _bump(connection, doctor_id, new_hospital_id, 'cases', (TOTAL, day), value)
+    for doctor_id in {row[0] for row in rows}:
+        for hospital_id in (old_hospital_id, new_hospital_id):
+            _set_patients(connection, doctor_id, hospital_id)
+
+
+def _counted(metric):
+    """按创建者和创建日统计不区分医院的指标"""
+    def inserted(mapper, connection, target):
+        _bump(connection, target.creator_id, ANY_HOSPITAL, metric, (TOTAL, _period(target.created_at)), 1)
+
+    def deleted(mapper, connection, target):
+        _bump(connection, target.creator_id, ANY_HOSPITAL, metric, (TOTAL, _period(target.created_at)), -1)
+    return inserted, deleted
+
+
+for _model, _metric in ((ImageSeg, 'ai_segs'), (AiAdvice, 'ai_advices')):
+    _inserted, _deleted = _counted(_metric)
+    event.listen(_model, 'after_insert', _inserted)
+    event.listen(_model, 'after_delete', _deleted)
+
+
+def dashboard(doctor_id, hospital_id, today=None):
+    """
+    一次查询读取首页统计: 每个指标的全部累计和最近 RECENT_DAYS 天的计数行，最多几十行，走唯一索引。
+    """
+    today = today or date.today()
+    days = [(today - timedelta(days=RECENT_DAYS - 1 - i)).isoformat() for i in range(RECENT_DAYS)]
+    rows = db.session.query(DashboardCounter.metric, DashboardCounter.period, DashboardCounter.value).filter(
+        DashboardCounter.doctor_id == doctor_id,
+        DashboardCounter.hospital_id.in_((hospital_id, ANY_HOSPITAL)),
+        DashboardCounter.period.in_([TOTAL] + days)
+    ).all()
+    values = {(metric, period): value for metric, period, value in rows}
+    return {
+        'total_cases': values.get(('cases', TOTAL), 0),
+        'today_cases': values.get(('cases', days[-1]), 0),
+        'total_patients': values.get(('patients', TOTAL), 0),
+        'ai_seg': values.get(('ai_segs', TOTAL), 0),
+        'today_ai_seg': values.get(('ai_segs', days[-1]), 0),
+        'ai_advice': values.get(('ai_advices', TOTAL), 0),
+        'today_ai_advice': values.get(('ai_advices', days[-1]), 0),
+        'recent_cases': [{'日期': day, '数量': values.get(('cases', day), 0)} for day in days]
+    }
+
+
+def _day_range(day):
+    """统计日对应的半开时间区间 [当天0点, 次日0点)，直接与 created_at 比较，可以使用该列上的索引"""
+    start = datetime.combine(day, datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+def _count_between(column, start, end):
+    """条件聚合: 统计 column 落在 [start, end) 内的行数"""
+    return func.coalesce(func.sum(case((and_(column >= start, column < end), 1), else_=0)), 0)
+
+
+def live_dashboard(doctor_id, hospital_id, today=None):
+    """
+    直接从业务表聚合首页统计，返回与 dashboard() 相同的结构，用于计数器尚未建立 (或需要核对) 的场景。
+
+    - 日期条件都写成 created_at 上的半开区间，不对列套 func.date()，created_at 上的索引仍然可用
+    - 病历的累计、去重病人数、今天和最近每天的数量在一次条件聚合 (SUM(CASE WHEN ...)) 中算出
+    - AI分割和AI辅诊的累计与今天的数量作为两个标量子查询，在第二次查询中一并读出
+    """
+    today = today or date.today()
+    days = [today - timedelta(days=RECENT_DAYS - 1 - i) for i in range(RECENT_DAYS)]
+    ranges = [_day_range(day) for day in days]
+    today_start, tomorrow = ranges[-1]
+
+    cases = db.session.query(
+        func.count(Case.id),
+        func.count(func.distinct(Case.patient_id)),
+        *[_count_between(Case.created_at, start, end) for start, end in ranges]
+    ).join(Office, Case.office_id == Office.id).filter(
+        Case.doctor_id == doctor_id,
+        Office.hospital_id == hospital_id
+    ).one()
+    total_cases, total_patients, daily = cases[0], cases[1], [int(value) for value in cases[2:]]
+
+    def totals(query, column):
+        return (query.with_entities(func.count()).scalar_subquery(),
+                query.with_entities(_count_between(column, today_start, tomorrow)).scalar_subquery())
+
+    segs = totals(db.session.query(ImageSeg).join(Image, ImageSeg.image_id == Image.id)
+                  .filter(ImageSeg.creator_id == doctor_id), ImageSeg.created_at)
+    advices = totals(db.session.query(AiAdvice).filter(AiAdvice.creator_id == doctor_id), AiAdvice.created_at)
+    ai_seg, today_ai_seg, ai_advice, today_ai_advice = (int(value or 0) for value in db.session.execute(
+        select(*segs, *advices)).one())
+
+    return {
+        'total_cases': total_cases,
+        'today_cases': daily[-1],
+        'total_patients': total_patients,
+        'ai_seg': ai_seg,
+        'today_ai_seg': today_ai_seg,
+        'ai_advice': ai_advice,
+        'today_ai_advice': today_ai_advice,
+        'recent_cases': [{'日期': day.isoformat(), '数量': value} for day, value in zip(days, daily)]
+    }
+
+
+def _daily(query):
+    """把 (医生, 医院, 日期, 计数) 的分组结果展开为每天一行和累计一行"""
+    counts = Counter()
+    for doctor_id, hospital_id, day, value in query:
+        # func.date 在 SQLite 中返回字符串，在 MySQL 中返回 date
+        day = day.isoformat() if isinstance(day, date) else str(day)[:10]
+        counts[(doctor_id, hospital_id, day)] += value
+        counts[(doctor_id, hospital_id, TOTAL)] += value
+    return counts
+
+
+def rebuild_counters():
+    """
+    从业务表整体重算所有计数器 (在一个事务中先删后写)，用于首次启用或修正绕过ORM的修改造成的偏差。
+    返回写入的计数器行数。
+    """
+    case_day = func.date(Case.created_at)
+    seg_day = func.date(ImageSeg.created_at)
+    advice_day = func.date(AiAdvice.created_at)
+    metrics = {
+        'cases': _daily(db.session.query(Case.doctor_id, Office.hospital_id, case_day, func.count(Case.id))
+                        .join(Office, Case.office_id == Office.id)
+                        .group_by(Case.doctor_id, Office.hospital_id, case_day)),
+        'patients': Counter({
+            (doctor_id, hospital_id, TOTAL): value for doctor_id, hospital_id, value in
+            db.session.query(Case.doctor_id, Office.hospital_id, func.count(func.distinct(Case.patient_id)))
+            .join(Office, Case.office_id == Office.id)
+            .group_by(Case.doctor_id, Office.hospital_id)
+        }),
+        'ai_segs': _daily(db.session.query(ImageSeg.creator_id, literal(ANY_HOSPITAL), seg_day,
+                                           func.count(ImageSeg.id))
+                          .join(Image, ImageSeg.image_id == Image.id)
+                          .group_by(ImageSeg.creator_id, seg_day)),
+        'ai_advices': _daily(db.session.query(AiAdvice.creator_id, literal(ANY_HOSPITAL), advice_day,
+                                              func.count(AiAdvice.id))
+                             .group_by(AiAdvice.creator_id, advice_day)),
+    }
+    rows = [
+        {'doctor_id': doctor_id, 'hospital_id': hospital_id, 'metric': metric, 'period': period, 'value': value}
+        for metric, counts in metrics.items()
+        for (doctor_id, hospital_id, period), value in counts.items()
+    ]
+    try:
+        DashboardCounter.query.delete()
+        if rows:
+            db.session.execute(DashboardCounter.__table__.insert(), rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(rows)
@@ -5,8 +5,14 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import pytest
+import bcrypt
 from app import app as flask_app
-from models import db as _db
+from models import db as _db, Doctor
+from utils.jwtauth import JWTAuth
+from utils.oss import MemoryBackend, use_backend, uploader
+from offices import office_trees
+from utils.response_cache import response_cache
+from typeahead import patient_typeahead
 
 
 @pytest.fixture(scope='session')
@@ -17,7 +23,10 @@ def app():
     flask_app.config.update({
         "TESTING": True,
         "SQLALCHEMY_DATABASE_URI": f"sqlite:///{db_path}",
-        "SECRET_KEY": "test_secret_key"
+        "SECRET_KEY": "test_secret_key",
+        # 后台任务在请求内同步执行，便于断言处理结果
+        "INGEST_BACKEND": "inline",
+        "INGEST_WORK_DIR": os.path.join(os.path.dirname(__file__), 'ingest_work')
     })
 
     # 在测试期间禁用CSRF保护
@@ -49,6 +58,10 @@ def db(app):
         for table in reversed(_db.metadata.sorted_tables):
             _db.session.execute(table.delete())
         _db.session.commit()
+        # 直接清表不经过ORM，缓存的科室树、接口响应和病人联想需要手动清空
+        office_trees.clear()
+        response_cache.clear()
+        patient_typeahead.clear()
         
         yield _db
         
@@ -56,4 +69,36 @@ def db(app):
         _db.session.rollback()
         for table in reversed(_db.metadata.sorted_tables):
             _db.session.execute(table.delete())
-        _db.session.commit() 
\ No newline at end of file
+        _db.session.commit()
+
+
+@pytest.fixture()
+def storage(monkeypatch):
+    """用内存存储替代OSS，测试结束后恢复"""
+    backend = MemoryBackend()
+    previous = use_backend(backend)
+    monkeypatch.setattr(uploader, 'backoff', 0)
+    yield backend
+    use_backend(previous)
+
+
+@pytest.fixture()
+def doctor(db):
+    """创建一个测试医生"""
+    test_doctor = Doctor(
+        phone='13800000000',
+        name='测试医生',
+        gender='男',
+        password=bcrypt.hashpw(b'password123', bcrypt.gensalt()).decode('utf-8')
+    )
+    db.session.add(test_doctor)
+    db.session.commit()
+    return test_doctor
+
+
+@pytest.fixture()
+def auth_headers(app, doctor):
+    """测试医生的认证请求头"""
+    with app.app_context():
+        token = JWTAuth.generate_token(doctor.id, doctor.phone)
+    return {'Authorization': f'Bearer {token}'}
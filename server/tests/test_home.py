@@ -0,0 +1,160 @@
+import json
+from datetime import datetime, timedelta
+from models import Hospital, Office, Patient, Case, Image, ImageSeg, AiAdvice, DoctorHospital, DashboardCounter
+from stats import rebuild_counters, live_dashboard
+
+
+def _home_data(client, auth_headers, hospital_id):
+    response = client.get('/api/home/data', headers=auth_headers, query_string={'hospital_id': hospital_id})
+    return json.loads(response.data)['data']
+
+
+def test_home_counters_follow_writes_and_match_rebuild(client, db, doctor, auth_headers):
+    """
+    测试首页统计计数器随病历、AI分割、AI辅诊的写入增量更新，且与整体重算的结果一致
+    """
+    first, second = Hospital(name='第一医院'), Hospital(name='第二医院')
+    patients = [Patient(name='王五', gender='男'), Patient(name='赵六', gender='女')]
+    db.session.add_all([first, second] + patients)
+    db.session.flush()
+    office, other_office = Office(name='放射科', hospital_id=first.id), Office(name='放射科', hospital_id=second.id)
+    db.session.add_all([office, other_office,
+                        DoctorHospital(doc_id=doctor.id, hosp_id=first.id),
+                        DoctorHospital(doc_id=doctor.id, hosp_id=second.id)])
+    db.session.commit()
+    first_id, second_id, office_id, other_office_id = first.id, second.id, office.id, other_office.id
+    patient_ids = [p.id for p in patients]
+
+    # 同一病人两份病历，病人数只计一次
+    for patient_id in (patient_ids[0], patient_ids[0], patient_ids[1]):
+        response = client.post('/api/hospital/case', headers=auth_headers, json={
+            'patient_id': patient_id, 'office_id': office_id, 'case_date': '2024-06-01'
+        })
+        assert response.status_code == 201
+    # 一份历史病历，只计入累计
+    db.session.add(Case(patient_id=patient_ids[1], office_id=office_id, doctor_id=doctor.id,
+                        case_date=datetime(2023, 1, 1).date(), created_at=datetime.now() - timedelta(days=30)))
+    image = Image(name='照片', format='picture', type='其他', dim='2D', creator_id=doctor.id, oss_key='a.png', size=1)
+    db.session.add(image)
+    db.session.flush()
+    db.session.add(ImageSeg(image_id=image.id, creator_id=doctor.id, oss_key='seg.png'))
+    db.session.add(AiAdvice(creator_id=doctor.id, patient_id=patient_ids[0]))
+    db.session.commit()
+
+    data = _home_data(client, auth_headers, first_id)
+    assert (data['total_cases'], data['today_cases'], data['total_patients']) == (4, 3, 2)
+    assert (data['ai_seg'], data['today_ai_seg'], data['ai_advice'], data['today_ai_advice']) == (1, 1, 1, 1)
+    assert data['recent_cases'][-1]['数量'] == 3 and sum(d['数量'] for d in data['recent_cases']) == 3
+    # 直接聚合业务表的结果与计数器一致
+    assert live_dashboard(doctor.id, first_id) == data
+
+    # 病历移到另一家医院的科室: 原医院少一份病历，病人仍有其他病历所以病人数不变
+    moved = Case.query.filter_by(patient_id=patient_ids[0]).first()
+    moved.office_id = other_office_id
+    db.session.commit()
+    first_data, second_data = _home_data(client, auth_headers, first_id), _home_data(client, auth_headers, second_id)
+    assert (first_data['total_cases'], first_data['total_patients']) == (3, 2)
+    assert (second_data['total_cases'], second_data['total_patients']) == (1, 1)
+    assert live_dashboard(doctor.id, second_id) == second_data
+
+    # 删除影像级联删除AI分割
+    db.session.delete(Image.query.get(image.id))
+    db.session.commit()
+    assert _home_data(client, auth_headers, first_id)['ai_seg'] == 0
+
+    incremental = {(c.doctor_id, c.hospital_id, c.metric, c.period): c.value
+                   for c in DashboardCounter.query.all() if c.value}
+    rebuild_counters()
+    rebuilt = {(c.doctor_id, c.hospital_id, c.metric, c.period): c.value for c in DashboardCounter.query.all()}
+    assert incremental == rebuilt
+
+
+def test_home_response_cached_until_own_write(client, db, doctor, auth_headers):
+    """
+    测试首页统计的响应缓存: 重复请求命中缓存，本医生新建病历提交后缓存失效，其他医生的写入不影响
+    """
+    from models import Doctor
+    hospital = Hospital(name='测试医院')
+    patient = Patient(name='王五', gender='男')
+    other = Doctor(phone='13900000000', name='其他医生', gender='女', password='-')
+    db.session.add_all([hospital, patient, other])
+    db.session.flush()
+    office = Office(name='放射科', hospital_id=hospital.id)
+    db.session.add_all([office, DoctorHospital(doc_id=doctor.id, hosp_id=hospital.id)])
+    db.session.commit()
+    hospital_id, office_id, patient_id, other_id = hospital.id, office.id, patient.id, other.id
+
+    def get():
+        response = client.get('/api/home/data', headers=auth_headers, query_string={'hospital_id': hospital_id})
+        return response.headers['X-Cache'], json.loads(response.data)['data']['total_cases']
+
+    assert get() == ('MISS', 0)
+    assert get() == ('HIT', 0)
+
+    db.session.add(Case(patient_id=patient_id, office_id=office_id, doctor_id=other_id,
+                        case_date=datetime(2024, 1, 1).date()))
+    db.session.commit()
+    assert get() == ('HIT', 0)
+
+    response = client.post('/api/hospital/case', headers=auth_headers, json={
+        'patient_id': patient_id, 'office_id': office_id, 'case_date': '2024-06-01'
+    })
+    assert response.status_code == 201
+    assert get() == ('MISS', 1)
+    assert get() == ('HIT', 1)
+
+
+def test_home_patient_counter_with_cases_in_one_flush(client, db, doctor, auth_headers):
+    """
+    测试同一次提交中新增、删除同一病人的多份病历时病人数只计一次，
+    以及科室换医院后病历和病人数随之移动，结果都与整体重算一致
+    """
+    first, second = Hospital(name='第一医院'), Hospital(name='第二医院')
+    patient = Patient(name='王五', gender='男')
+    db.session.add_all([first, second, patient])
+    db.session.flush()
+    office = Office(name='放射科', hospital_id=first.id)
+    db.session.add_all([office, DoctorHospital(doc_id=doctor.id, hosp_id=first.id),
+                        DoctorHospital(doc_id=doctor.id, hosp_id=second.id)])
+    db.session.flush()
+    cases = [Case(patient_id=patient.id, office_id=office.id, doctor_id=doctor.id,
+                  case_date=datetime(2024, 1, 1).date()) for _ in range(2)]
+    db.session.add_all(cases)
+    db.session.commit()
+    first_id, second_id = first.id, second.id
+
+    def counters():
+        return {(c.hospital_id, c.metric, c.period): c.value for c in DashboardCounter.query.all() if c.value}
+
+    data = _home_data(client, auth_headers, first_id)
+    assert (data['total_cases'], data['total_patients']) == (2, 1)
+
+    office.hospital_id = second_id
+    db.session.commit()
+    assert (_home_data(client, auth_headers, first_id)['total_patients'],
+            _home_data(client, auth_headers, second_id)['total_cases'],
+            _home_data(client, auth_headers, second_id)['total_patients']) == (0, 2, 1)
+    incremental = counters()
+    rebuild_counters()
+    assert incremental == counters()
+
+    for case in cases:
+        db.session.delete(case)
+    db.session.commit()
+    assert counters() == {}
+
+
+def test_fill_dashboard_counters_without_cases(db, doctor):
+    """测试升级时只有AI分割而没有病历的库也能建立计数器 (ImageSeg 的 query 列遮住了 Model.query)"""
+    from migrate import fill_dashboard_counters
+    image = Image(name='照片', format='picture', type='其他', dim='2D', creator_id=doctor.id, oss_key='a.png', size=1)
+    db.session.add(image)
+    db.session.flush()
+    db.session.add(ImageSeg(image_id=image.id, creator_id=doctor.id, oss_key='seg.png'))
+    db.session.commit()
+    DashboardCounter.query.delete()
+    db.session.commit()
+
+    assert fill_dashboard_counters()
+    assert {(c.metric, c.period) for c in DashboardCounter.query.all()} >= {('ai_segs', 'total')}
+    assert not fill_dashboard_counters()
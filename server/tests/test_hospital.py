@@ -0,0 +1,309 @@
+import json
+from datetime import date
+import pytest
+from sqlalchemy import update
+from models import Hospital, Office, Patient, Case, DoctorHospital, DoctorOffice
+from offices import OfficeMoveError, office_move_error
+
+
+def _office_with_cases(db, doctor, case_dates):
+    """创建一个科室，并为同一个病人按给定日期创建病历"""
+    hospital = Hospital(name='测试医院')
+    db.session.add(hospital)
+    db.session.flush()
+    office = Office(name='放射科', hospital_id=hospital.id)
+    patient = Patient(name='张三', gender='男')
+    db.session.add_all([office, patient])
+    db.session.flush()
+    for case_date in case_dates:
+        db.session.add(Case(patient_id=patient.id, office_id=office.id, doctor_id=doctor.id, case_date=case_date))
+    db.session.commit()
+    return office
+
+
+def test_cases_by_office_cursor_pagination(client, db, doctor, auth_headers):
+    """
+    测试科室病历列表的游标分页: 就诊日期相同的病历按创建时间和ID稳定排序，翻页不重复不遗漏
+    """
+    office = _office_with_cases(db, doctor, [date(2024, 5, 1)] * 3 + [date(2024, 6, 1)] * 2 + [date(2024, 4, 1)])
+
+    response = client.get('/api/hospital/case', headers=auth_headers,
+                          query_string={'office_id': office.id, 'per_page': 10})
+    body = json.loads(response.data)
+    expected = [case['id'] for case in body['data']]
+    assert body['pagination']['total_items'] == 6
+    assert [case['case_date'] for case in body['data']][:2] == ['2024-06-01'] * 2
+
+    seen, cursor = [], ''
+    while cursor is not None:
+        response = client.get('/api/hospital/case', headers=auth_headers,
+                              query_string={'office_id': office.id, 'per_page': 4, 'cursor': cursor})
+        body = json.loads(response.data)
+        seen += [case['id'] for case in body['data']]
+        cursor = body['pagination']['next_cursor']
+    assert seen == expected
+
+
+def test_cursor_pagination_includes_null_created_at(client, db, doctor, auth_headers):
+    """
+    测试创建时间为空的旧病历在游标翻页时不被跳过，向后、向前翻页的结果都与页码模式一致
+    """
+    office = _office_with_cases(db, doctor, [date(2024, 5, 1)] * 4 + [date(2024, 6, 1)])
+    legacy = [case.id for case in Case.query.filter_by(office_id=office.id).order_by(Case.id)[1:3]]
+    db.session.execute(update(Case).where(Case.id.in_(legacy)).values(created_at=None))
+    db.session.commit()
+
+    def get(**args):
+        response = client.get('/api/hospital/case', headers=auth_headers,
+                              query_string=dict(args, office_id=office.id))
+        body = json.loads(response.data)
+        return [case['id'] for case in body['data']], body['pagination']
+
+    expected = get(per_page=10)[0]
+    assert len(expected) == 5 and set(legacy) <= set(expected)
+
+    pages, cursor = [], ''
+    while cursor is not None:
+        ids, pagination = get(per_page=2, cursor=cursor)
+        pages.append(ids)
+        cursor = pagination['next_cursor']
+    assert sum(pages, []) == expected
+
+    back, cursor = [], pagination['prev_cursor']
+    while cursor is not None:
+        ids, pagination = get(per_page=2, cursor=cursor)
+        back = ids + back
+        cursor = pagination['prev_cursor']
+    assert back + pages[-1] == expected
+
+
+def test_doctor_offices_use_cached_tree_and_invalidate_on_change(client, app, db, doctor, auth_headers, monkeypatch):
+    """
+    测试科室列表返回负责科室的全部子孙科室及父科室路径，科室树只加载一次，修改科室提交后立即生效
+    """
+    from sqlalchemy import event
+    from utils.response_cache import response_cache
+
+    # 只测科室树缓存，关闭接口响应缓存
+    monkeypatch.setattr(response_cache, 'backend', None)
+
+    hospital = Hospital(name='测试医院')
+    db.session.add(hospital)
+    db.session.flush()
+    root = Office(name='内科', hospital_id=hospital.id)
+    db.session.add(root)
+    db.session.flush()
+    ward = Office(name='心内科', hospital_id=hospital.id, parent_id=root.id)
+    db.session.add(ward)
+    db.session.flush()
+    db.session.add(Office(name='心内一病区', hospital_id=hospital.id, parent_id=ward.id))
+    db.session.add_all([DoctorHospital(doc_id=doctor.id, hosp_id=hospital.id),
+                        DoctorOffice(doc_id=doctor.id, off_id=ward.id)])
+    db.session.commit()
+    hospital_id, ward_id = hospital.id, ward.id
+
+    def get_offices():
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = client.get('/api/hospital/office', headers=auth_headers,
+                                  query_string={'hospital_id': hospital_id})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return json.loads(response.data)['data'], len(statements)
+
+    offices, first_queries = get_offices()
+    by_name = {office['name']: office for office in offices}
+    assert set(by_name) == {'心内科', '心内一病区'}
+    assert [p['name'] for p in by_name['心内一病区']['parent_path']] == ['内科', '心内科']
+
+    _, cached_queries = get_offices()
+    assert cached_queries == first_queries - 1
+
+    db.session.add(Office(name='心内二病区', hospital_id=hospital_id, parent_id=ward_id))
+    db.session.commit()
+    offices, _ = get_offices()
+    assert {office['name'] for office in offices} == {'心内科', '心内一病区', '心内二病区'}
+
+
+def test_office_path_maintained_on_insert_and_move(client, db, doctor, auth_headers):
+    """
+    测试科室物化路径在新增和移动时维护，科室病历列表包含移入的子科室的病历
+    """
+    hospital = Hospital(name='测试医院')
+    patient = Patient(name='李四', gender='女')
+    db.session.add_all([hospital, patient])
+    db.session.flush()
+    internal = Office(name='内科', hospital_id=hospital.id)
+    surgery = Office(name='外科', hospital_id=hospital.id)
+    db.session.add_all([internal, surgery])
+    db.session.flush()
+    ward = Office(name='普外病区', hospital_id=hospital.id, parent_id=surgery.id)
+    db.session.add(ward)
+    db.session.flush()
+    bed = Office(name='普外一组', hospital_id=hospital.id, parent_id=ward.id)
+    db.session.add(bed)
+    db.session.flush()
+    db.session.add(Case(patient_id=patient.id, office_id=bed.id, doctor_id=doctor.id, case_date=date(2024, 1, 1)))
+    db.session.commit()
+    assert bed.path == f"/{surgery.id}/{ward.id}/{bed.id}/"
+
+    def case_count(office_id):
+        response = client.get('/api/hospital/case', headers=auth_headers, query_string={'office_id': office_id})
+        return json.loads(response.data)['pagination']['total_items']
+
+    assert (case_count(surgery.id), case_count(internal.id)) == (1, 0)
+
+    ward.parent_id = internal.id
+    db.session.commit()
+    assert Office.query.get(bed.id).path == f"/{internal.id}/{ward.id}/{bed.id}/"
+    assert (case_count(surgery.id), case_count(internal.id)) == (0, 1)
+
+    # 移到自己的子孙科室下: 修改前检查出错误，绕过检查时提交被拒绝
+    assert office_move_error(ward, bed.id) and office_move_error(ward, ward.id)
+    assert office_move_error(ward, surgery.id) is None
+    ward.parent_id = bed.id
+    with pytest.raises(OfficeMoveError):
+        db.session.commit()
+    db.session.rollback()
+
+    # 还没有执行 upgrade-db 的数据库中路径为空，退回按科室树展开子孙科室
+    db.session.execute(update(Office).values(path=None))
+    db.session.commit()
+    assert (case_count(surgery.id), case_count(internal.id), case_count(ward.id)) == (0, 1, 1)
+
+
+def test_search_ranks_patients_and_cases_from_ngram_index(client, db, doctor, auth_headers):
+    """
+    测试检索索引随病人、病历的写入更新，姓名和病历文本按子串检索并排序分页，与整体重建的索引一致
+    """
+    from models import SearchGram
+    from search import rebuild_search_index
+
+    office = _office_with_cases(db, doctor, [])
+    db.session.add(DoctorHospital(doc_id=doctor.id, hosp_id=office.hospital_id))
+    patients = [Patient(name=name, gender='男') for name in ('张三丰', '张三', '李张三', '王五')]
+    db.session.add_all(patients)
+    db.session.flush()
+    db.session.add_all([
+        Case(patient_id=patients[0].id, office_id=office.id, doctor_id=doctor.id, case_date=date(2024, 1, 1),
+             chief_complaint='头痛三天', diagnosis='偏头痛'),
+        Case(patient_id=patients[3].id, office_id=office.id, doctor_id=doctor.id, case_date=date(2024, 1, 2),
+             chief_complaint='头部外伤后头痛', diagnosis='脑震荡'),
+        Case(patient_id=patients[1].id, office_id=office.id, doctor_id=doctor.id, case_date=date(2024, 1, 3),
+             chief_complaint='咳嗽', diagnosis='上呼吸道感染'),
+    ])
+    db.session.commit()
+
+    def search(**args):
+        response = client.get('/api/patient/search', headers=auth_headers, query_string=args)
+        return json.loads(response.data)
+
+    body = search(q='张三', per_page=2)
+    assert [p['name'] for p in body['data']][0] == '张三'
+    assert body['pagination']['has_next']
+    assert {p['name'] for p in body['data'] + search(q='张三', per_page=2, page=2)['data']} == {'张三丰', '张三', '李张三'}
+    # 单字查询匹配任意位置
+    assert {p['name'] for p in search(q='丰')['data']} == {'张三丰'}
+
+    # 诊断命中的权重高于主诉
+    assert [c['diagnosis'] for c in search(q='头痛', type='case')['data']] == ['偏头痛', '脑震荡']
+
+    # 改名后旧姓名不再命中；按姓名筛选病历只返回子串匹配的病人
+    patients[2].name = '李四'
+    db.session.commit()
+    assert {p['name'] for p in search(q='张三')['data']} == {'张三丰', '张三'}
+    response = client.get('/api/hospital/case', headers=auth_headers,
+                          query_string={'office_id': office.id, 'patient_name': '三丰'})
+    assert [c['diagnosis'] for c in json.loads(response.data)['data']] == ['偏头痛']
+
+    incremental = sorted((g.gram, g.doc_type, g.doc_id, g.field, g.tf) for g in SearchGram.query.all())
+    rebuild_search_index()
+    assert sorted((g.gram, g.doc_type, g.doc_id, g.field, g.tf) for g in SearchGram.query.all()) == incremental
+
+
+def test_patient_typeahead_prefix_from_memory(client, db, doctor, auth_headers):
+    """
+    测试病人联想按姓名或拼音首字母前缀返回最新建档的病人，建好前缀树后查询不访问数据库，新增、改名提交后立即生效
+    """
+    from sqlalchemy import event
+
+    db.session.add_all([Patient(name=name, gender='男') for name in ('张三', '张三丰', '张无忌', '李四')])
+    db.session.commit()
+
+    def typeahead(q, **args):
+        statements = []
+        listener = lambda *a: statements.append(a[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = client.get('/api/hospital/patient/typeahead', headers=auth_headers,
+                                  query_string=dict(args, q=q))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        body = json.loads(response.data)
+        return [p['name'] for p in body['data']], len(statements), body['seq']
+
+    typeahead('张')
+    assert typeahead('张', limit=2, seq='7') == (['张无忌', '张三丰'], 0, '7')
+    assert typeahead('张三')[0] == ['张三丰', '张三']
+
+    response = client.post('/api/hospital/add_patient', headers=auth_headers, json={'name': '张三娘', 'gender': '女'})
+    assert response.status_code == 201
+    assert typeahead('张三')[0] == ['张三娘', '张三丰', '张三']
+
+    patient = Patient.query.filter_by(name='张三丰').one()
+    patient.name = '李三丰'
+    db.session.commit()
+    assert typeahead('张三')[0] == ['张三娘', '张三']
+    assert typeahead('李')[0] == ['李四', '李三丰']
+    assert typeahead('ZS')[0] == ['张三娘', '张三']
+    assert typeahead('lsf')[0] == ['李三丰']
+
+
+def test_patient_typeahead_first_build_runs_once(monkeypatch):
+    """测试并发的首次联想查询只加载一次前缀树，其余请求等待加载完成"""
+    import threading
+    import time
+    from typeahead import PatientTypeahead, PrefixTrie
+
+    typeahead = PatientTypeahead()
+    builds = []
+
+    def build():
+        builds.append(1)
+        time.sleep(0.1)
+        trie = PrefixTrie(typeahead.limit)
+        trie.insert('zs', 1)
+        typeahead._trie, typeahead._patients, typeahead._built_at = trie, {1: {'id': 1}}, time.monotonic()
+
+    monkeypatch.setattr(typeahead, 'build', build)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(typeahead.search('z'))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+    assert results == [[{'id': 1}]] * 4
+
+
+def test_memory_response_cache_ttl_capped(client, app, db, doctor, auth_headers, monkeypatch):
+    """
+    测试内存后端的失效不跨进程，医院列表接口上 300 秒的过期时间被限制为 RESPONSE_CACHE_MEMORY_MAX_TTL
+    """
+    from utils.response_cache import response_cache
+    monkeypatch.setitem(app.config, 'RESPONSE_CACHE_MEMORY_MAX_TTL', 30)
+    now = 1000.0
+    monkeypatch.setattr('utils.response_cache.time.monotonic', lambda: now)
+
+    def get():
+        return client.get('/api/user/hospitals', headers=auth_headers).headers['X-Cache']
+
+    assert get() == 'MISS'
+    [(expires_at, _)] = response_cache.backend._items.values()
+    assert expires_at == now + 30
+    now += 29
+    assert get() == 'HIT'
+    now += 1
+    assert get() == 'MISS'
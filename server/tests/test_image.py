@@ -0,0 +1,860 @@
+import io
+import json
+import time
+import zipfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ImplicitVRLittleEndian, generate_uid
+from PIL import Image as PilImage
+from models import Image, IngestJob, ImagePyramid, SliceManifest, ContentObject, ImageSeg
+from migrate import compact_slices, backfill_previews, backfill_thumbnails
+
+
+def _nii_upload(shape=(6, 5, 4)):
+    """生成一个随机的3D NII文件用于上传"""
+    volume = nib.Nifti1Image(np.random.rand(*shape).astype(np.float32), np.eye(4))
+    return io.BytesIO(volume.to_bytes())
+
+
+def _single_frame_dicom(series_uid, position, pixels):
+    """生成一个属于指定序列的单帧DICOM文件"""
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = series_uid
+    ds.ImagePositionPatient = [0, 0, position]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.PixelData = pixels.tobytes()
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+def test_add_image_series_assembles_volume_from_zip(client, db, storage, auth_headers):
+    """
+    测试上传zip中的单帧DICOM序列：按层面位置排序后组装为一个3D影像，非DICOM文件被忽略
+    """
+    volume = (np.random.rand(5, 6, 4) * 2000 - 1000).astype(np.int16)
+    series_uid = generate_uid()
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        # 文件名顺序与层面位置相反，组装时应按 ImagePositionPatient 排序
+        for z in range(5):
+            zf.writestr(f"IMG{4 - z:04d}", _single_frame_dicom(series_uid, z * 2.5, volume[z]))
+        zf.writestr('DICOMDIR.txt', b'not a dicom file')
+    archive.seek(0)
+
+    response = client.post('/api/image/series', headers=auth_headers, data={
+        'name': '测试CT序列', 'type': 'CT', 'file': (archive, 'study.zip')
+    })
+    data = json.loads(response.data)['data']
+    assert response.status_code == 202
+    assert data['ignored_files'] == 1
+    assert len(data['series']) == 1
+    created = data['series'][0]
+    assert created['series_uid'] == series_uid and created['files'] == 5
+    assert created['job']['status'] == 'succeeded'
+
+    image = created['image']
+    assert (image['format'], image['dim']) == ('dicom', '3D')
+    assert (image['slice_x'], image['slice_y'], image['slice_z']) == (4, 6, 5)
+
+    assembled = pydicom.dcmread(io.BytesIO(storage.objects[image['oss_key']]))
+    assert assembled.NumberOfFrames == 5
+    assert np.array_equal(assembled.pixel_array, volume)
+
+
+def test_add_image_series_limits_archive_and_reports_failed_series(client, app, db, storage, auth_headers, monkeypatch):
+    """
+    测试zip解压的文件数和总大小超过限制时返回400且不解压；
+    多个序列中某个序列处理失败时，其他序列照常登记，响应中列出失败的序列
+    """
+    import image as image_module
+    volume = (np.random.rand(3, 6, 4) * 2000).astype(np.int16)
+    uids = [generate_uid(), generate_uid()]
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for series_index, series_uid in enumerate(uids):
+            for z in range(3):
+                zf.writestr(f"S{series_index}_{z}", _single_frame_dicom(series_uid, z * 2.5, volume[z]))
+    upload = archive.getvalue()
+
+    def post():
+        return client.post('/api/image/series', headers=auth_headers, data={
+            'name': '测试CT序列', 'type': 'CT', 'file': (io.BytesIO(upload), 'study.zip')
+        })
+
+    monkeypatch.setitem(app.config, 'INGEST_SERIES_MAX_FILES', 5)
+    response = post()
+    assert response.status_code == 400 and '文件数' in json.loads(response.data)['message']
+    monkeypatch.setitem(app.config, 'INGEST_SERIES_MAX_FILES', 100)
+    monkeypatch.setitem(app.config, 'INGEST_SERIES_MAX_BYTES', len(upload))
+    response = post()
+    assert response.status_code == 400 and 'MB' in json.loads(response.data)['message']
+    assert Image.query.count() == 0
+
+    monkeypatch.setitem(app.config, 'INGEST_SERIES_MAX_BYTES', 1024 * 1024)
+    assemble = image_module.assemble_series
+
+    def flaky_assemble(members, path):
+        if members[0]['series_uid'] == uids[1]:
+            raise IOError('disk full')
+        return assemble(members, path)
+
+    monkeypatch.setattr(image_module, 'assemble_series', flaky_assemble)
+    response = post()
+    data = json.loads(response.data)
+    assert response.status_code == 202 and '1 个序列处理失败' in data['message']
+    assert [item['series_uid'] for item in data['data']['series']] == [uids[0]]
+    assert data['data']['failed'][0]['series_uid'] == uids[1]
+    assert 'disk full' in data['data']['failed'][0]['reason']
+
+
+def test_add_3d_image_runs_ingest_job(client, db, storage, auth_headers):
+    """
+    测试上传3D影像返回202，后台任务生成全部切片并更新进度
+    """
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'file': (_nii_upload(), 'volume.nii')
+    })
+    data = json.loads(response.data)
+
+    assert response.status_code == 202
+    assert data['data']['image']['dim'] == '3D'
+    job_id = data['data']['job']['id']
+
+    response = client.get(f'/api/image/job/{job_id}', headers=auth_headers)
+    job = json.loads(response.data)['data']
+    assert job['status'] == 'succeeded'
+    assert job['total'] == job['done'] == 6 + 5 + 4
+    assert job['progress'] == 100.0
+
+    volume = Image.query.get(job['image_id'])
+    assert volume.status == 'ready'
+    # 切片只记录在每个方向一条的切片清单中，不再逐张创建影像记录
+    assert Image.query.filter_by(parent_image_id=volume.id).count() == 0
+    manifest = SliceManifest.query.filter_by(image_id=volume.id, direction='z').one()
+    assert manifest.count == 4
+    # 原始文件 + 全部切片 + 列表缩略图
+    assert len(storage.objects) == 1 + 6 + 5 + 4 + 1
+    assert all(key in storage.objects for key in manifest.keys())
+    # 列表预览指针在入库时写入: x 方向第一张切片
+    x_manifest = SliceManifest.query.filter_by(image_id=volume.id, direction='x').one()
+    assert volume.preview_key == x_manifest.key(0)
+
+
+def test_upload_spooled_once_into_work_dir(client, app, db, storage, auth_headers, monkeypatch):
+    """
+    测试上传的文件在解析请求时直接写入工作目录并计算哈希，接口接管该文件而不再复制；
+    没有被接管的文件 (例如参数校验失败) 在请求结束时删除
+    """
+    import hashlib
+    import os
+    from ingest import ingest_queue, SpooledUpload
+    spool = ingest_queue.spool
+    spooled = []
+    monkeypatch.setattr(ingest_queue, 'spool', lambda stream, suffix: spooled.append(
+        (isinstance(stream, SpooledUpload), stream.path)) or spool(stream, suffix))
+    work_files = set(os.listdir(app.config['INGEST_WORK_DIR']))
+
+    upload = _nii_upload().getvalue()
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'lazy': 'true', 'file': (io.BytesIO(upload), 'volume.nii')
+    })
+    assert response.status_code == 201
+    [(direct, path)] = spooled
+    assert direct and os.path.dirname(path) == os.path.abspath(app.config['INGEST_WORK_DIR'])
+    assert json.loads(response.data)['data']['content_hash'] == hashlib.sha256(upload).hexdigest()
+
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'type': 'CT', 'file': (io.BytesIO(upload), 'volume.nii')
+    })
+    assert response.status_code == 400
+    assert set(os.listdir(app.config['INGEST_WORK_DIR'])) == work_files
+
+
+def test_slice_rows_inserted_in_executemany_batches(client, app, db, storage, auth_headers, monkeypatch):
+    """
+    测试不使用切片清单时切片记录按 INSERT_BATCH 分批以 executemany 写入，而不是逐条 INSERT
+    """
+    from sqlalchemy import event
+    import ingest
+    monkeypatch.setitem(app.config, 'INGEST_SLICE_MANIFEST', False)
+    monkeypatch.setattr(ingest, 'INSERT_BATCH', 4)
+    inserts = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT INTO image '):
+            inserts.append(len(parameters) if executemany else 1)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        response = client.post('/api/image/add', headers=auth_headers, data={
+            'name': '测试CT', 'type': 'CT', 'file': (_nii_upload(), 'volume.nii')
+        })
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    volume_id = json.loads(response.data)['data']['image']['id']
+
+    # 主影像一条，6 + 5 + 4 张切片分为 4、4、4、3 条
+    assert inserts == [1, 4, 4, 4, 3]
+    slices = Image.query.filter_by(parent_image_id=volume_id).all()
+    assert sorted((s.slice_direction, s.slice) for s in slices) == sorted(
+        [('x', i) for i in range(6)] + [('y', i) for i in range(5)] + [('z', i) for i in range(4)])
+
+
+def test_reupload_same_study_reuses_stored_content(client, db, storage, auth_headers):
+    """
+    测试重复上传相同的研究时按内容哈希复用原始文件和已生成的切片，不再上传也不再渲染
+    """
+    upload = _nii_upload().getvalue()
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'file': (io.BytesIO(upload), 'volume.nii')
+    })
+    first = json.loads(response.data)['data']['image']
+    stored = dict(storage.objects)
+
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '转诊CT', 'type': 'CT', 'file': (io.BytesIO(upload), 'referral.nii')
+    })
+    second = json.loads(response.data)['data']
+    assert response.status_code == 201
+    assert second['status'] == 'ready'
+    assert second['oss_key'] == first['oss_key']
+    assert second['content_hash'] == first['content_hash']
+    assert storage.objects == stored
+    assert IngestJob.query.filter_by(image_id=second['id']).count() == 0
+
+    first_z = SliceManifest.query.filter_by(image_id=first['id'], direction='z').one()
+    second_z = SliceManifest.query.filter_by(image_id=second['id'], direction='z').one()
+    assert second_z.keys() == first_z.keys()
+
+
+def test_reupload_reuses_tile_pyramids_and_windowed_thumbnail(client, app, db, storage, auth_headers, monkeypatch):
+    """
+    测试需要瓦片的重复上传: 已有影像没有生成瓦片时重新渲染，之后的重复上传共用已生成的瓦片金字塔；
+    窗口模式变化后重新渲染，缩略图不复用按旧窗口生成的那张
+    """
+    # 6x5x4 的体数据只有 y、z 方向的切片达到瓦片尺寸
+    monkeypatch.setitem(app.config, 'INGEST_TILE_MIN_SIZE', 6)
+    upload = _nii_upload().getvalue()
+
+    def post(tiles):
+        response = client.post('/api/image/add', headers=auth_headers, data={
+            'name': '测试CT', 'type': 'CT', 'tiles': tiles, 'file': (io.BytesIO(upload), 'volume.nii')
+        })
+        data = json.loads(response.data)['data']
+        return response.status_code, Image.query.get(data['image']['id'] if 'job' in data else data['id'])
+
+    def pyramids(volume):
+        return {(s.slice_direction, s.slice): s.pyramid.oss_prefix
+                for s in Image.query.filter_by(parent_image_id=volume.id) if s.pyramid}
+
+    assert post('false')[0] == 202
+    status, tiled = post('true')
+    assert status == 202
+    assert len(pyramids(tiled)) == 5 + 4
+    stored = dict(storage.objects)
+
+    status, reused = post('true')
+    assert status == 201 and reused.status == 'ready'
+    assert pyramids(reused) == pyramids(tiled)
+    assert storage.objects == stored
+    assert reused.thumbnail_key == tiled.thumbnail_key
+
+    monkeypatch.setitem(app.config, 'INGEST_WINDOWING', 'percentile')
+    status, rewindowed = post('false')
+    assert status == 202
+    assert rewindowed.thumbnail_key not in (None, tiled.thumbnail_key)
+
+
+def test_ingest_job_fails_when_slice_upload_fails(client, db, storage, auth_headers):
+    """
+    测试任一切片上传失败时任务失败，且不残留切片记录
+    """
+    original_put = storage.put
+
+    def flaky_put(key, data):
+        if key.endswith('.png'):
+            raise IOError('network down')
+        original_put(key, data)
+
+    storage.put = flaky_put
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'file': (_nii_upload(), 'volume.nii')
+    })
+    job = IngestJob.query.get(json.loads(response.data)['data']['job']['id'])
+
+    assert job.status == 'failed'
+    assert 'network down' in job.error
+    assert job.image.status == 'failed'
+    assert Image.query.filter_by(parent_image_id=job.image_id).count() == 0
+
+
+def test_ingest_jobs_recovered_after_restart(client, app, db, storage, auth_headers, monkeypatch):
+    """
+    测试进程重启后丢失的处理任务: 仍在排队的重新投递并只执行一次，执行中已超时的标记为失败
+    """
+    from datetime import datetime, timedelta
+    from ingest import ingest_queue
+    # 模拟任务登记后进程退出: 投递不执行
+    submit = ingest_queue.submit
+    monkeypatch.setattr(ingest_queue, 'submit', lambda job_id: None)
+    job_ids = []
+    for name in ('排队CT', '中断CT'):
+        response = client.post('/api/image/add', headers=auth_headers, data={
+            'name': name, 'type': 'CT', 'file': (_nii_upload(), 'volume.nii')
+        })
+        job_ids.append(json.loads(response.data)['data']['job']['id'])
+    queued_id, stale_id = job_ids
+    IngestJob.query.filter_by(id=stale_id).update(
+        {'status': 'running', 'updated_at': datetime.now() - timedelta(hours=1)})
+    db.session.commit()
+
+    monkeypatch.setattr(ingest_queue, 'submit', submit)
+    monkeypatch.setitem(app.config, 'INGEST_BACKEND', 'local')
+    # 测试数据库的各线程共用一个连接，重复投递的任务依次执行
+    monkeypatch.setitem(app.config, 'INGEST_WORKERS', 1)
+    monkeypatch.setattr(ingest_queue, '_executor', None)
+    assert ingest_queue.recover() == (1, 1)
+    # 同一任务被投递两次 (重启恢复与原进程)，只执行一次
+    ingest_queue.submit(queued_id)
+    ingest_queue._executor.shutdown(wait=True)
+    db.session.expire_all()
+
+    queued, stale = IngestJob.query.get(queued_id), IngestJob.query.get(stale_id)
+    assert queued.status == 'succeeded' and queued.image.status == 'ready'
+    assert SliceManifest.query.filter_by(image_id=queued.image_id).count() == 3
+    assert stale.status == 'failed' and stale.image.status == 'failed'
+    response = client.get(f'/api/image/job/{stale_id}', headers=auth_headers)
+    assert json.loads(response.data)['data']['status'] == 'failed'
+
+
+def test_manifest_slice_annotation_updates_bitmap(client, db, storage, auth_headers):
+    """
+    测试切片清单中的切片在标注前登记切片记录，标注增删同步更新清单的标注位图
+    """
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'file': (_nii_upload(), 'volume.nii')
+    })
+    volume_id = json.loads(response.data)['data']['image']['id']
+
+    response = client.get(f"/api/image/{volume_id}?direction=z", headers=auth_headers)
+    data = json.loads(response.data)['data']
+    assert [p['id'] for p in data['slice_previews']] == [None] * 4
+    assert data['annotated_slices'] == []
+
+    response = client.post(f"/api/image/{volume_id}/slice/z/2", headers=auth_headers)
+    slice_img = json.loads(response.data)['data']
+    assert response.status_code == 200
+    assert storage.objects.get(slice_img['oss_key']) is not None
+
+    response = client.post('/api/image/annotate', headers=auth_headers, json={
+        'image_id': slice_img['id'], 'anno_type': 'bbox',
+        'up_left_x': 0, 'up_left_y': 0, 'bottom_right_x': 2, 'bottom_right_y': 2
+    })
+    bbox_id = json.loads(response.data)['data']['id']
+
+    response = client.get(f"/api/image/{volume_id}?direction=z", headers=auth_headers)
+    data = json.loads(response.data)['data']
+    assert data['annotated_slices'] == [2]
+    assert data['slice_previews'][2]['id'] == slice_img['id']
+
+    client.delete('/api/image/annotate', headers=auth_headers, json={'anno_id': bbox_id, 'anno_type': 'bbox'})
+    response = client.get(f"/api/image/{volume_id}?direction=z", headers=auth_headers)
+    assert json.loads(response.data)['data']['annotated_slices'] == []
+
+
+def test_compact_slices_packs_legacy_slice_rows(client, app, db, storage, auth_headers, monkeypatch):
+    """
+    测试把逐张切片记录的旧3D影像改为切片清单，只保留有标注的切片记录
+    """
+    monkeypatch.setitem(app.config, 'INGEST_SLICE_MANIFEST', False)
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'file': (_nii_upload(), 'volume.nii')
+    })
+    volume_id = json.loads(response.data)['data']['image']['id']
+    legacy = Image.query.filter_by(parent_image_id=volume_id, slice_direction='y').order_by(Image.slice).all()
+    legacy_keys, annotated_id = [s.oss_key for s in legacy], legacy[3].id
+    assert len(legacy) == 5
+    client.post('/api/image/annotate', headers=auth_headers, json={
+        'image_id': annotated_id, 'anno_type': 'bbox',
+        'up_left_x': 0, 'up_left_y': 0, 'bottom_right_x': 2, 'bottom_right_y': 2
+    })
+
+    assert compact_slices() == (1, 0)
+    assert [s.id for s in Image.query.filter_by(parent_image_id=volume_id)] == [annotated_id]
+
+    response = client.get(f"/api/image/{volume_id}?direction=y", headers=auth_headers)
+    data = json.loads(response.data)['data']
+    assert [p['url'] for p in data['slice_previews']] == [f"https://cdn.ember.ac.cn/{key}" for key in legacy_keys]
+    assert data['annotated_slices'] == [3]
+    assert data['slice_previews'][3]['id'] == annotated_id
+    assert compact_slices() == (0, 0)
+
+
+def test_lazy_3d_image_renders_slices_on_demand(client, db, storage, auth_headers):
+    """
+    测试按需生成模式：上传时不生成切片，首次访问渲染接口时生成并记录，之后重定向到CDN
+    """
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'lazy': 'true', 'file': (_nii_upload(), 'volume.nii')
+    })
+    image = json.loads(response.data)['data']
+    assert response.status_code == 201
+    assert image['lazy_slices'] is True
+    assert Image.query.filter_by(parent_image_id=image['id']).count() == 0
+
+    response = client.get(f"/api/image/{image['id']}?direction=y", headers=auth_headers)
+    previews = json.loads(response.data)['data']['slice_previews']
+    assert len(previews) == 5
+    assert previews[2]['id'] is None
+
+    # 渲染接口使用签名鉴权，不需要认证头
+    response = client.get(previews[2]['url'])
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.data[:8] == b'\x89PNG\r\n\x1a\n'
+
+    slice_img = Image.query.filter_by(parent_image_id=image['id'], slice_direction='y', slice=2).one()
+    assert storage.objects[slice_img.oss_key] == response.data
+
+    response = client.get(previews[2]['url'])
+    assert response.status_code == 302
+
+    response = client.get(f"/api/image/{image['id']}/slice/y/1?token=forged")
+    assert response.status_code == 403
+
+
+def test_lazy_3d_image_original_across_filesystems(client, app, db, storage, auth_headers, monkeypatch):
+    """
+    测试按需生成模式下工作目录与切片缓存不在同一文件系统时原始文件复制进缓存，
+    移入缓存失败时上传仍然成功，首次访问切片时从存储下载原始文件
+    """
+    import errno
+    import os
+    import utils.slice_cache
+    from utils.slice_cache import slice_cache
+
+    replace = os.replace
+
+    def cross_device_replace(src, dst):
+        if os.path.dirname(src) != os.path.dirname(dst):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        replace(src, dst)
+
+    monkeypatch.setattr(utils.slice_cache.os, 'replace', cross_device_replace)
+    work_files = set(os.listdir(app.config['INGEST_WORK_DIR']))
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'lazy': 'true', 'file': (_nii_upload(), 'volume.nii')
+    })
+    assert response.status_code == 201
+    image = Image.query.get(json.loads(response.data)['data']['id'])
+    assert os.path.exists(slice_cache.original_path(image.oss_key))
+    assert set(os.listdir(app.config['INGEST_WORK_DIR'])) == work_files
+
+    def fail_adopt(oss_key, path):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(slice_cache, 'adopt_original', fail_adopt)
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'lazy': 'true', 'file': (_nii_upload((4, 4, 3)), 'other.nii')
+    })
+    assert response.status_code == 201
+    image_id = json.loads(response.data)['data']['id']
+    assert set(os.listdir(app.config['INGEST_WORK_DIR'])) == work_files
+    response = client.get(f"/api/image/{image_id}?direction=z", headers=auth_headers)
+    previews = json.loads(response.data)['data']['slice_previews']
+    assert client.get(previews[0]['url']).status_code == 200
+
+
+def test_large_picture_builds_tile_pyramid(client, app, db, storage, auth_headers, monkeypatch):
+    """
+    测试大尺寸图片上传时生成 DZI 瓦片金字塔，清单接口返回各层的瓦片行列数
+    """
+    monkeypatch.setitem(app.config, 'INGEST_TILE_MIN_SIZE', 300)
+    picture = io.BytesIO()
+    PilImage.fromarray(np.random.randint(0, 255, (300, 520), dtype=np.uint8)).save(picture, format='PNG')
+    picture.seek(0)
+
+    response = client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试X光', 'type': 'X-ray', 'tiles': 'true', 'file': (picture, 'xray.png')
+    })
+    image = json.loads(response.data)['data']
+    assert response.status_code == 201
+
+    response = client.get(f"/api/image/{image['id']}/tiles", headers=auth_headers)
+    tiles = json.loads(response.data)['data']
+    assert response.status_code == 200
+    assert (tiles['width'], tiles['height']) == (520, 300)
+    # 520 需要 10 次减半才到 1 像素，共 11 层
+    assert len(tiles['levels']) == 11
+    top = tiles['levels'][-1]
+    assert (top['cols'], top['rows']) == (3, 2)
+    assert tiles['levels'][0] == {'level': 0, 'width': 1, 'height': 1, 'cols': 1, 'rows': 1}
+
+    pyramid = ImagePyramid.query.filter_by(image_id=image['id']).one()
+    tile_keys = [k for k in storage.objects if k.startswith(f"{pyramid.oss_prefix}_files/")]
+    assert len(tile_keys) == pyramid.tile_count == sum(l['cols'] * l['rows'] for l in tiles['levels'])
+    corner = PilImage.open(io.BytesIO(storage.objects[f"{pyramid.oss_prefix}_files/10/2_1.png"]))
+    assert corner.size == (520 - 512, 300 - 256)
+
+    response = client.get(f"/api/image/{image['id']}", headers=auth_headers)
+    assert json.loads(response.data)['data']['tiled'] is True
+
+
+def test_slice_tile_pyramids_stay_with_their_volume(client, app, db, storage, auth_headers, monkeypatch):
+    """
+    测试相同内容的两个3D影像各自生成切片瓦片时 (切片按内容寻址，oss_key 相同)，
+    瓦片金字塔关联到本影像的切片记录，而不是另一个影像的同名切片
+    """
+    import image as image_module
+    monkeypatch.setitem(app.config, 'INGEST_TILE_MIN_SIZE', 4)
+    # 模拟两次上传并发处理: 第二次上传时第一次的切片尚未登记，不能复用
+    monkeypatch.setattr(image_module, 'reuse_rendered_slices', lambda *args: False)
+    upload = _nii_upload().getvalue()
+    volume_ids = []
+    for name in ('测试CT', '转诊CT'):
+        response = client.post('/api/image/add', headers=auth_headers, data={
+            'name': name, 'type': 'CT', 'tiles': 'true', 'file': (io.BytesIO(upload), 'volume.nii')
+        })
+        volume_ids.append(json.loads(response.data)['data']['image']['id'])
+
+    for volume_id in volume_ids:
+        slices = Image.query.filter_by(parent_image_id=volume_id).all()
+        assert len(slices) == 6 + 5 + 4
+        assert ImagePyramid.query.filter(ImagePyramid.image_id.in_([s.id for s in slices])).count() == len(slices)
+
+
+def test_list_images_resolves_previews_in_constant_queries(client, app, db, storage, auth_headers):
+    """
+    测试影像列表批量解析预览图：查询次数不随每页影像数量增长
+    """
+    from sqlalchemy import event
+
+    def upload_picture():
+        buffer = io.BytesIO()
+        PilImage.fromarray((np.random.rand(8, 8) * 255).astype(np.uint8)).save(buffer, format='PNG')
+        buffer.seek(0)
+        client.post('/api/image/add', headers=auth_headers, data={
+            'name': '照片', 'type': '其他', 'file': (buffer, 'photo.png')
+        })
+
+    def list_with_query_count():
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = client.get('/api/image/list?per_page=50', headers=auth_headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return json.loads(response.data)['data'], len(statements)
+
+    upload_picture()
+    client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'file': (_nii_upload(), 'volume.nii')
+    })
+    _, baseline = list_with_query_count()
+
+    for _ in range(3):
+        upload_picture()
+    client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'file': (_nii_upload(), 'volume.nii')
+    })
+    data, queries = list_with_query_count()
+
+    assert queries == baseline
+    assert len(data) == 6
+    for item in data:
+        if item['dim'] == '3D':
+            manifest = SliceManifest.query.filter_by(image_id=item['id'], direction='x').one()
+            assert item['preview_url'].endswith(manifest.key(0))
+        else:
+            assert item['preview_url'] == item['source_url']
+        # 列表返回按内容寻址的缩略图，长边缩小到配置的尺寸以内
+        thumbnail_key = item['thumbnail_url'].split('/', 3)[3]
+        assert thumbnail_key.endswith('/thumb_256.webp')
+        thumbnail = PilImage.open(io.BytesIO(storage.objects[thumbnail_key]))
+        assert thumbnail.format == 'WEBP' and max(thumbnail.size) <= 256
+
+
+def test_backfill_previews_fills_legacy_images(client, db, storage, auth_headers):
+    """
+    测试为没有预览指针的旧影像回填: 2D DICOM 指向预览子影像，3D 指向 x 方向第一张切片
+    """
+    client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'file': (_nii_upload(), 'volume.nii')
+    })
+    pixels = (np.random.rand(8, 8) * 1000).astype(np.int16)
+    client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试X光', 'type': 'X-ray',
+        'file': (io.BytesIO(_single_frame_dicom(generate_uid(), 0, pixels)), 'xray.dcm')
+    })
+    volume = Image.query.filter_by(dim='3D').one()
+    xray = Image.query.filter_by(format='dicom', parent_image_id=None).one()
+    expected = {
+        volume.id: (None, volume.preview_key),
+        xray.id: (xray.preview_image_id, xray.preview_key),
+    }
+    assert xray.preview_image_id == xray.child_images.one().id
+
+    Image.query.filter(Image.parent_image_id.is_(None)).update({'preview_image_id': None, 'preview_key': None})
+    db.session.commit()
+
+    assert backfill_previews(batch_size=1) == (2, 0)
+    for image_id, pointer in expected.items():
+        image = Image.query.get(image_id)
+        assert (image.preview_image_id, image.preview_key) == pointer
+
+
+def test_backfill_thumbnails_from_previews(client, db, storage, auth_headers):
+    """
+    测试为没有缩略图的旧影像从预览图生成缩略图
+    """
+    client.post('/api/image/add', headers=auth_headers, data={
+        'name': '测试CT', 'type': 'CT', 'file': (_nii_upload(), 'volume.nii')
+    })
+    volume = Image.query.filter_by(dim='3D').one()
+    thumbnail_key = volume.thumbnail_key
+    assert thumbnail_key in storage.objects
+
+    volume.thumbnail_key = None
+    ContentObject.query.filter(ContentObject.kind.startswith('thumbnail:')).delete(synchronize_session=False)
+    del storage.objects[thumbnail_key]
+    db.session.commit()
+
+    assert backfill_thumbnails() == (1, 0)
+    assert Image.query.get(volume.id).thumbnail_key == thumbnail_key
+    assert thumbnail_key in storage.objects
+
+
+def test_list_images_cursor_pagination(client, db, storage, auth_headers):
+    """
+    测试影像列表的游标分页: 逐页翻到底与页码分页顺序一致，prev_cursor 能回到上一页，页码参数保持兼容
+    """
+    for i in range(5):
+        buffer = io.BytesIO()
+        PilImage.fromarray(np.full((4, 4), i * 40, dtype=np.uint8)).save(buffer, format='PNG')
+        buffer.seek(0)
+        client.post('/api/image/add', headers=auth_headers, data={
+            'name': f'照片{i}', 'type': '其他', 'file': (buffer, f'photo{i}.png')
+        })
+
+    response = client.get('/api/image/list?page=1&per_page=10', headers=auth_headers)
+    body = json.loads(response.data)
+    expected = [item['id'] for item in body['data']]
+    assert body['pagination']['total_items'] == 5
+
+    pages, cursor = [], ''
+    while cursor is not None:
+        response = client.get('/api/image/list', headers=auth_headers, query_string={'per_page': 2, 'cursor': cursor})
+        body = json.loads(response.data)
+        assert 'total_items' not in body['pagination']
+        pages.append(body)
+        cursor = body['pagination']['next_cursor']
+    assert [item['id'] for page in pages for item in page['data']] == expected
+    assert [len(page['data']) for page in pages] == [2, 2, 1]
+
+    response = client.get('/api/image/list', headers=auth_headers, query_string={
+        'per_page': 2, 'cursor': pages[2]['pagination']['prev_cursor'], 'with_total': 'true'
+    })
+    body = json.loads(response.data)
+    assert [item['id'] for item in body['data']] == expected[2:4]
+    assert body['pagination']['has_prev'] and body['pagination']['total_items'] == 5
+
+    response = client.get('/api/image/list?cursor=not-a-cursor', headers=auth_headers)
+    assert response.status_code == 400
+
+
+@pytest.fixture()
+def predict_server():
+    """本地的AI预测服务桩: GET 返回原图，POST /predict 稍作停顿后返回分割结果，查询词含 fail 时返回500"""
+    state = {'active': 0, 'max_active': 0, 'calls': 0, 'gets': 0, 'bodies': []}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            state['gets'] += 1
+            self._reply(200, b'png-bytes', 'image/png')
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            with lock:
+                state['active'] += 1
+                state['calls'] += 1
+                state['max_active'] = max(state['max_active'], state['active'])
+                call = state['calls']
+                state['bodies'].append(body)
+            time.sleep(0.05)
+            with lock:
+                state['active'] -= 1
+            if b'fail' in body:
+                self._reply(500, b'model error', 'text/plain')
+            else:
+                result = {'result': '1.  【结节】右肺上叶', 'oss_key': f'hidoc2/seg/{call}.png'}
+                self._reply(200, json.dumps(result).encode(), 'application/json')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state['url'] = f"http://127.0.0.1:{server.server_address[1]}"
+    yield state
+    server.shutdown()
+
+
+def test_seg_jobs_queue_with_concurrency_limit(client, app, db, doctor, auth_headers, predict_server, storage,
+                                               monkeypatch, tmp_path):
+    """
+    测试AI分割改为排队任务: 提交立即返回202，同时调用AI服务的任务数不超过并发上限，
+    完成后创建分割记录，AI服务出错时任务失败并记录原因。
+    原图从本地缓存读取，只经存储后端下载一次，不经过CDN
+    """
+    from segment import seg_queue
+    from utils.slice_cache import slice_cache, DiskLru
+    monkeypatch.setitem(app.config, 'SEG_BACKEND', 'local')
+    monkeypatch.setitem(app.config, 'SEG_CONCURRENCY', 1)
+    monkeypatch.setitem(app.config, 'SEG_PREDICT_URL', f"{predict_server['url']}/predict")
+    monkeypatch.setitem(app.config, 'SEG_IMAGE_BASE_URL', predict_server['url'])
+    monkeypatch.setattr(seg_queue, '_executor', None)
+    monkeypatch.setattr(slice_cache, 'originals', DiskLru(str(tmp_path), 1024 * 1024))
+    storage.put('a.png', b'png-bytes')
+    downloads = []
+    get_to_file = storage.get_to_file
+    monkeypatch.setattr(storage, 'get_to_file', lambda key, path: downloads.append(key) or get_to_file(key, path))
+
+    image = Image(name='照片', format='picture', type='其他', dim='2D', creator_id=doctor.id, oss_key='a.png', size=1)
+    db.session.add(image)
+    db.session.commit()
+    image_id = image.id
+
+    job_ids = []
+    for query in ('结节', '肺叶', 'fail'):
+        response = client.post('/api/image/seg', headers=auth_headers, json={'image_id': image_id, 'query': query})
+        assert response.status_code == 202
+        job_ids.append(json.loads(response.data)['data']['id'])
+
+    # 测试数据库的各线程共用一个连接，等后台任务结束后再查询
+    seg_queue._executor.shutdown(wait=True)
+    jobs = {}
+    for job_id in job_ids:
+        response = client.get(f'/api/image/seg/job/{job_id}', headers=auth_headers)
+        jobs[job_id] = json.loads(response.data)['data']
+
+    assert [jobs[job_id]['status'] for job_id in job_ids] == ['succeeded', 'succeeded', 'failed']
+    assert predict_server['max_active'] == 1
+    assert '调用AI服务失败' in jobs[job_ids[2]]['error']
+    seg = jobs[job_ids[0]]['seg']
+    assert seg['reasoning'] == '1.【结节】右肺上叶'
+    assert db.session.query(ImageSeg).filter_by(image_id=image_id).count() == 2
+    assert downloads == ['a.png'] and predict_server['gets'] == 0
+    assert all(b'png-bytes' in body for body in predict_server['bodies'])
+
+    # 'url' 来源只把对象键和下载地址交给AI服务
+    monkeypatch.setitem(app.config, 'SEG_BACKEND', 'inline')
+    monkeypatch.setitem(app.config, 'SEG_IMAGE_SOURCE', 'url')
+    response = client.post('/api/image/seg', headers=auth_headers, json={'image_id': image_id, 'query': '结节'})
+    assert json.loads(response.data)['data']['status'] == 'succeeded'
+    body = predict_server['bodies'][-1]
+    assert b'png-bytes' not in body and b'a.png' in body and b'image_url' in body
+
+
+def test_seg_jobs_recovered_after_restart(client, app, db, doctor, auth_headers, predict_server, storage,
+                                          monkeypatch, tmp_path):
+    """
+    测试进程重启后丢失的分割任务: 仍在排队的重新投递并只执行一次，执行中已超时的标记为失败，
+    已中断的任务不再计入排队数，也不会阻止新的提交
+    """
+    from datetime import datetime, timedelta
+    from models import SegJob
+    from segment import seg_queue
+    from utils.slice_cache import slice_cache, DiskLru
+    monkeypatch.setitem(app.config, 'SEG_BACKEND', 'local')
+    monkeypatch.setitem(app.config, 'SEG_MAX_PENDING', 1)
+    # 测试数据库的各线程共用一个连接，重复投递的任务依次执行
+    monkeypatch.setitem(app.config, 'SEG_CONCURRENCY', 1)
+    monkeypatch.setitem(app.config, 'SEG_PREDICT_URL', f"{predict_server['url']}/predict")
+    monkeypatch.setattr(seg_queue, '_executor', None)
+    monkeypatch.setattr(slice_cache, 'originals', DiskLru(str(tmp_path), 1024 * 1024))
+    storage.put('a.png', b'png-bytes')
+
+    image = Image(name='照片', format='picture', type='其他', dim='2D', creator_id=doctor.id, oss_key='a.png', size=1)
+    db.session.add(image)
+    db.session.flush()
+    long_ago = datetime.now() - timedelta(hours=1)
+    running = SegJob(image_id=image.id, creator_id=doctor.id, query='结节', status='running',
+                     created_at=long_ago, updated_at=long_ago)
+    queued = SegJob(image_id=image.id, creator_id=doctor.id, query='肺叶')
+    db.session.add_all([running, queued])
+    db.session.commit()
+    running_id, queued_id, image_id = running.id, queued.id, image.id
+
+    response = client.get(f'/api/image/seg/job/{running_id}', headers=auth_headers)
+    assert json.loads(response.data)['data']['status'] == 'failed'
+
+    # 同一任务被投递两次 (重启恢复与原进程)，只执行一次
+    assert seg_queue.recover() == (1, 0)
+    seg_queue.submit(queued_id)
+    # 测试数据库的各线程共用一个连接，等后台任务结束后再查询
+    seg_queue._executor.shutdown(wait=True)
+    response = client.get(f'/api/image/seg/job/{queued_id}', headers=auth_headers)
+    assert json.loads(response.data)['data']['status'] == 'succeeded'
+    assert predict_server['calls'] == 1
+
+    stale = SegJob(image_id=image_id, creator_id=doctor.id, query='结节', created_at=long_ago)
+    db.session.add(stale)
+    db.session.commit()
+    monkeypatch.setitem(app.config, 'SEG_BACKEND', 'inline')
+    response = client.post('/api/image/seg', headers=auth_headers, json={'image_id': image_id, 'query': '结节'})
+    assert response.status_code == 202
+
+
+def test_seg_storage_source_reads_from_oss_endpoint(app, monkeypatch):
+    """测试 'storage' 来源和签名地址使用OSS endpoint，而不是CDN域名"""
+    from urllib.parse import urlparse
+    from segment import _image_from_storage
+    from utils import oss
+
+    class Stop(Exception):
+        pass
+
+    requested = []
+
+    def do_request(req, timeout):
+        requested.append(req.url)
+        raise Stop()
+
+    backend = oss.OssBackend(oss.bucket, oss.read_bucket)
+    monkeypatch.setattr(oss.uploader, 'backend', backend)
+    monkeypatch.setattr(oss.session, 'do_request', do_request)
+
+    with pytest.raises(Stop):
+        _image_from_storage(Image(oss_key='hidoc2/a.png'), app.config)
+    endpoint_host = urlparse(oss.oss_endpoint).netloc
+    assert urlparse(requested[0]).netloc == f"{oss.bucket_name}.{endpoint_host}"
+    assert urlparse(oss.signed_url('hidoc2/a.png', 60)).netloc == f"{oss.bucket_name}.{endpoint_host}"
+    assert urlparse(oss.custom_endpoint).netloc not in requested[0]
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset
+import utils.imaging
+from utils.imaging import window_volume
+
+
+def test_window_volume_minmax_is_consistent_across_slices(monkeypatch):
+    """
+    测试整体窗口下，不同切片中相同的原始值映射到相同的灰度
+    """
+    # 使用较小的分块，确保分块转换覆盖多个块
+    monkeypatch.setattr(utils.imaging, 'WINDOW_BLOCK', 3)
+    volume = np.zeros((8, 4, 4), dtype=np.int16)
+    volume[0] = 1000   # 第一帧整体很亮
+    volume[5] = 500
+    volume[7, 0, 0] = -1000
+
+    out = window_volume(volume, mode='minmax')
+
+    assert out.dtype == np.uint8
+    assert out.shape == volume.shape
+    assert out[0].min() == 255
+    assert out[7, 0, 0] == 0
+    # 值为0的体素无论在哪一帧都映射到同一个灰度
+    assert len(np.unique(out[volume == 0])) == 1
+    assert out[5, 1, 1] == int((500 + 1000) / 2000 * 255)
+
+
+def test_window_volume_percentile_clips_outliers():
+    """
+    测试分位数窗口不会被极端值压暗
+    """
+    volume = np.tile(np.arange(100, dtype=np.float32), (10, 10, 1))
+    volume[0, 0, 0] = 1e6
+
+    out = window_volume(volume, mode='percentile')
+
+    assert out[0, 0, 0] == 255
+    assert out[1, 1, 99] == 255
+    assert out[1, 1, 50] > 100
+
+
+def test_window_volume_dicom_window_center_width():
+    """
+    测试DICOM窗宽窗位按 Rescale 换算到存储值后生效
+    """
+    ds = Dataset()
+    ds.WindowCenter = 40
+    ds.WindowWidth = 400
+    ds.RescaleSlope = 1
+    ds.RescaleIntercept = -1024
+    # 存储值 = HU + 1024，窗口 [-160, 240] HU 对应存储值 [864, 1264]
+    volume = np.array([[[0, 864, 1064, 1264, 4000]]], dtype=np.uint16)
+
+    out = window_volume(volume, ds, mode='volume')
+
+    assert out.tolist() == [[[0, 0, 127, 255, 255]]]
+
+
+def test_window_volume_rejects_slice_mode():
+    with pytest.raises(ValueError):
+        window_volume(np.zeros((2, 2, 2)), mode='slice')
+
+
+def _write_multiframe_dicom(path, volume):
+    from pydicom.dataset import FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.NumberOfFrames, ds.Rows, ds.Columns = volume.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.PixelData = volume.tobytes()
+    ds.save_as(path, enforce_file_format=True)
+
+
+def test_load_volume_memory_maps_uncompressed_dicom(tmp_path):
+    """
+    测试未压缩的多帧DICOM以内存映射方式读取，且与 pydicom 解码结果一致
+    """
+    import pydicom
+    from utils.imaging import load_volume
+
+    volume = (np.random.rand(4, 30, 20) * 2000 - 1000).astype(np.int16)
+    path = str(tmp_path / 'volume.dcm')
+    _write_multiframe_dicom(path, volume)
+
+    pixels, ds = load_volume(path, 'dicom')
+
+    assert isinstance(pixels, np.memmap)
+    assert np.array_equal(pixels, volume)
+    assert np.array_equal(pixels, pydicom.dcmread(path).pixel_array)
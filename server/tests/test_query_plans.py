@@ -0,0 +1,78 @@
+import re
+from datetime import date
+from sqlalchemy import event
+from models import Hospital, Office, Patient, Case, Image, ImageSeg, AiAdvice, DoctorHospital
+from utils.response_cache import response_cache
+
+# 数据量会随使用持续增长的表，查询这些表时不允许全表扫描
+HOT_TABLES = ('image', 'case', 'image_seg', 'ai_advice')
+FULL_SCAN = re.compile(r'^SCAN (%s)(_\d+)?\b' % '|'.join(HOT_TABLES))
+
+
+def _full_scans(db, statements):
+    """用 SQLite 的 EXPLAIN QUERY PLAN 检查语句，返回其中对大表做全表 (或全索引) 扫描的计划"""
+    scans = []
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for statement, parameters in statements:
+            for row in cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters):
+                if FULL_SCAN.match(row[-1]):
+                    scans.append((row[-1], statement))
+    finally:
+        connection.close()
+    return scans
+
+
+def test_hot_endpoints_do_not_full_scan(client, app, db, doctor, auth_headers, monkeypatch):
+    """
+    测试影像、病历、AI记录相关的列表和统计接口的每条查询都能使用索引，不退化为全表扫描
+    """
+    monkeypatch.setattr(response_cache, 'backend', None)
+    monkeypatch.setitem(app.config, 'HOME_STATS_SOURCE', 'live')
+
+    hospital = Hospital(name='测试医院')
+    patient = Patient(name='张三', gender='男')
+    db.session.add_all([hospital, patient])
+    db.session.flush()
+    office = Office(name='放射科', hospital_id=hospital.id)
+    volume = Image(name='CT', format='nii', type='CT', dim='3D', creator_id=doctor.id, oss_key='v.nii', size=1,
+                   slice_x=1, slice_y=1, slice_z=2)
+    picture = Image(name='照片', format='picture', type='其他', dim='2D', creator_id=doctor.id, oss_key='p.png', size=1)
+    db.session.add_all([office, volume, picture, DoctorHospital(doc_id=doctor.id, hosp_id=hospital.id)])
+    db.session.flush()
+    db.session.add_all([
+        Case(patient_id=patient.id, office_id=office.id, doctor_id=doctor.id, case_date=date(2024, 1, 1)),
+        Image(name='z0', format='picture', type='CT', dim='2D', creator_id=doctor.id, oss_key='z0.png', size=1,
+              parent_image_id=volume.id, slice_direction='z', slice=0),
+        ImageSeg(image_id=picture.id, creator_id=doctor.id, oss_key='seg.png'),
+        AiAdvice(creator_id=doctor.id, patient_id=patient.id),
+    ])
+    db.session.commit()
+    requests = [
+        ('/api/image/list', {}),
+        (f'/api/image/{volume.id}', {'direction': 'z'}),
+        ('/api/image/seg/list', {'image_id': picture.id}),
+        ('/api/hospital/case', {'office_id': office.id}),
+        ('/api/patient/list', {}),
+        ('/api/patient/case', {'patient_id': patient.id}),
+        ('/api/patient/analyze', {'patient_id': patient.id}),
+        ('/api/home/data', {'hospital_id': hospital.id}),
+    ]
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        for path, args in requests:
+            response = client.get(path, headers=auth_headers, query_string=args)
+            assert response.status_code == 200, path
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+    assert statements
+    assert _full_scans(db, statements) == []
@@ -0,0 +1,58 @@
+import numpy as np
+import utils.render
+from utils.render import render_volume_slices
+
+
+def _render_all(volume, is_dicom, axes, workers):
+    return [(axis, i, buf.getvalue()) for axis, i, buf in render_volume_slices(volume, is_dicom, None, axes, workers)]
+
+
+def test_parallel_render_matches_serial(monkeypatch):
+    """
+    测试多进程渲染的切片与串行渲染逐字节一致，且顺序相同
+    """
+    # 让小体数据也走多进程路径
+    monkeypatch.setattr(utils.render, 'MIN_PARALLEL_SLICES', 0)
+    monkeypatch.setattr(utils.render, 'CHUNK_SIZE', 4)
+
+    # DICOM 多帧: (帧, 行, 列)
+    dicom_volume = (np.random.rand(6, 20, 18) * 4000).astype(np.int16)
+    axes = {'x': 18, 'y': 20, 'z': 6}
+    assert _render_all(dicom_volume, True, axes, 2) == _render_all(dicom_volume, True, axes, 1)
+
+    # NII: (x, y, z)
+    nii_volume = np.random.rand(10, 12, 7)
+    axes = {'x': 10, 'y': 12, 'z': 7}
+    serial = _render_all(nii_volume, False, axes, 1)
+    assert _render_all(nii_volume, False, axes, 2) == serial
+    assert [(axis, i) for axis, i, _ in serial][:2] == [('x', 0), ('x', 1)]
+
+
+def test_render_pool_shared_and_spawned():
+    """测试并行渲染使用共享的进程池: 同样大小只创建一次，以 spawn 方式启动子进程，进程数不超过CPU核数"""
+    import os
+    from utils.process_pool import shared_pool
+    pool = shared_pool(2)
+    assert shared_pool(2) is pool
+    assert pool._mp_context.get_start_method() == 'spawn'
+    assert shared_pool(10 ** 6)._max_workers == (os.cpu_count() or 1)
+
+
+def test_broken_render_pool_discarded_and_recreated(monkeypatch):
+    """测试工作进程异常退出后渲染失败并丢弃损坏的进程池，之后的渲染使用新建的进程池"""
+    import os
+    import pytest
+    from concurrent.futures.process import BrokenProcessPool
+    from utils.process_pool import shared_pool
+    monkeypatch.setattr(utils.render, 'MIN_PARALLEL_SLICES', 0)
+    volume = (np.random.rand(4, 8, 6) * 4000).astype(np.int16)
+    axes = {'x': 6, 'y': 8, 'z': 4}
+
+    broken = shared_pool(2)
+    with pytest.raises(BrokenProcessPool):
+        broken.submit(os._exit, 1).result()
+    with pytest.raises(BrokenProcessPool):
+        _render_all(volume, True, axes, 2)
+
+    assert shared_pool(2) is not broken
+    assert _render_all(volume, True, axes, 2) == _render_all(volume, True, axes, 1)
@@ -0,0 +1,33 @@
+import os
+import utils.slice_cache
+from utils.slice_cache import DiskLru
+
+
+def test_disk_lru_tracks_size_and_scans_only_when_full(tmp_path, monkeypatch):
+    """
+    测试磁盘缓存启动时扫描一次已有文件，容量内的写入只增减已用字节数不扫描目录，
+    超出容量时按访问时间淘汰最久未用的文件
+    """
+    (tmp_path / 'existing').write_bytes(b'x' * 40)
+    os.utime(tmp_path / 'existing', (1, 1))
+    cache = DiskLru(str(tmp_path), 100)
+    assert cache._size == 40
+
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(utils.slice_cache.os, 'scandir', lambda path: scans.append(path) or scandir(path))
+
+    cache.write('a', b'a' * 30)
+    cache.write('a', b'a' * 20)
+    assert cache._size == 60 and scans == []
+
+    source = tmp_path / 'upload.tmp'
+    source.write_bytes(b'b' * 30)
+    cache.put_file(str(source), cache.path('b'))
+    assert cache._size == 90 and scans == []
+
+    cache.write('c', b'c' * 30)
+    assert len(scans) == 1
+    assert not (tmp_path / 'existing').exists()
+    assert cache._size == 80 == sum(entry.stat().st_size for entry in scandir(tmp_path))
+    assert cache.read('a') == b'a' * 20
@@ -0,0 +1,220 @@
+import heapq
+import time
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from pypinyin import lazy_pinyin, Style
+from models import Patient
+from utils.ngrams import normalize
+
+
+def initials(name):
+    """姓名的拼音首字母，例如 张三丰 -> zsf；非汉字部分忽略"""
+    return ''.join(lazy_pinyin(name or '', style=Style.FIRST_LETTER, errors='ignore')).lower()
+
+
+def name_keys(name):
+    """一个病人在前缀树中的键: 归一化的姓名 (去掉空白) 和拼音首字母"""
+    return {key for key in (''.join(normalize(name).split()), initials(name)) if key}
+
+
+class _Node:
+    __slots__ = ('children', 'ids', 'top')
+
+    def __init__(self):
+        self.children = {}
+        # 以该节点为终点的键所属的记录ID
+        self.ids = set()
+        # 子树中排名最前的记录ID (ID越大越新越靠前)，None 表示需要重新计算
+        self.top = []
+
+
+class PrefixTrie:
+    """
+    前缀树，每个节点缓存子树中排名最前的 limit 个ID，查询只需沿前缀走到节点直接取出。
+    插入时沿路径增量更新缓存；删除时只有缓存中含该ID的节点需要在下次查询时重新计算。
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.root = _Node()
+
+    def insert(self, key, record_id):
+        node = self.root
+        for char in key:
+            node = node.children.setdefault(char, _Node())
+            if node.top is not None and record_id not in node.top:
+                node.top.append(record_id)
+                node.top.sort(reverse=True)
+                del node.top[self.limit:]
+        node.ids.add(record_id)
+
+    def remove(self, key, record_id):
+        path, node = [], self.root
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return
+            path.append(node)
+        node.ids.discard(record_id)
+        for node in path:
+            if node.top is not None and record_id in node.top:
+                node.top = None
+
+    def _collect(self, node):
+        ids, stack = set(), [node]
+        while stack:
+            current = stack.pop()
+            ids.update(current.ids)
+            stack.extend(current.children.values())
+        return heapq.nlargest(self.limit, ids)
+
+    def search(self, prefix, limit):
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return []
+        if node.top is None:
+            node.top = self._collect(node)
+        return node.top[:limit]
+
+
+class PatientTypeahead:
+    """
+    病人选择框的输入联想: 内存中的姓名和拼音首字母前缀树，查询不访问数据库。
+
+    - 首次查询时 (或启动时调用 build()) 从病人表整体加载
+    - 本进程中经ORM增删改病人并提交后立即更新前缀树
+    - 其他进程的修改依赖 TYPEAHEAD_REFRESH (秒) 后的整体重建，重建在后台线程中进行，期间仍使用旧的前缀树
+    - TYPEAHEAD_LIMIT 为单次查询最多返回的条数
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.limit = 10
+        self.refresh = 300
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._trie = None
+        self._patients = {}
+        self._built_at = None
+        self._building = False
+        # 重建期间提交的修改，重建完成后在新的前缀树上重放
+        self._pending = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TYPEAHEAD_LIMIT', 10)
+        app.config.setdefault('TYPEAHEAD_REFRESH', 300)
+        self.limit = app.config['TYPEAHEAD_LIMIT']
+        self.refresh = app.config['TYPEAHEAD_REFRESH']
+        self.app = app
+        app.extensions['patient_typeahead'] = self
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._trie = None
+            self._patients = {}
+            self._built_at = None
+
+    def build(self):
+        """从病人表整体加载前缀树，需要在应用上下文中调用"""
+        with self._lock:
+            self._pending = []
+        trie, patients = PrefixTrie(self.limit), {}
+        try:
+            for patient in Patient.query.yield_per(1000):
+                data = patient.to_dict()
+                patients[data['id']] = data
+                for key in name_keys(data['name']):
+                    trie.insert(key, data['id'])
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._trie, self._patients, self._built_at = trie, patients, time.monotonic()
+            for change in pending:
+                self._apply(*change)
+
+    def _refresh_in_context(self):
+        try:
+            with self.app.app_context():
+                self.build()
+        except Exception as e:
+            print(f"Patient typeahead refresh failed: {e}")
+        finally:
+            with self._lock:
+                self._building = False
+
+    def search(self, q, limit=None):
+        """返回姓名或拼音首字母以 q 开头的病人 (最新建档的在前)"""
+        prefix = ''.join(normalize(q).split())
+        if not prefix:
+            return []
+        limit = min(limit or self.limit, self.limit)
+        if self._trie is None:
+            # 并发的首次查询等待同一次加载，不重复加载
+            with self._build_lock:
+                if self._trie is None:
+                    self.build()
+        else:
+            with self._lock:
+                stale = self.refresh and time.monotonic() - self._built_at > self.refresh and not self._building
+                if stale:
+                    self._building = True
+            if stale:
+                threading.Thread(target=self._refresh_in_context, daemon=True).start()
+        with self._lock:
+            return [self._patients[record_id] for record_id in self._trie.search(prefix, limit)]
+
+    def _apply(self, action, data):
+        """在持有锁时更新前缀树: action 为 'put' (新增或修改) 或 'delete'"""
+        old = self._patients.pop(data['id'], None)
+        if old is not None:
+            for key in name_keys(old['name']):
+                self._trie.remove(key, old['id'])
+        if action == 'put':
+            self._patients[data['id']] = data
+            for key in name_keys(data['name']):
+                self._trie.insert(key, data['id'])
+
+    def apply(self, changes):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(changes)
+            if self._trie is None:
+                return
+            for change in changes:
+                self._apply(*change)
+
+
+patient_typeahead = PatientTypeahead()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_patient_changes(session, flush_context):
+    """记录本事务中新增、修改、删除的病人，提交后再更新前缀树"""
+    changes = session.info.setdefault('typeahead_changes', [])
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Patient):
+            changes.append(('put', obj.to_dict()))
+    for obj in session.deleted:
+        if isinstance(obj, Patient):
+            changes.append(('delete', {'id': obj.id}))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_patient_changes(session):
+    changes = session.info.pop('typeahead_changes', None)
+    if changes:
+        patient_typeahead.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_patient_changes(session):
+    session.info.pop('typeahead_changes', None)
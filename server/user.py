@@ -1,9 +1,14 @@
 import utils.jwtauth
 from flask import request, jsonify, Blueprint, make_response
 from models import db, Doctor, DoctorHospital, Hospital
+from utils.response_cache import response_cache
 
 user_bp = Blueprint('user', __name__)
 
+# 医院列表随医院信息和医生的医院归属变化
+response_cache.invalidate_on(Hospital, 'hospitals')
+response_cache.invalidate_on(DoctorHospital, 'hospitals', 'doc_id')
+
 @user_bp.route('/api/user/info', methods=['GET'])
 @utils.jwtauth.jwt_required
 def get_user_info():
@@ -18,6 +23,8 @@ def get_user_info():
 # 获取医生的医院列表。用于医生登录后选择自己的一个医院
 @user_bp.route('/api/user/hospitals', methods=['GET'])
 @utils.jwtauth.jwt_required
+# 300 秒只在 redis 后端生效，内存后端的失效不跨进程，过期时间不超过 RESPONSE_CACHE_MEMORY_MAX_TTL
+@response_cache.cached('hospitals', ttl=300)
 def get_user_hospitals():
     user_id = request.user_id
     
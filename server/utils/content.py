@@ -0,0 +1,19 @@
+def content_key(digest, suffix):
+    """
+    内容寻址的OSS键: 相同内容总是得到相同的键，重复上传时可以直接复用已存储的对象。
+    以哈希前两位分目录，避免单个前缀下对象过多。
+    """
+    return f"hidoc2/cas/{digest[:2]}/{digest}{suffix}"
+
+
+def derived_key(digest, name):
+    """
+    由原始文件内容派生的对象 (预览图、切片) 的OSS键。
+    同一原始文件用相同参数渲染出的结果总是相同，因此按原始文件的哈希寻址即可复用，无需逐张计算哈希。
+    """
+    return f"hidoc2/cas/{digest[:2]}/{digest}/{name}"
+
+
+def derived_slice_template(digest, windowing, direction):
+    """3D切片的OSS键模板，{index} 替换为切片索引"""
+    return derived_key(digest, f"{windowing}/{direction}/{{index}}.png")
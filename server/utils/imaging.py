@@ -0,0 +1,206 @@
+import io
+import os
+import numpy as np
+import pydicom
+from pydicom.pixel_data_handlers.util import apply_voi_lut
+from pydicom.uid import ImplicitVRLittleEndian, ExplicitVRLittleEndian
+import nibabel as nib
+from PIL import Image as PilImage
+
+# 大于该大小的DICOM元素延迟读取，像素数据在真正使用时才从文件读出
+DICOM_DEFER_SIZE = '1 MB'
+# 像素数据未压缩、可以直接内存映射的传输语法
+MMAP_TRANSFER_SYNTAXES = (ImplicitVRLittleEndian, ExplicitVRLittleEndian)
+
+# 切片方向与显示标签
+AXIS_LABELS = {'x': 'sagittal', 'y': 'coronal', 'z': 'axial'}
+
+
+# 体数据窗宽窗位模式:
+# - slice: 每张切片独立归一化 (旧行为)
+# - volume: 自动选择，DICOM 带 VOI LUT 或窗宽窗位时用 voi，否则用 minmax
+# - minmax: 整个体数据的最小/最大值
+# - percentile: 整个体数据的 0.5%/99.5% 分位数，可抑制金属伪影等极值
+# - voi: DICOM 的 VOI LUT 或 WindowCenter/WindowWidth
+WINDOW_MODES = ('slice', 'volume', 'minmax', 'percentile', 'voi')
+PERCENTILE_RANGE = (0.5, 99.5)
+# 估计分位数时最多采样的体素数
+PERCENTILE_SAMPLES = 1 << 20
+# 转换为 uint8 时每次处理的帧数，决定临时 float32 缓冲区的大小
+WINDOW_BLOCK = 16
+
+
+def encode_png(arr):
+    """将 uint8 灰度数组编码为PNG图像字节流"""
+    # 转换为灰度PIL图像
+    if arr.ndim == 2:
+        pil_img = PilImage.fromarray(arr, 'L')
+    else: # 对于可能存在的多通道数据，只取第一通道
+        pil_img = PilImage.fromarray(arr[:,:,0], 'L')
+
+    # 保存到内存缓冲区
+    img_buffer = io.BytesIO()
+    pil_img.save(img_buffer, format='PNG')
+    img_buffer.seek(0)
+
+    return img_buffer
+
+
+def convert_to_png(pixel_array, is_dicom, ds=None):
+    """
+    将DICOM或NII文件的像素数组转换为PNG图像字节流。
+    如果可用，会为DICOM应用VOI LUT。
+    """
+    # 归一化或应用LUT
+    if is_dicom and ds and 'VOILUTSequence' in ds:
+        # 应用VOI LUT
+        arr = apply_voi_lut(pixel_array, ds)
+    else:
+        # 其他情况进行简单的归一化
+        arr = pixel_array.astype(np.float32)
+        arr_min, arr_max = np.min(arr), np.max(arr)
+        if arr_max != arr_min:
+            arr = (arr - arr_min) / (arr_max - arr_min) * 255.0
+        else:
+            arr = np.zeros_like(arr)
+
+    return encode_png(arr.astype(np.uint8))
+
+
+def _dicom_window(ds):
+    """
+    将 DICOM 的 WindowCenter/WindowWidth (作用于经 Rescale 后的值) 换算为存储值上的窗口。
+    """
+    center, width = ds.WindowCenter, ds.WindowWidth
+    # 多个窗口时取第一个
+    center = float(center[0] if isinstance(center, pydicom.multival.MultiValue) else center)
+    width = float(width[0] if isinstance(width, pydicom.multival.MultiValue) else width)
+    slope = float(ds.get('RescaleSlope', 1) or 1)
+    intercept = float(ds.get('RescaleIntercept', 0) or 0)
+    low = (center - width / 2 - intercept) / slope
+    high = (center + width / 2 - intercept) / slope
+    return min(low, high), max(low, high)
+
+
+def _blocks(volume):
+    for start in range(0, volume.shape[0], WINDOW_BLOCK):
+        yield start, volume[start:start + WINDOW_BLOCK]
+
+
+def compute_window(volume, ds=None, mode='volume'):
+    """
+    对整个体数据统一计算一次窗口。
+    :param mode: WINDOW_MODES 中除 'slice' 外的模式
+    :return: (low, high, transform)，transform 为映射前需要先施加的 VOI LUT，没有则为 None
+    """
+    if mode not in WINDOW_MODES or mode == 'slice':
+        raise ValueError(f"不支持的窗口模式: {mode}")
+
+    has_voi = ds is not None and ('VOILUTSequence' in ds or 'WindowCenter' in ds)
+    if mode == 'volume':
+        mode = 'voi' if has_voi else 'minmax'
+    elif mode == 'voi' and not has_voi:
+        mode = 'minmax'
+
+    transform = None
+    if mode == 'voi' and 'VOILUTSequence' in ds:
+        # 非线性 LUT: 先整体求出 LUT 输出的范围，再逐块映射到 0-255
+        transform = lambda block: apply_voi_lut(block, ds)
+        low = min(float(transform(block).min()) for _, block in _blocks(volume))
+        high = max(float(transform(block).max()) for _, block in _blocks(volume))
+    elif mode == 'voi':
+        low, high = _dicom_window(ds)
+    elif mode == 'percentile':
+        step = max(1, volume.size // PERCENTILE_SAMPLES)
+        sample = volume.ravel(order='K')[::step]
+        low, high = (float(v) for v in np.percentile(sample, PERCENTILE_RANGE))
+    else:
+        low, high = float(volume.min()), float(volume.max())
+    return low, high, transform
+
+
+def apply_window(arr, window, out=None):
+    """按 compute_window 得到的窗口把任意形状的数组映射为 uint8"""
+    low, high, transform = window
+    if transform:
+        arr = transform(arr)
+    scale = np.float32(255.0 / (high - low)) if high > low else np.float32(0)
+    arr = arr.astype(np.float32)
+    arr -= np.float32(low)
+    arr *= scale
+    np.clip(arr, 0, 255, out=arr)
+    if out is None:
+        return arr.astype(np.uint8)
+    out[...] = arr
+    return out
+
+
+def window_volume(volume, ds=None, mode='volume'):
+    """
+    对整个体数据统一计算一次窗口，并转换为 uint8 体数据。
+    转换按帧分块进行，临时 float32 缓冲区只有 WINDOW_BLOCK 帧大小，
+    不会像逐切片归一化那样为每张切片各复制一份 float32 数组。
+
+    :param mode: WINDOW_MODES 中除 'slice' 外的模式
+    :return: 与 volume 形状相同的 uint8 数组
+    """
+    window = compute_window(volume, ds, mode)
+    out = np.empty(volume.shape, dtype=np.uint8)
+    for start, block in _blocks(volume):
+        apply_window(block, window, out=out[start:start + block.shape[0]])
+    return out
+
+
+def upload_suffix(filename):
+    """返回上传文件的扩展名，NII 的双扩展名 .nii.gz 需要完整保留以便 nibabel 识别"""
+    if filename and filename.endswith('.nii.gz'):
+        return '.nii.gz'
+    return os.path.splitext(filename or '')[1]
+
+
+def _memmap_dicom_pixels(path, ds):
+    """
+    未压缩的单通道DICOM直接对文件中的像素数据做只读内存映射，不整体读入内存。
+    不满足条件时返回 None。
+    """
+    raw = ds.get_item('PixelData')
+    if raw is None or getattr(raw, 'value_tell', None) is None:
+        return None
+    if ds.file_meta.get('TransferSyntaxUID') not in MMAP_TRANSFER_SYNTAXES:
+        return None
+    if ds.get('SamplesPerPixel', 1) != 1 or ds.get('BitsAllocated') not in (8, 16, 32):
+        return None
+    # 有符号且存储位数小于分配位数时需要符号扩展，交给 pydicom 处理
+    if ds.PixelRepresentation == 1 and ds.BitsStored != ds.BitsAllocated:
+        return None
+
+    frames = int(ds.get('NumberOfFrames', 1) or 1)
+    shape = (frames, ds.Rows, ds.Columns) if frames > 1 else (ds.Rows, ds.Columns)
+    dtype = np.dtype(f"<{'i' if ds.PixelRepresentation == 1 else 'u'}{ds.BitsAllocated // 8}")
+    return np.memmap(path, dtype=dtype, mode='r', offset=raw.value_tell, shape=shape)
+
+
+def load_volume(path, img_format, native=False):
+    """
+    读取影像文件的像素数组，返回 (pixel_array, ds)。NII 文件的 ds 为 None。
+    未压缩的DICOM和NII尽量以内存映射方式读取，避免把整个研究读入内存。
+    native 为 True 时 NII 保留文件中的原始数据类型，而不是统一转换为 float64。
+    """
+    if img_format == 'dicom':
+        ds = pydicom.dcmread(path, defer_size=DICOM_DEFER_SIZE)
+        pixels = _memmap_dicom_pixels(path, ds)
+        return (pixels if pixels is not None else ds.pixel_array), ds
+    nii = nib.load(path, mmap=True)
+    return (np.asanyarray(nii.dataobj) if native else nii.get_fdata()), None
+
+
+def extract_slice(pixel_array, axis_name, index, is_dicom):
+    """
+    按方向和索引从3D像素数组中取出一个2D切片。
+    """
+    if axis_name == 'z':
+        return pixel_array[index, :, :] if is_dicom else pixel_array[:, :, index].T
+    elif axis_name == 'y':
+        return pixel_array[:, index, :] if is_dicom else pixel_array[:, index, :].T
+    else: # x
+        return pixel_array[:, :, index] if is_dicom else pixel_array[index, :, :].T
@@ -0,0 +1,41 @@
+import re
+import unicodedata
+from collections import Counter
+
+# 连续的文字 (汉字、字母、数字) 为一段，标点和空白只作分隔
+_RUN = re.compile(r'[^\W_]+')
+
+
+def normalize(text):
+    """全角转半角、大写转小写，索引和查询使用相同的归一化"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def runs(text):
+    return _RUN.findall(normalize(text))
+
+
+def index_grams(text):
+    """
+    文本的索引词元及出现次数: 每段文字的所有相邻二元组，外加该段的最后一个字。
+    这样每个字都是某个词元的首字，单字查询可以按词元前缀检索。
+    汉字不需要分词，按二元组检索即可匹配任意位置的子串。
+    """
+    grams = Counter()
+    for run in runs(text):
+        grams.update(run[i:i + 2] for i in range(len(run) - 1))
+        grams[run[-1]] += 1
+    return grams
+
+
+def query_terms(text):
+    """
+    查询串的检索词元，文本须包含其中所有的词元才算匹配:
+    - 长度不少于 2 的段取全部二元组，与索引词元精确匹配
+    - 单字段取该字本身，匹配以该字开头的索引词元
+    """
+    terms = []
+    for run in runs(text):
+        terms.extend([run] if len(run) == 1 else (run[i:i + 2] for i in range(len(run) - 1)))
+    # 去重并保持顺序
+    return list(dict.fromkeys(terms))
@@ -1,16 +1,220 @@
 import oss2
 import os
+import time
+import random
+import shutil
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 access_key_id = 'LTAI5tHP6zqRhFLCkbCcZ2t1'
 access_key_secret = 'VdZs0WNoUvi1zrIpvCnQ4Sk2kJMVa7'
 bucket_name = 'emberauthor'
 custom_endpoint = 'https://cdn.ember.ac.cn'
 
-# 创建认证对象  
+# 并发上传线程数，同时也是 HTTP keep-alive 连接池的大小
+UPLOAD_WORKERS = 16
+# 单个对象上传失败后的重试次数，以及指数退避的基准等待秒数
+UPLOAD_RETRIES = 3
+UPLOAD_BACKOFF = 0.5
+# 超过该大小的本地文件使用分片上传，分片大小与单文件分片并发数
+MULTIPART_THRESHOLD = 20 * 1024 * 1024
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+MULTIPART_THREADS = 4
+
+# 创建认证对象
 auth = oss2.Auth(access_key_id, access_key_secret)
 
+# 所有请求复用同一个连接池，避免每次上传重新建立TLS连接
+session = oss2.Session(pool_size=UPLOAD_WORKERS)
+
 # 创建 Bucket 对象
-bucket = oss2.Bucket(auth, custom_endpoint, bucket_name, is_cname=True)
+bucket = oss2.Bucket(auth, custom_endpoint, bucket_name, is_cname=True, session=session)
+
+# 服务端读取和签名直接访问 bucket 所在地域的OSS endpoint，不经过CDN；CDN域名只用于拼接公开访问URL。
+# 与OSS同地域部署时设置 HIDOC_OSS_INTERNAL=1 走内网 endpoint，或用 HIDOC_OSS_ENDPOINT 直接指定
+oss_region = os.environ.get('HIDOC_OSS_REGION', 'cn-hangzhou')
+oss_endpoint = os.environ.get('HIDOC_OSS_ENDPOINT') or (
+    f"https://oss-{oss_region}-internal.aliyuncs.com" if os.environ.get('HIDOC_OSS_INTERNAL') == '1'
+    else f"https://oss-{oss_region}.aliyuncs.com"
+)
+read_bucket = oss2.Bucket(auth, oss_endpoint, bucket_name, session=session)
+
+
+class UploadError(Exception):
+    """对象上传失败"""
+
+
+UploadResult = namedtuple('UploadResult', ['key', 'url', 'error'])
+
+
+class OssBackend:
+    """阿里云OSS存储后端，read_bucket 用于下载和签名，未指定时与上传使用同一个 bucket"""
+
+    def __init__(self, bucket, read_bucket=None):
+        self.bucket = bucket
+        self.read_bucket = read_bucket or bucket
+
+    def put(self, key, data):
+        result = self.bucket.put_object(key, data)
+        if result.status != 200:
+            raise UploadError(f"OSS upload failed with status: {result.status}")
+
+    def put_file(self, key, path):
+        # 小文件直接 put_object，大文件自动分片上传，失败的分片可断点续传
+        oss2.resumable_upload(
+            self.bucket, key, path,
+            multipart_threshold=MULTIPART_THRESHOLD,
+            part_size=MULTIPART_PART_SIZE,
+            num_threads=MULTIPART_THREADS
+        )
+
+    def get_to_file(self, key, path):
+        self.read_bucket.get_object_to_file(key, path)
+
+    def get(self, key):
+        return self.read_bucket.get_object(key).read()
+
+    def sign_url(self, key, expires):
+        # 私有读的对象也可以通过签名地址在有效期内直接下载
+        return self.read_bucket.sign_url('GET', key, expires)
+
+
+class LocalBackend:
+    """本地文件系统存储后端，用于开发环境和脱离阿里云的性能测试"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+
+    def put_file(self, key, path):
+        path_to = self._path(key)
+        os.makedirs(os.path.dirname(path_to), exist_ok=True)
+        shutil.copyfile(path, path_to)
+
+    def get_to_file(self, key, path):
+        shutil.copyfile(self._path(key), path)
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+
+class MemoryBackend:
+    """内存存储后端，用于测试"""
+
+    def __init__(self):
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, data):
+        content = bytes(data) if isinstance(data, (bytes, bytearray)) else data.read()
+        with self._lock:
+            self.objects[key] = content
+
+    def put_file(self, key, path):
+        with open(path, 'rb') as f:
+            self.put(key, f)
+
+    def get_to_file(self, key, path):
+        with open(path, 'wb') as f:
+            f.write(self.objects[key])
+
+    def get(self, key):
+        return self.objects[key]
+
+
+class Uploader:
+    """
+    带重试的并发上传器。
+    所有上传共享一个有界线程池，失败时按指数退避重试。
+    """
+
+    def __init__(self, backend, max_workers=UPLOAD_WORKERS, retries=UPLOAD_RETRIES, backoff=UPLOAD_BACKOFF):
+        self.backend = backend
+        self.retries = retries
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hidoc-upload')
+
+    def put(self, key, data):
+        """
+        上传单个对象，失败时重试，全部失败则抛出 UploadError。
+        data 可以是 bytes 或文件流；文件流会在每次重试前回到起始位置。
+        :return: 文件的公开访问URL
+        """
+        start = data.tell() if hasattr(data, 'seek') else None
+        for attempt in range(self.retries + 1):
+            try:
+                if start is not None:
+                    data.seek(start)
+                self.backend.put(key, data)
+                return f"{custom_endpoint}/{key}"
+            except Exception as e:
+                if attempt == self.retries:
+                    raise UploadError(f"{key}: {e}") from e
+                # 指数退避，加入随机抖动避免并发请求同时重试
+                time.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+
+    def put_file(self, key, path):
+        """
+        上传本地文件，大文件分片上传而不是整体读入内存，失败时重试。
+        :return: 文件的公开访问URL
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                self.backend.put_file(key, path)
+                return f"{custom_endpoint}/{key}"
+            except Exception as e:
+                if attempt == self.retries:
+                    raise UploadError(f"{key}: {e}") from e
+                time.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+
+    def upload_batch(self, items):
+        """
+        并发上传多个对象。
+        :param items: (key, bytes或文件流) 的可迭代对象
+        :return: 与输入顺序一致的 UploadResult 列表，失败项的 url 为 None、error 为错误信息
+        """
+        futures = [(key, self._executor.submit(self.put, key, data)) for key, data in items]
+        results = []
+        for key, future in futures:
+            try:
+                results.append(UploadResult(key, future.result(), None))
+            except UploadError as e:
+                results.append(UploadResult(key, None, str(e)))
+        return results
+
+
+def _default_backend():
+    """通过环境变量 HIDOC_STORAGE 选择存储后端: oss (默认) / local / memory"""
+    kind = os.environ.get('HIDOC_STORAGE', 'oss')
+    if kind == 'local':
+        return LocalBackend(os.environ.get('HIDOC_STORAGE_DIR', os.path.join(os.getcwd(), 'storage')))
+    if kind == 'memory':
+        return MemoryBackend()
+    return OssBackend(bucket, read_bucket)
+
+
+uploader = Uploader(_default_backend())
+
+
+def use_backend(backend):
+    """切换全局上传器使用的存储后端，返回原来的后端"""
+    previous = uploader.backend
+    uploader.backend = backend
+    return previous
+
 
 def upload_to_oss(file_storage, object_name):
     """
@@ -21,17 +225,36 @@ def upload_to_oss(file_storage, object_name):
     :return: 上传成功则返回文件URL，否则返回None
     """
     try:
-        # 使用 put_object 方法上传文件流
-        result = bucket.put_object(object_name, file_storage)
-        
-        # 如果HTTP状态码是200，说明上传成功
-        if result.status == 200:
-            # 构建文件的公开访问URL
-            file_url = f"{custom_endpoint}/{object_name}"
-            return file_url
-        else:
-            print(f"OSS upload failed with status: {result.status}")
-            return None
-    except oss2.exceptions.OssError as e:
+        return uploader.put(object_name, file_storage)
+    except UploadError as e:
         print(f"Error uploading to OSS: {e}")
         return None
+
+
+def upload_file_to_oss(path, object_name):
+    """
+    将本地文件上传到阿里云OSS，大文件自动分片上传。
+    :return: 上传成功则返回文件URL，否则返回None
+    """
+    try:
+        return uploader.put_file(object_name, path)
+    except UploadError as e:
+        print(f"Error uploading to OSS: {e}")
+        return None
+
+
+def download_from_oss(object_name, path):
+    """将OSS上的对象下载到本地文件"""
+    uploader.backend.get_to_file(object_name, path)
+
+
+def read_from_oss(object_name):
+    """读取OSS上对象的全部内容，使用与上传相同的连接池"""
+    return uploader.backend.get(object_name)
+
+
+def signed_url(object_name, expires):
+    """对象的临时下载地址；存储后端不支持签名时返回公开访问地址"""
+    if hasattr(uploader.backend, 'sign_url'):
+        return uploader.backend.sign_url(object_name, expires)
+    return f"{custom_endpoint}/{object_name}"
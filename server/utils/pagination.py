@@ -0,0 +1,131 @@
+import json
+import base64
+from datetime import date, datetime
+from flask import request
+from sqlalchemy import and_, or_
+
+
+class InvalidCursor(ValueError):
+    """游标无法解析或与当前列表的排序键不匹配"""
+
+
+def _encode_value(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
+def _decode_value(column, value):
+    python_type = column.type.python_type
+    if value is None:
+        return None
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is date:
+        return date.fromisoformat(value)
+    return python_type(value)
+
+
+def encode_cursor(keys, item, direction):
+    """
+    把一条记录的排序键值编码为不透明的游标字符串。
+    :param direction: 'next' 取该记录之后的一页，'prev' 取该记录之前的一页
+    """
+    payload = {'d': direction, 'v': [_encode_value(getattr(item, column.key)) for column in keys]}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(keys, cursor):
+    """解析游标，返回 (方向, 排序键值列表)，游标无效时抛出 InvalidCursor"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        direction, values = payload['d'], payload['v']
+        if direction not in ('next', 'prev') or len(values) != len(keys):
+            raise InvalidCursor('游标与列表的排序不匹配')
+        return direction, [_decode_value(column, value) for column, value in zip(keys, values)]
+    except InvalidCursor:
+        raise
+    except (ValueError, TypeError, KeyError) as e:
+        raise InvalidCursor(f'无效的游标: {e}') from e
+
+
+def _beyond(keys, values, older=True):
+    """
+    按降序排序键取位于 values 之后 (older=True，更旧) 或之前 (更新) 的记录。
+    展开为 (a < x) OR (a = x AND b < y) ... 的形式，各数据库都能据此使用 (a, b) 上的索引做范围扫描。
+    可为空的列 (例如旧数据的 created_at) 按 MySQL、SQLite 的规则把 NULL 视为最小值、降序时排在最后，
+    与 NULL 的比较单独展开为 IS NULL / IS NOT NULL，否则这些记录会被跳过或提前结束翻页。
+    """
+    clauses = []
+    for i, (column, value) in enumerate(zip(keys, values)):
+        # 与 None 比较相等时生成 IS NULL
+        equal = [keys[j] == values[j] for j in range(i)]
+        nullable = getattr(column.expression, 'nullable', True)
+        if older:
+            if value is None:
+                continue
+            step = or_(column < value, column.is_(None)) if nullable else column < value
+        else:
+            step = column.isnot(None) if value is None else column > value
+        clauses.append(and_(*equal, step))
+    return or_(*clauses)
+
+
+def paginate(query, keys):
+    """
+    按请求参数对查询分页，所有列表接口共用。返回 (当前页记录, 分页信息)。
+
+    :param keys: 排序键列，全部按降序排列，最后一列必须唯一 (一般是主键)
+
+    请求参数:
+    - 页码模式 (默认，兼容已有客户端): page, per_page。
+      返回 page / per_page / total_pages / total_items / has_next / has_prev
+    - 游标模式: 传入 cursor 参数即启用，首页传空字符串，之后原样传回上一次返回的 next_cursor 或 prev_cursor。
+      按排序键做范围查询，不使用 OFFSET，翻到多深都只读取一页的数据。
+      返回 per_page / next_cursor / prev_cursor / has_next / has_prev
+    - with_total: 是否统计总数。页码模式默认统计，游标模式默认不统计；统计总数需要一次额外的 COUNT 查询。
+    游标无效时抛出 InvalidCursor。
+    """
+    per_page = request.args.get('per_page', 10, type=int)
+    cursor = request.args.get('cursor')
+    with_total = request.args.get('with_total')
+    ordered = query.order_by(*[column.desc() for column in keys])
+
+    if cursor is None:
+        count = with_total != 'false'
+        pagination = ordered.paginate(page=request.args.get('page', 1, type=int), per_page=per_page,
+                                      error_out=False, count=count)
+        return pagination.items, {
+            'page': pagination.page,
+            'per_page': pagination.per_page,
+            'total_pages': pagination.pages if count else None,
+            'total_items': pagination.total,
+            'has_next': pagination.has_next if count else len(pagination.items) == per_page,
+            'has_prev': pagination.has_prev
+        }
+
+    per_page = max(per_page, 1)
+    direction, values = decode_cursor(keys, cursor) if cursor else ('next', None)
+    if direction == 'next':
+        page_query = ordered if values is None else ordered.filter(_beyond(keys, values))
+    else:
+        # 向前翻页时反向排序取紧邻游标的一页，再恢复为降序
+        page_query = query.filter(_beyond(keys, values, older=False)).order_by(*[column.asc() for column in keys])
+    # 多取一条用于判断游标方向上是否还有更多记录
+    items = page_query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'prev':
+        items.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, values is not None
+
+    result = {
+        'per_page': per_page,
+        'next_cursor': encode_cursor(keys, items[-1], 'next') if has_next and items else None,
+        'prev_cursor': encode_cursor(keys, items[0], 'prev') if has_prev and items else None,
+        'has_next': has_next and bool(items),
+        'has_prev': has_prev and bool(items),
+    }
+    if with_total == 'true':
+        result['total_items'] = query.order_by(None).count()
+    return items, result
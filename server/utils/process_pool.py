@@ -0,0 +1,34 @@
+import os
+import threading
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+
+# 按进程数缓存的共享进程池
+_pools = {}
+_lock = threading.Lock()
+
+
+def shared_pool(workers=None):
+    """
+    返回共享的进程池，进程数为 workers (默认且最多为CPU核数)。
+    同样大小的进程池只创建一次，由所有任务共用，多个任务同时执行时子任务排队，进程总数不会随任务数增加。
+
+    子进程以 spawn 方式启动: Web进程中同时有请求线程和后台任务线程，fork 会把其他线程持有的锁
+    (日志、数据库连接池、OSS会话等) 以加锁状态复制到子进程，子进程用到时会死锁。
+    """
+    cpus = os.cpu_count() or 1
+    size = min(workers or cpus, cpus)
+    with _lock:
+        pool = _pools.get(size)
+        if pool is None:
+            pool = _pools[size] = ProcessPoolExecutor(max_workers=size, mp_context=get_context('spawn'))
+        return pool
+
+
+def discard_pool(pool):
+    """子进程异常退出后进程池不再可用，丢弃它，下次调用 shared_pool 时重新创建"""
+    with _lock:
+        for size, cached in list(_pools.items()):
+            if cached is pool:
+                del _pools[size]
+    pool.shutdown(wait=False, cancel_futures=True)
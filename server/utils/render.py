@@ -0,0 +1,106 @@
+import io
+import os
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import wait
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from pydicom.dataset import Dataset
+from utils.imaging import convert_to_png, encode_png, extract_slice
+from utils.process_pool import shared_pool, discard_pool
+
+# 每个子任务渲染的切片数，过小会放大进程间通信开销
+CHUNK_SIZE = 16
+# 切片总数低于该值时直接在当前线程渲染，避免写共享内存文件和进程间通信的开销
+MIN_PARALLEL_SLICES = 48
+
+
+def _shared_dir(nbytes):
+    """优先使用内存文件系统 /dev/shm，空间不足时退回系统临时目录"""
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and shutil.disk_usage(shm).free > nbytes * 1.1:
+        return shm
+    return tempfile.gettempdir()
+
+
+def _lut_header(ds):
+    """
+    只保留 VOI LUT 计算需要的文件头，避免把像素数据传给每个工作进程。
+    没有 VOI LUT 时 convert_to_png 不使用 ds，直接返回 None。
+    """
+    if ds is None or 'VOILUTSequence' not in ds:
+        return None
+    header = Dataset()
+    for elem in ds:
+        if elem.keyword != 'PixelData':
+            header.add(elem)
+    return header
+
+
+def _render_slice(volume, axis_name, index, is_dicom, ds, prewindowed):
+    slice_arr = extract_slice(volume, axis_name, index, is_dicom)
+    if prewindowed:
+        return encode_png(slice_arr)
+    return convert_to_png(slice_arr, is_dicom, ds)
+
+
+def _render_chunk(volume_path, is_dicom, ds, prewindowed, axis_name, start, stop):
+    # 以只读内存映射方式打开，各工作进程共享同一份物理内存；打开映射只读取文件头，每个子任务各自打开
+    volume = np.load(volume_path, mmap_mode='r')
+    return [
+        (axis_name, i, _render_slice(volume, axis_name, i, is_dicom, ds, prewindowed).getvalue())
+        for i in range(start, stop)
+    ]
+
+
+def render_volume_slices(pixel_array, is_dicom, ds, axes, workers=None, prewindowed=False):
+    """
+    渲染3D像素数组在各方向上的切片PNG，按 axes 的顺序逐张产出 (方向, 索引, PNG缓冲区)。
+
+    体数据只写入一次共享内存文件，工作进程以内存映射方式读取，不会为每个任务复制整个体数据。
+    并行渲染使用 utils.process_pool 的共享进程池，多个任务同时渲染时共用这些进程。
+    每张切片仍由 convert_to_png 生成，输出与串行渲染逐字节一致。
+
+    :param axes: {'x': 切片数, 'y': 切片数, 'z': 切片数}
+    :param workers: 共享进程池的进程数，默认且最多为CPU核数；为1时在当前线程串行渲染
+    :param prewindowed: pixel_array 已经过 window_volume 转换为 uint8，切片直接编码，不再逐张归一化
+    """
+    workers = workers or os.cpu_count() or 1
+    total = sum(axes.values())
+
+    if workers <= 1 or total < MIN_PARALLEL_SLICES:
+        for axis_name, slice_count in axes.items():
+            for i in range(slice_count):
+                yield axis_name, i, _render_slice(pixel_array, axis_name, i, is_dicom, ds, prewindowed)
+        return
+
+    volume_path = os.path.join(_shared_dir(pixel_array.nbytes), f"hidoc_volume_{uuid.uuid4().hex}.npy")
+    np.save(volume_path, pixel_array)
+    try:
+        chunks = [
+            (axis_name, start, min(start + CHUNK_SIZE, slice_count))
+            for axis_name, slice_count in axes.items()
+            for start in range(0, slice_count, CHUNK_SIZE)
+        ]
+        header = _lut_header(ds)
+        pool = shared_pool(workers)
+        futures = []
+        try:
+            # 进程池已损坏时提交就会失败，同样需要丢弃
+            futures = [pool.submit(_render_chunk, volume_path, is_dicom, header, prewindowed, *chunk)
+                       for chunk in chunks]
+            # 按提交顺序取结果，同时保持所有子任务并行执行
+            for future in futures:
+                for axis_name, i, png_bytes in future.result():
+                    yield axis_name, i, io.BytesIO(png_bytes)
+        except BrokenProcessPool:
+            discard_pool(pool)
+            raise
+        finally:
+            # 调用方提前中止(例如上传失败)时，取消尚未开始的子任务，等已开始的子任务结束后再删除体数据文件
+            for future in futures:
+                future.cancel()
+            wait(futures)
+    finally:
+        os.remove(volume_path)
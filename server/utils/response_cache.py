@@ -0,0 +1,237 @@
+import json
+import time
+import hashlib
+import threading
+from functools import wraps
+from collections import OrderedDict
+from flask import request, make_response, current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+
+class MemoryBackend:
+    """
+    进程内 LRU 缓存，按条目数限制容量，条目到期后在读取时丢弃，线程安全。
+    多进程部署时各进程各自缓存，失效只作用于本进程，其他进程依赖 TTL 过期，
+    因此过期时间不超过 RESPONSE_CACHE_MEMORY_MAX_TTL。
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.monotonic() + ttl, value)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def versions(self, keys):
+        with self._lock:
+            return [self._versions.get(key, 0) for key in keys]
+
+    def incr(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._versions.clear()
+
+
+class RedisBackend:
+    """
+    Redis (或兼容 Redis 协议的服务) 缓存，多个进程共享缓存和失效版本号。
+    """
+
+    def __init__(self, url, prefix):
+        # 仅在启用 redis 后端时才需要安装 redis
+        from redis import Redis
+        self.redis = Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.redis.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.redis.set(self.prefix + key, value, ex=ttl)
+
+    def versions(self, keys):
+        return [int(value or 0) for value in self.redis.mget([self.prefix + key for key in keys])]
+
+    def incr(self, key):
+        self.redis.incr(self.prefix + key)
+
+    def clear(self):
+        for key in self.redis.scan_iter(match=self.prefix + '*', count=1000):
+            self.redis.delete(key)
+
+
+class ResponseCache:
+    """
+    读接口的响应缓存。
+
+    - @response_cache.cached('名称', ttl=秒) 放在 jwt_required 之后，按 (接口名称, 用户, 路径, 查询参数) 缓存 200 响应
+    - invalidate_on(模型, '名称', 所属用户字段) 登记失效规则: 该模型的记录经ORM增删改并提交后，
+      所属用户 (字段为 None 时为所有用户) 在该接口上的缓存失效
+    - 失效通过递增版本号实现，版本号是缓存键的一部分，无需逐个删除缓存键；
+      版本号在执行接口前读取，与提交并发的请求写入的旧数据落在旧版本的键上，不会被读到
+
+    配置:
+    - RESPONSE_CACHE_BACKEND: 'memory' (默认，进程内 LRU)、'redis' 或 'none' (不缓存)
+    - RESPONSE_CACHE_TTL: 默认过期时间 (秒)；RESPONSE_CACHE_TTLS 可按接口名称覆盖
+    - RESPONSE_CACHE_MAX_ENTRIES: 内存后端的最大条目数
+    - RESPONSE_CACHE_MEMORY_MAX_TTL: 内存后端的过期时间上限 (秒)，默认 30。内存后端的失效不跨进程，
+      其他进程中的旧响应最多保留这么久；多进程部署要使用接口上更长的过期时间 (如科室、医院列表的 300 秒)
+      时应使用 redis 后端
+    - RESPONSE_CACHE_REDIS_URL / RESPONSE_CACHE_PREFIX: redis 后端的连接地址和键前缀
+    缓存后端出错时直接执行接口，不影响请求。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.rules = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_BACKEND', 'memory')
+        app.config.setdefault('RESPONSE_CACHE_TTL', 30)
+        app.config.setdefault('RESPONSE_CACHE_TTLS', {})
+        app.config.setdefault('RESPONSE_CACHE_MAX_ENTRIES', 2048)
+        app.config.setdefault('RESPONSE_CACHE_MEMORY_MAX_TTL', 30)
+        app.config.setdefault('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+        app.config.setdefault('RESPONSE_CACHE_PREFIX', 'hidoc:response:')
+        self.app = app
+        self.configure(app.config['RESPONSE_CACHE_BACKEND'])
+        app.extensions['response_cache'] = self
+
+    def configure(self, backend):
+        """切换缓存后端，测试中也用它改为 'none' 关闭缓存"""
+        config = self.app.config
+        config['RESPONSE_CACHE_BACKEND'] = backend
+        if backend == 'memory':
+            self.backend = MemoryBackend(config['RESPONSE_CACHE_MAX_ENTRIES'])
+        elif backend == 'redis':
+            self.backend = RedisBackend(config['RESPONSE_CACHE_REDIS_URL'], config['RESPONSE_CACHE_PREFIX'])
+        elif backend == 'none':
+            self.backend = None
+        else:
+            raise ValueError(f'未知的响应缓存后端: {backend}')
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    @staticmethod
+    def _version_keys(name, user_id):
+        return [f"v:{name}", f"v:{name}:{user_id}"]
+
+    def _key(self, name, user_id, versions):
+        args = sorted(request.args.items(multi=True))
+        digest = hashlib.sha1(json.dumps([request.path, args]).encode('utf-8')).hexdigest()
+        return f"{name}:{':'.join(map(str, versions))}:{user_id}:{digest}"
+
+    def cached(self, name, ttl=None):
+        """缓存读接口的成功响应，响应头 X-Cache 标明是否命中"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                backend = self.backend
+                if backend is None:
+                    return view(*args, **kwargs)
+                user_id = request.user_id
+                try:
+                    key = self._key(name, user_id, backend.versions(self._version_keys(name, user_id)))
+                    body = backend.get(key)
+                except Exception as e:
+                    print(f"Response cache unavailable: {e}")
+                    return view(*args, **kwargs)
+                if body is not None:
+                    response = current_app.response_class(body, mimetype='application/json')
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    expires = self.app.config['RESPONSE_CACHE_TTLS'].get(
+                        name, ttl or self.app.config['RESPONSE_CACHE_TTL'])
+                    if isinstance(backend, MemoryBackend):
+                        expires = min(expires, self.app.config['RESPONSE_CACHE_MEMORY_MAX_TTL'])
+                    try:
+                        backend.set(key, response.get_data(), expires)
+                    except Exception as e:
+                        print(f"Response cache unavailable: {e}")
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
+
+    def invalidate(self, name, user_id=None):
+        """使接口缓存失效: 指定用户的，或 user_id 为 None 时所有用户的"""
+        if self.backend is None:
+            return
+        keys = self._version_keys(name, user_id)
+        try:
+            self.backend.incr(keys[0] if user_id is None else keys[1])
+        except Exception as e:
+            print(f"Response cache unavailable: {e}")
+
+    def invalidate_on(self, model, name, owner=None):
+        """
+        登记失效规则。owner 为模型上记录所属用户ID的属性名，修改了该属性时新旧用户的缓存都失效。
+        """
+        self.rules.append((model, name, owner))
+
+    def collect(self, obj, changed):
+        for model, name, owner in self.rules:
+            if not isinstance(obj, model):
+                continue
+            if owner is None:
+                changed.add((name, None))
+                continue
+            changed.add((name, getattr(obj, owner)))
+            for previous in inspect(obj).attrs[owner].history.deleted:
+                changed.add((name, previous))
+
+
+response_cache = ResponseCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    """记录本事务中影响缓存的修改，提交后再失效，回滚则丢弃"""
+    if not response_cache.rules:
+        return
+    changed = session.info.setdefault('response_cache_changes', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        response_cache.collect(obj, changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changes(session):
+    changed = session.info.pop('response_cache_changes', None)
+    for name, user_id in changed or ():
+        response_cache.invalidate(name, user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('response_cache_changes', None)
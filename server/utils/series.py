@@ -0,0 +1,194 @@
+import io
+import os
+import struct
+import hashlib
+import zipfile
+from collections import Counter, defaultdict
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pydicom
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from utils.process_pool import shared_pool, discard_pool
+
+# 文件数低于该值时在当前进程读取文件头，避免进程间通信的开销
+MIN_PARALLEL_FILES = 64
+# 每个子任务读取的文件数
+HEADER_CHUNK = 32
+# 解压时每次读写的字节数
+EXTRACT_CHUNK = 1024 * 1024
+
+
+def read_header(path):
+    """
+    只读取DICOM文件头 (stop_before_pixels)，返回组装序列需要的字段；不是DICOM文件时返回 None。
+    """
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True)
+    except (pydicom.errors.InvalidDicomError, OSError):
+        return None
+    if 'SeriesInstanceUID' not in ds or 'Rows' not in ds:
+        return None
+    position = ds.get('ImagePositionPatient')
+    orientation = ds.get('ImageOrientationPatient')
+    return {
+        'path': path,
+        'series_uid': str(ds.SeriesInstanceUID),
+        'series_description': str(ds.get('SeriesDescription', '') or ''),
+        'sop_uid': str(ds.get('SOPInstanceUID', '') or ''),
+        'instance': int(ds.InstanceNumber) if ds.get('InstanceNumber') is not None else None,
+        'position': tuple(float(v) for v in position) if position and len(position) == 3 else None,
+        'orientation': tuple(float(v) for v in orientation) if orientation and len(orientation) == 6 else None,
+        'shape': (int(ds.Rows), int(ds.Columns)),
+        'frames': int(ds.get('NumberOfFrames', 1) or 1),
+        'samples': int(ds.get('SamplesPerPixel', 1) or 1),
+        'slope': float(ds.get('RescaleSlope', 1) or 1),
+        'intercept': float(ds.get('RescaleIntercept', 0) or 0),
+    }
+
+
+def _read_headers(paths):
+    return [read_header(path) for path in paths]
+
+
+def scan_headers(paths, workers=None):
+    """
+    并行读取一批文件的DICOM文件头，返回与 paths 顺序一致的列表，非DICOM文件为 None。
+    :param workers: 共享进程池的进程数，默认且最多为CPU核数；为1时串行读取
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(paths) < MIN_PARALLEL_FILES:
+        return _read_headers(paths)
+    chunks = [paths[i:i + HEADER_CHUNK] for i in range(0, len(paths), HEADER_CHUNK)]
+    pool = shared_pool(workers)
+    try:
+        return [header for result in pool.map(_read_headers, chunks) for header in result]
+    except BrokenProcessPool:
+        discard_pool(pool)
+        raise
+
+
+def _sort_key(normal):
+    """
+    切片排序: 优先按 ImagePositionPatient 在切片法向上的投影，其次按 InstanceNumber，最后按文件名。
+    """
+    def key(header):
+        if normal is not None and header['position'] is not None:
+            return (0, float(np.dot(header['position'], normal)), 0)
+        if header['instance'] is not None:
+            return (1, float(header['instance']), 0)
+        return (2, 0.0, header['path'])
+    return key
+
+
+def group_series(headers):
+    """
+    按 SeriesInstanceUID 分组并排序。
+    同一序列中尺寸与多数切片不同的文件 (例如定位像) 以及多帧文件会被剔除。
+    :return: {SeriesInstanceUID: 排好序的文件头列表}, [被剔除的文件头]
+    """
+    grouped = defaultdict(list)
+    for header in headers:
+        if header is not None:
+            grouped[header['series_uid']].append(header)
+
+    series, rejected = {}, []
+    for series_uid, members in grouped.items():
+        shape = Counter(h['shape'] for h in members).most_common(1)[0][0]
+        kept = []
+        for h in members:
+            (kept if h['shape'] == shape and h['frames'] == 1 and h['samples'] == 1 else rejected).append(h)
+        if not kept:
+            continue
+        normal = None
+        orientation = kept[0]['orientation']
+        if orientation is not None:
+            normal = np.cross(orientation[:3], orientation[3:])
+        series[series_uid] = sorted(kept, key=_sort_key(normal))
+    return series, rejected
+
+
+def _frame_bytes(header, dtype, slope, intercept):
+    """解码单个文件的像素数据，换算到第一张切片的存储值空间后返回字节"""
+    arr = pydicom.dcmread(header['path']).pixel_array
+    if (header['slope'], header['intercept']) != (slope, intercept):
+        # 各切片的 Rescale 不同时 (常见于PET)，按第一张切片的 Rescale 重新量化
+        info = np.iinfo(dtype)
+        arr = (arr.astype(np.float64) * header['slope'] + header['intercept'] - intercept) / slope
+        arr = np.clip(np.rint(arr), info.min, info.max)
+    return arr.astype(dtype, copy=False).tobytes()
+
+
+def assemble_series(members, path):
+    """
+    把排好序的单帧DICOM文件组装为一个未压缩的多帧DICOM文件，供现有的3D切片流程使用。
+    文件头取自第一张切片，像素数据逐张解码后追加写入，任意时刻只有一张切片的像素在内存中。
+    生成的文件内容只由输入决定，相同的序列重复上传时内容哈希不变。
+    :return: (帧数, 文件内容的SHA-256)
+    """
+    ds = pydicom.dcmread(members[0]['path'], stop_before_pixels=True)
+    rows, columns = members[0]['shape']
+    bits = int(ds.BitsAllocated)
+    dtype = np.dtype(f"<{'i' if ds.PixelRepresentation == 1 else 'u'}{bits // 8}")
+
+    ds.NumberOfFrames = len(members)
+    ds.SOPInstanceUID = generate_uid(entropy_srcs=[m['sop_uid'] or m['path'] for m in members])
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    # 像素数据重新以未压缩形式写出，压缩相关的属性不再适用
+    for keyword in ('LossyImageCompression', 'LossyImageCompressionRatio', 'LossyImageCompressionMethod'):
+        if keyword in ds:
+            delattr(ds, keyword)
+
+    header = io.BytesIO()
+    ds.save_as(header, enforce_file_format=True)
+    length = rows * columns * dtype.itemsize * len(members)
+    padding = length % 2
+    vr = b'OB' if bits == 8 else b'OW'
+
+    digest = hashlib.sha256()
+    slope, intercept = members[0]['slope'], members[0]['intercept']
+    with open(path, 'wb') as f:
+        def write(data):
+            digest.update(data)
+            f.write(data)
+
+        write(header.getvalue())
+        # PixelData (7FE0,0010) 的显式VR元素头: 标签 + VR + 2字节保留 + 4字节长度
+        write(struct.pack('<HH2s2xI', 0x7FE0, 0x0010, vr, length + padding))
+        for member in members:
+            write(_frame_bytes(member, dtype, slope, intercept))
+        if padding:
+            write(b'\x00')
+    return len(members), digest.hexdigest()
+
+
+class ArchiveTooLarge(ValueError):
+    """压缩包的文件数或解压后的总大小超过限制"""
+
+
+def extract_zip(zip_path, target_dir, max_files, max_bytes):
+    """
+    解压zip中的所有文件到 target_dir，返回解压后的路径列表。
+    解压后的文件按序号重新命名，不使用压缩包内的路径，避免目录穿越。
+    解压前按目录中登记的大小检查文件数和总大小，解压时再按实际写出的字节数检查 (登记的大小可以伪造)，
+    超过 max_files 或 max_bytes 时抛出 ArchiveTooLarge，防止压缩炸弹占满工作目录。
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        members = [info for info in archive.infolist()
+                   if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+        if len(members) > max_files:
+            raise ArchiveTooLarge(f'压缩包中的文件数超过 {max_files} 个')
+        if sum(info.file_size for info in members) > max_bytes:
+            raise ArchiveTooLarge(f'压缩包解压后超过 {max_bytes // (1024 * 1024)} MB')
+
+        paths, written = [], 0
+        for info in members:
+            path = os.path.join(target_dir, f"{len(paths)}.dcm")
+            paths.append(path)
+            with archive.open(info) as src, open(path, 'wb') as dst:
+                for chunk in iter(lambda: src.read(EXTRACT_CHUNK), b''):
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise ArchiveTooLarge(f'压缩包解压后超过 {max_bytes // (1024 * 1024)} MB')
+                    dst.write(chunk)
+    return paths
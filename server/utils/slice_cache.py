@@ -0,0 +1,231 @@
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from utils.oss import download_from_oss
+from utils.imaging import load_volume, compute_window
+
+
+class LruBytesCache:
+    """
+    按字节数限制容量的内存 LRU 缓存，线程安全。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+
+class DiskLru:
+    """
+    按字节数限制容量的磁盘目录缓存，以文件访问时间近似 LRU 顺序淘汰。
+    已用字节数在启动时扫描一次目录得到，之后在写入和淘汰时增减；只有超出容量时才重新扫描目录，
+    按访问时间淘汰并校正已用字节数 (例如其他进程共用同一目录时)。
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._scan())
+
+    def path(self, key, suffix=''):
+        return os.path.join(self.root, hashlib.sha1(key.encode('utf-8')).hexdigest() + suffix)
+
+    def touch(self, path):
+        """记录一次访问，返回文件是否存在"""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def read(self, key):
+        path = self.path(key)
+        if not self.touch(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def write(self, key, value):
+        path = self.path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(value)
+        self.put_file(tmp_path, path)
+
+    def put_file(self, src_path, path):
+        """
+        把已写好的文件移到缓存中的 path (替换同名文件)，计入已用字节数，超出容量时淘汰。
+        源文件与缓存目录不在同一文件系统时 (例如工作目录在 tmpfs 上) 先复制到缓存目录再替换。
+        """
+        size = os.path.getsize(src_path)
+        try:
+            self._replace(src_path, path, size)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                shutil.copyfile(src_path, tmp_path)
+                self._replace(tmp_path, path, size)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            os.remove(src_path)
+
+    def _replace(self, src_path, path, size):
+        with self._lock:
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(src_path, path)
+            self._size += size - replaced
+            if self._size > self.max_bytes:
+                self._prune()
+
+    def prune(self):
+        with self._lock:
+            self._prune()
+
+    def _scan(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _prune(self):
+        entries = self._scan()
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                pass
+
+
+class SliceCache:
+    """
+    按需生成切片使用的缓存:
+    - 渲染好的切片PNG: 内存 LRU + 磁盘 LRU 两级缓存
+    - 原始影像文件: 从OSS下载到本地磁盘后以内存映射方式打开，已打开的体数据及其窗口保留在内存中
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.memory = None
+        self.disk = None
+        self.originals = None
+        self._volumes = OrderedDict()
+        self._volume_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SLICE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'hidoc_slices'))
+        app.config.setdefault('SLICE_CACHE_MEMORY_MB', 256)
+        app.config.setdefault('SLICE_CACHE_DISK_MB', 2048)
+        app.config.setdefault('SLICE_CACHE_ORIGINALS_MB', 8192)
+        # 同时保持打开的体数据个数
+        app.config.setdefault('SLICE_CACHE_VOLUMES', 4)
+        root = app.config['SLICE_CACHE_DIR']
+        self.memory = LruBytesCache(app.config['SLICE_CACHE_MEMORY_MB'] * 1024 * 1024)
+        self.disk = DiskLru(os.path.join(root, 'png'), app.config['SLICE_CACHE_DISK_MB'] * 1024 * 1024)
+        self.originals = DiskLru(os.path.join(root, 'originals'), app.config['SLICE_CACHE_ORIGINALS_MB'] * 1024 * 1024)
+        app.extensions['slice_cache'] = self
+        self.app = app
+
+    def get_png(self, key):
+        png = self.memory.get(key)
+        if png is None:
+            png = self.disk.read(key)
+            if png is not None:
+                self.memory.put(key, png)
+        return png
+
+    def put_png(self, key, png):
+        self.memory.put(key, png)
+        self.disk.write(key, png)
+
+    def original_path(self, oss_key):
+        suffix = '.nii.gz' if oss_key.endswith('.nii.gz') else os.path.splitext(oss_key)[1]
+        return self.originals.path(oss_key, suffix)
+
+    def adopt_original(self, oss_key, path):
+        """把上传时已落盘的原始文件移入缓存，避免首次访问切片时再从OSS下载"""
+        self.originals.put_file(path, self.original_path(oss_key))
+
+    def fetch_original(self, oss_key):
+        """返回原始文件在缓存中的路径，不在缓存中时先从OSS下载"""
+        path = self.original_path(oss_key)
+        if not self.originals.touch(path):
+            # 先下载到临时文件，避免并发读取到下载了一半的文件
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                download_from_oss(oss_key, tmp_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self.originals.put_file(tmp_path, path)
+        return path
+
+    def get_volume(self, image, windowing):
+        """
+        返回 (pixel_array, ds, window)。window 在 'slice' 模式下为 None。
+        """
+        key = (image.oss_key, windowing)
+        with self._volume_lock:
+            if key in self._volumes:
+                self._volumes.move_to_end(key)
+                return self._volumes[key]
+
+        path = self.fetch_original(image.oss_key)
+        pixel_array, ds = load_volume(path, image.format, native=(windowing != 'slice'))
+        window = None if windowing == 'slice' else compute_window(pixel_array, ds, windowing)
+        entry = (pixel_array, ds, window)
+
+        with self._volume_lock:
+            self._volumes[key] = entry
+            while len(self._volumes) > self.app.config['SLICE_CACHE_VOLUMES']:
+                self._volumes.popitem(last=False)
+        return entry
+
+
+slice_cache = SliceCache()
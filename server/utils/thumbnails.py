@@ -0,0 +1,30 @@
+import io
+from PIL import Image as PilImage
+
+# 缩略图格式: 配置名 -> (PIL 编码器名, 文件后缀)
+THUMBNAIL_FORMATS = {
+    'webp': ('WEBP', 'webp'),
+    'jpeg': ('JPEG', 'jpg'),
+}
+THUMBNAIL_QUALITY = 80
+
+
+def thumbnail_name(size, fmt):
+    """缩略图的文件名，尺寸和格式都写进文件名，配置变化后不会覆盖旧的缩略图"""
+    return f"thumb_{size}.{THUMBNAIL_FORMATS[fmt][1]}"
+
+
+def encode_thumbnail(pil_img, size, fmt, quality=THUMBNAIL_QUALITY):
+    """
+    把图像等比缩小到长边不超过 size 后按 fmt 编码，返回字节。
+    灰度图保持单通道，其余模式转为 RGB (JPEG 不支持透明通道)。
+    """
+    encoder, _ = THUMBNAIL_FORMATS[fmt]
+    # JPEG 等格式解码时可以直接按比例缩小，省去大部分像素的解码
+    pil_img.draft(pil_img.mode, (size, size))
+    img = pil_img if pil_img.mode in ('L', 'RGB') else pil_img.convert('RGB')
+    img = img.copy()
+    img.thumbnail((size, size), PilImage.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, format=encoder, quality=quality)
+    return buffer.getvalue()
@@ -0,0 +1,98 @@
+import io
+import math
+
+# 瓦片边长(像素)与相邻瓦片的重叠像素数，与 Deep Zoom (DZI) 的默认约定一致
+TILE_SIZE = 256
+TILE_OVERLAP = 0
+# 支持的瓦片格式: 医学灰度影像默认无损PNG，大幅彩色图片可选JPEG
+TILE_FORMATS = {'png': 'PNG', 'jpeg': 'JPEG'}
+JPEG_QUALITY = 90
+
+
+def pyramid_levels(width, height):
+    """
+    按 DZI 约定计算金字塔各层的尺寸。
+    第0层为 1x1，最高层为原图尺寸，相邻两层的宽高相差一半(向上取整)。
+    :return: [(level, width, height)]，按层级从低到高排列
+    """
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    levels = []
+    for level in range(max_level + 1):
+        scale = 2 ** (max_level - level)
+        levels.append((level, math.ceil(width / scale), math.ceil(height / scale)))
+    return levels
+
+
+def tile_grid(width, height, tile_size=TILE_SIZE):
+    """返回某一层的瓦片列数和行数"""
+    return math.ceil(width / tile_size), math.ceil(height / tile_size)
+
+
+def tile_key(prefix, level, col, row, fmt='png'):
+    """瓦片的存储键，目录结构与 DZI 相同: {prefix}_files/{level}/{col}_{row}.{fmt}"""
+    return f"{prefix}_files/{level}/{col}_{row}.{fmt}"
+
+
+def dzi_xml(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, fmt='png'):
+    """生成 DZI 描述文件，OpenSeadragon 等查看器可直接加载"""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" '
+        f'Overlap="{overlap}" Format="{fmt}"><Size Width="{width}" Height="{height}"/></Image>'
+    ).encode('utf-8')
+
+
+def _prepare(pil_img, fmt):
+    """统一为可直接编码的颜色模式，JPEG 不支持透明通道"""
+    if fmt == 'jpeg':
+        return pil_img if pil_img.mode in ('L', 'RGB') else pil_img.convert('RGB')
+    return pil_img if pil_img.mode in ('L', 'LA', 'RGB', 'RGBA') else pil_img.convert('RGBA')
+
+
+def _encode(tile, fmt):
+    buffer = io.BytesIO()
+    if fmt == 'jpeg':
+        tile.save(buffer, format='JPEG', quality=JPEG_QUALITY)
+    else:
+        tile.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def iter_tiles(pil_img, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, fmt='png'):
+    """
+    从原图开始逐层缩小，依次产出每张瓦片 (level, col, row, 编码后的字节)。
+    每层由上一层缩小一半得到，而不是每层都从原图缩放，内存中同时只保留一层图像。
+    """
+    if fmt not in TILE_FORMATS:
+        raise ValueError(f"不支持的瓦片格式: {fmt}")
+    level_img = _prepare(pil_img, fmt)
+    levels = pyramid_levels(*level_img.size)
+
+    for level, width, height in reversed(levels):
+        if level_img.size != (width, height):
+            # reduce 对 2x2 像素块取平均，奇数尺寸时结果向上取整，与 DZI 的层尺寸一致
+            level_img = level_img.reduce(2)
+        cols, rows = tile_grid(width, height, tile_size)
+        for col in range(cols):
+            for row in range(rows):
+                left = max(col * tile_size - overlap, 0)
+                upper = max(row * tile_size - overlap, 0)
+                right = min((col + 1) * tile_size + overlap, width)
+                lower = min((row + 1) * tile_size + overlap, height)
+                yield level, col, row, _encode(level_img.crop((left, upper, right, lower)), fmt)
+
+
+def manifest(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, fmt='png'):
+    """各层尺寸和瓦片行列数，供客户端按缩放级别只请求可见区域的瓦片"""
+    levels = []
+    for level, level_width, level_height in pyramid_levels(width, height):
+        cols, rows = tile_grid(level_width, level_height, tile_size)
+        levels.append({'level': level, 'width': level_width, 'height': level_height, 'cols': cols, 'rows': rows})
+    return {
+        'width': width,
+        'height': height,
+        'tile_size': tile_size,
+        'overlap': overlap,
+        'format': fmt,
+        'levels': levels
+    }